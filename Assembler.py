@@ -5,6 +5,11 @@
 import re
 import os
 import sys, getopt
+import json
+import shlex
+import time
+import traceback
+import concurrent.futures
 from colorama import Fore, Style
 from datetime import datetime
 
@@ -14,489 +19,1126 @@ import Instructions
 import Preprocessor
 import Symbols
 import Macro
+import Rom
+from FileLine import FileLine, LineStore
+from Statement import *
 from Msg import *
 
-# CLI options
-ignore_info_msg = False
-ignore_warn_msg = False
-
 # Assembler
-re_symbol_table = {}
-un_symbol_table = {}
-SYMVALUNK = 0xffffffff
+SYMVALUNK = Symbols.SYMVALUNK
 # MATH_OPS = ("+", "-", "*", "/", "%", "<<", ">>", "|", "&", "^")
 MATH_OPS = ("+", "-", "*", "/")
 MATH_ALT_OPS = ("%", "|", "&", "^")
 INTERNAL_PC_SYM = "__$PC__"
 MAX_PASSES = 7
-
-pc = -1
-line_num = 0
-file_contents = []
-rom_size = 0
-rom_offset = 0
-rom_contents = []
-pass_num = 0
-needs_another_pass = False
-build_num = -1                  # Read from BUILD.NUM file
 LIST_LINE_BREAK = 29            # Width of line before a new line is printed to breakup bytes in a listing file
 
-# For reg widths
-al = False
-xl = False
-
-def getpcsym(lpc):
-    return Symbols.Symbol(INTERNAL_PC_SYM, lpc, lpc, lpc)
-
-def addsym(sym, val, exp, lpc):
-    global re_symbol_table
-    global un_symbol_table
-
-    if pass_num == 1 and ( (sym in un_symbol_table and un_symbol_table[sym].val != val) or (sym in re_symbol_table and re_symbol_table[sym].val != val) ):
-        pmsg(ERROR,f"Multiple define symbol '{sym}'", file_contents[line_num-1])
-
-    if val == SYMVALUNK:
-        un_symbol_table[sym] = Symbols.Symbol(sym, val, exp, lpc)
-    else:
-        re_symbol_table[sym] = Symbols.Symbol(sym, val, exp, lpc)
-
-        if sym in un_symbol_table:
-            un_symbol_table.pop(sym)
-
-
-def getsym(sym, internal=False):
-    # print("SYM: ", sym, internal)
-    global needs_another_pass
-
-    if sym in re_symbol_table:
-        # print(f"Found resolved symbol: {sym}") # DEBUG
-        return re_symbol_table[sym].val
+# CLI options
+SHORT_OPTS = "r:a:o:iwl:s:b:d:j:h"
+# Options that take a path, the paths in a batch manifest are relative to the manifest
+PATH_OPTS = ("-a", "--asm", "-o", "--out", "-l", "--listing", "--pplisting", "-s", "--sym", "-b", "--build", "-d", "--base-dir", "--cache-dir", "--depfile")
+LONG_OPTS = ["rom=", "asm=", "out=", "ignoreinfo", "ignorewarn", "o64", "listing=", "pplisting=", "sym=", "build=", "base-dir=", "cache-dir=", "jobs=", "depfile=", "if-changed", "precedence", "sparse", "verify", "max-errors=", "batch=", "batch-jobs=", "hidden", "help"]
+
+# Batch builds
+BATCH_CRASHED = -3      # Exit code of a build that stopped with an internal error
+batch_lex_cache = None  # Lexer cache of a batch worker process, see initbatchworker()
+
+
+# Settings of an assembly, the CLI fills these in from its options
+class Options:
+    def __init__(self, **kwargs):
+        self.rom_size = 0x8000
+        self.base_dir = "./"    # Default to relative file paths
+        self.cache_dir = ""     # Include cache is disabled when empty
+        self.jobs = 1
+        self.ignore_info = False    # Ignore info messages on pass 1
+        self.ignore_warn = False    # Ignore warnings on pass 1
+        self.precedence = False     # Evaluate infix expressions with standard operator precedence
+        self.sparse = False
+        self.verify = False
+        self.max_errors = 1
+        self.build_num = -1
+        for name, val in kwargs.items():
+            if not hasattr(self, name):
+                raise TypeError(f"Unknown option '{name}'")
+            setattr(self, name, val)
+
+
+
+# Records everything a line read and changed while it was parsed. On the next pass, a line whose
+# inputs are unchanged is not parsed again, its outputs are replayed instead. The bytes the line
+# wrote are not copied, they are the line's own bytes in the LineStore
+class LineTrace:
+    __slots__ = ("asm", "pc", "al", "xl", "addr_mode", "rom_offset", "reads", "syms", "writes", "written", "replayable",
+                 "out_pc", "out_al", "out_xl", "out_rom_offset")
+
+    def __init__(self, asm, line):
+        self.asm = asm
+        self.pc = asm.pc
+        self.al = asm.al
+        self.xl = asm.xl
+        self.addr_mode = line.addr_mode
+        self.rom_offset = asm.rom_offset
+        self.reads = set()      # SYMs the line read, the SymbolTable tells the trace when one changes
+        self.syms = ()          # (SYM, VAL, EXP, LPC), arguments of each addsym() call (most lines have none)
+        self.writes = []        # ADDR, LENGTH of each run of bytes written to ROM
+        self.written = 0        # Number of bytes written to ROM
+        self.replayable = True  # False if the line must be parsed again on the next pass
+        self.out_pc = asm.pc
+        self.out_al = asm.al
+        self.out_xl = asm.xl
+        self.out_rom_offset = asm.rom_offset
+
+    # Returns true if the line would be parsed exactly as it was when it was recorded
+    def isclean(self, line):
+        return self.replayable and self.pc == self.asm.pc and self.al == self.asm.al and self.xl == self.asm.xl \
+            and self.addr_mode == line.addr_mode and self.rom_offset == self.asm.rom_offset
+
+    # Called by the SymbolTable when a symbol the line read changes
+    def symchanged(self, sym):
+        self.replayable = False
+
+    # Records bytes written to ROM, a write that carries on from the last one extends it
+    def wrote(self, addr, length):
+        writes = self.writes
+        if len(writes) > 0 and writes[-2] + writes[-1] == addr:
+            writes[-1] += length
+        else:
+            writes.append(addr)
+            writes.append(length)
+        self.written += length
+
+    # Repeats the line's outputs. The line still has the bytes it was given when it was recorded
+    def replay(self, line):
+        for sym, val, exp, lpc in self.syms:
+            self.asm.addsym(sym, val, exp, lpc)
+        data = line.getdata()
+        offset = 0
+        for i in range(0, len(self.writes), 2):
+            length = self.writes[i+1]
+            self.asm.storerom(self.writes[i], data[offset:offset+length])
+            offset += length
+        self.asm.pc = self.out_pc
+        self.asm.al = self.out_al
+        self.asm.xl = self.out_xl
+        self.asm.rom_offset = self.out_rom_offset
+
+
+# Syntax error found while compiling an expression in --precedence mode
+class ExpressionError(Exception):
+    pass
+
+
+# Returns a compiled expression that always evaluates to val
+def constexp(val):
+    def exp():
+        return val
+    exp.const = True
+    exp.syms = ()
+    return exp
+
+
+# Applies a unary operator in --precedence mode. '~' only stops a '(' from being read as indirect addressing
+def prattunary(op, a):
+    if op == "-":
+        return -a
+    elif op == "<":
+        return a & 0xff
+    elif op == ">":
+        return (a >> 8) & 0xff
+    elif op == "^":
+        return (a >> 16) & 0xff
+    return a
 
-    elif sym in un_symbol_table:
-        # print(f"Found unresolved symbol: {sym}") # DEBUG
-        return un_symbol_table[sym].val
 
-    if not internal:
-        if (not (ignore_info_msg and pass_num == 1)) and (len(sym) < 2 or sym[:2] != "__"): # Also ignore macro hidden labels
-            pmsg(INFO,f"Unknown symbol '{sym}'", file_contents[line_num-1], APASS)
-        needs_another_pass = True
-    return SYMVALUNK
+def unaryexp(op, operand):
+    if operand.const:
+        if operand() == SYMVALUNK:
+            return operand
+        return constexp(prattunary(op, operand()))
 
+    def exp():
+        a = operand()
+        if a == SYMVALUNK:
+            return SYMVALUNK
+        return prattunary(op, a)
+    exp.const = False
+    exp.syms = operand.syms
+    return exp
+
+
+# Binding power of the infix operators in --precedence mode (higher binds tighter)
+PRATT_BINARY = {"|": 1, "^": 2, "&": 3, "<<": 4, ">>": 4, "+": 5, "-": 5, "*": 6, "/": 6, "%": 6}
+PRATT_UNARY = 7 # -, ~ and the <, >, ^ byte selectors
+
+re_pratt_sym = re.compile(r"[a-zA-Z_\.][a-zA-Z0-9_\.]*")
+re_pratt_num = {
+    "$": re.compile(r"[0-9a-fA-F]+"),
+    "%": re.compile(r"[01]+"),
+    "&": re.compile(r"[0-7]+"),
+    "": re.compile(r"[0-9]+"),
+}
+
+
+# Top-down operator precedence parser that compiles an infix expression into nested closures
+class PrattParser:
+    def __init__(self, asm, string):
+        self.asm = asm
+        self.string = string
+        self.i = 0
+
+    def error(self, msg):
+        raise ExpressionError(f"{msg} in expression '{self.string}'")
+
+    def skipspace(self):
+        while self.i < len(self.string) and self.string[self.i].isspace():
+            self.i += 1
+
+    def peek(self):
+        self.skipspace()
+        if self.i < len(self.string):
+            return self.string[self.i]
+        return ""
+
+    def parseall(self):
+        if self.peek() == "":   # Empty expressions are 0, as in the default mode
+            return constexp(0)
+        exp = self.parse(0)
+        if self.peek() != "":
+            self.error(f"Unexpected '{self.string[self.i:]}'")
+        return exp
+
+    # Returns the binary operator at the current position, or "" if there is none
+    def peekop(self):
+        c = self.peek()
+        if self.string.startswith("<<", self.i) or self.string.startswith(">>", self.i):
+            return self.string[self.i:self.i+2]
+        if c in PRATT_BINARY:
+            return c
+        return ""
+
+    def parse(self, rbp):
+        left = self.parseoperand()
+        op = self.peekop()
+        while op != "" and PRATT_BINARY[op] > rbp:
+            self.i += len(op)
+            right = self.parse(PRATT_BINARY[op])
+            left = self.asm.binaryexp(op, left, right)
+            op = self.peekop()
+        return left
+
+    def parsenumber(self, prefix, base):
+        match = re_pratt_num[prefix].match(self.string, self.i + len(prefix))
+        if not match or re_pratt_sym.match(self.string, match.end()):
+            end = re.compile(r"[^\s()+\-*/|&^<>%]*").match(self.string, self.i).end()
+            self.error(f"Invalid number format '{self.string[self.i:end]}'")
+        self.i = match.end()
+        return constexp(int(match.group(0), base) & 0xffffffff)
+
+    def parseoperand(self):
+        c = self.peek()
+        if c == "":
+            self.error("Expected operand")
+
+        if c == "(":
+            self.i += 1
+            exp = self.parse(0)
+            if self.peek() != ")":
+                self.error("Missing ')'")
+            self.i += 1
+            return exp
+
+        if c in ("-", "~", "<", ">", "^"):
+            self.i += 1
+            return unaryexp(c, self.parse(PRATT_UNARY))
+
+        # Postfix block
+        if c == "{":
+            bcnt = 0
+            j = self.i
+            while j < len(self.string):
+                if self.string[j] == "{":
+                    bcnt += 1
+                elif self.string[j] == "}":
+                    bcnt -= 1
+                    if bcnt == 0:
+                        break
+                j += 1
+            if j == len(self.string):
+                self.error("Missing '}'")
+            sub = self.asm.compilepostfix(self.string[self.i+1:j+1])
+            self.i = j + 1
+            return self.asm.postfixexp(sub)
+
+        # Character literal
+        if c in ("'", '"'):
+            end = self.string.find(c, self.i + 2)
+            if end < 0:
+                self.error("Literal missing closing character")
+            literal = escapestr(self.string[self.i+1:end])
+            self.i = end + 1
+            return constexp(ord(literal[0]))
+
+        if c == "$":
+            if re_pratt_num["$"].match(self.string, self.i + 1):
+                return self.parsenumber("$", 16)
+            self.i += 1
+            return self.asm.symexp(INTERNAL_PC_SYM)
+        if c == "%":
+            return self.parsenumber("%", 2)
+        if c == "&":
+            return self.parsenumber("&", 8)
+        if c.isdigit():
+            return self.parsenumber("", 10)
+
+        match = re_pratt_sym.match(self.string, self.i)
+        if match:
+            self.i = match.end()
+            if match.group(0) == ".":
+                return self.asm.symexp(INTERNAL_PC_SYM)
+            return self.asm.symexp(match.group(0))
 
-# Returns true if a symbol is in one of the symbol tables
-def issym(sym):
-    return (sym in re_symbol_table) or (sym in un_symbol_table)
+        self.error(f"Unexpected '{c}'")
 
-# Attempts to resolve a symbol. If successful, symbol is moved to re_symbol_table
-def tryresolvesym(sym):
-    global un_symbol_table
-    global re_symbol_table
 
-    if sym in re_symbol_table:
-        return -1
+# Stack operations of a postfix expression. Each takes the argument stack and returns None to
+# continue or the value of the expression
+def postfixop(op):
+    if op == "+":
+        def run(args):
+            args.append(args.pop() + args.pop())
+    elif op == "-":
+        def run(args):
+            num1 = args.pop()
+            num2 = args.pop()
+            args.append(num2 - num1)
+    elif op == "*":
+        def run(args):
+            args.append(args.pop() * args.pop())
+    elif op == "/":
+        def run(args):
+            num1 = args.pop()
+            num2 = args.pop()
+            args.append(num2 / num1)
+    elif op == "%":
+        def run(args):
+            num1 = args.pop()
+            num2 = args.pop()
+            args.append(num2 % num1)
+    elif op == ">>":
+        def run(args):
+            num1 = args.pop()
+            num2 = args.pop()
+            args.append(num2 >> num1)
+    elif op == "<<":
+        def run(args):
+            num1 = args.pop()
+            num2 = args.pop()
+            args.append(num2 << num1)
+    elif op == "|":
+        def run(args):
+            args.append(args.pop() | args.pop())
+    elif op == "&":
+        def run(args):
+            args.append(args.pop() & args.pop())
+    elif op == "^":
+        def run(args):
+            args.append(args.pop() ^ args.pop())
+    return run
 
-    if sym not in un_symbol_table:
-        pmsg(ERROR, f"Internal error, unable to find sym '{sym}' in unresolved table during resolution.\nContact someone (probably me or your neighbor) to fix this!")
 
-    exp = un_symbol_table[sym].exp
-    lpc = un_symbol_table[sym].lpc
-    re_symbol_table[INTERNAL_PC_SYM] = getpcsym(lpc)  # Update the PC location
-    val = parseexp(exp)
+def postfixpush(sub):
+    def run(args):
+        args.append(sub())
+    return run
 
-    if val != SYMVALUNK:
-        re_symbol_table[sym] = Symbols.Symbol(sym, val, exp, lpc)
-        un_symbol_table.pop(sym)
-        return 1
 
-    return 0
+# Escapes a string
+def escapestr(string):
+    return string.replace("\\r", "\r") \
+                .replace("\\0", chr(0)) \
+                .replace("\\n", "\n") \
+                .replace("\\t", "\t") \
+                .replace("^G", chr(7)) \
+                .replace("^H", chr(8)) \
+                .replace("^I", chr(9)) \
+                .replace("^J", chr(0xA)) \
+                .replace("^L", chr(0xC)) \
+                .replace("^M", chr(0xD)) \
+                .replace("^[", chr(0x1B)) \
+                .replace("ESC[", chr(0x1B)) \
+                .replace("\\x1b", chr(0x1B))
 
 
-def writerom8(addr, octet):
-    if octet > 0xff or octet < 0:
-        if not (ignore_warn_msg and pass_num == 1):
-            pmsg(WARN, f"Value outside range [0..0xff]", file_contents[line_num-1])
-    global rom_offset
-    global rom_contents
-    global rom_size
-    if addr >= rom_offset + rom_size:
-        pmsg(ERROR, f"Data placed outside of ROM area", file_contents[line_num-1])
-    rom_contents[addr-rom_offset] = octet & 0xff
-
-
-def writerom16(addr, word):
-    if word > 0xffff or word < 0:
-        if not (ignore_warn_msg and pass_num == 1):
-            pmsg(WARN, f"Value outside range [0..0xffff]", file_contents[line_num-1])
-    writerom8(addr, word & 0x00ff)           # Lowbyte
-    writerom8(addr+1, (word & 0xff00) >> 8)  # Highbyte
-
-
-# Takes an instruction's address mode value and prints an error (and exits) if the address mode is not valid
-# Returns the instruction's opcode value if valid
-def checkreturnaddrmode(instruction_mode):
-    global line_num
-    # print(f"IS {(instruction_mode):04X}") # DEBUG
-    if (instruction_mode < 0):
-        pmsg(ERROR, f"Invalid addressing mode", file_contents[line_num-1])
-    return instruction_mode
-
-
-# Takes a string and returns the bytes for an instruction based on its addressing mode for an address or immediate data
-def getopcodebytes(operand, instruction_d, instruction_a, instruction_l):
-    global line_num
-    global needs_another_pass
-
-    mo = 0
-    addr_mode_force = 0
-
-    if file_contents[line_num - 1].addr_mode != 0:
-        addr_mode_force = file_contents[line_num - 1].addr_mode
-
-    if operand[0] == "<":
-        mo = 1
-        if addr_mode_force == 0:
-            addr_mode_force = 1
-    elif operand[0] in ["!"]:#, "|"]: # Not using '|' since it is used for bitwise OR
-        mo = 1
-        if addr_mode_force == 0:
-            addr_mode_force = 2
-    elif operand[0] == ">":
-        mo = 1
-        if addr_mode_force == 0:
-            addr_mode_force = 3
-
-    # print(f"operand: '{operand[mo:]}'")
-    val = parseexp(operand[mo:])
-
-    returnbytes = []
-
-    if (val < 0x000100 and val >= 0 and addr_mode_force == 0 and instruction_d != -1) \
-            or addr_mode_force == 1 \
-            or (val == SYMVALUNK and instruction_a == -1 and instruction_d != -1):
-        returnbytes.append(checkreturnaddrmode(instruction_d))
-        returnbytes.append(val & 0xff)
-        file_contents[line_num - 1].addr_mode = 1 # Force addressing mode for next pass
-    elif (val < 0x010000 and val >= 0x000000 and addr_mode_force == 0 and instruction_a != -1) \
-            or addr_mode_force == 2 \
-            or (val == SYMVALUNK and instruction_a != -1) \
-            or (instruction_d == -1 and instruction_a != -1 and instruction_l == -1):
-        returnbytes.append(checkreturnaddrmode(instruction_a))
-        returnbytes.append(val & 0xff)
-        returnbytes.append((val >> 8) & 0xff)
-        file_contents[line_num - 1].addr_mode = 2  # Force addressing mode for next pass
-    elif (val <= 0xffffff and val >= 0x000000 and addr_mode_force == 0 and instruction_l != -1) \
-            or addr_mode_force == 3:
-        returnbytes.append(checkreturnaddrmode(instruction_l))
-        returnbytes.append(val & 0xff)
-        returnbytes.append((val >> 8) & 0xff)
-        returnbytes.append((val >> 16) & 0xff)
-        file_contents[line_num - 1].addr_mode = 3 # Force addressing mode for next pass
-    else:
-        # print("getopcodebytes - unable to determine addressing mode operand length")
-        checkreturnaddrmode(-1)  # Error and exit
+# Parses a string and returns a list of comma-separated elements
+def parsecsv(str):
 
-    # Value contains an unresolved symbol, assume an addressing mode
-    if val == SYMVALUNK:
-        needs_another_pass = True
-        if addr_mode_force == 0 and (val == SYMVALUNK and instruction_a != -1):
+    i = 0
+    s = 0
+    iq = False
+    vals = []
 
-            file_contents[line_num - 1].addr_mode = 2  # Force addressing mode for next pass
+    while i < len(str):
+        if (str[i] == "," and not iq) or i == len(str)-1:
+            if i == len(str)-1:
+                i += 1
+            if str[s:i].strip() != "":
+                vals.append(escapestr(str[s:i].strip()))
+                s = i + 1
 
-            if not (ignore_warn_msg and pass_num == 1):
-                pmsg(WARN, f"Forward reference or unresolved symbol, defaulting to absolute addressing", file_contents[line_num-1], APASS)
+        elif str[i] == "\"":
+            iq = not iq
+        elif str[i] == "\\" and len(str) > i+1 and str[i+1] == "\"":
+            i += 1
+        i += 1
 
-        elif val == SYMVALUNK and (
-                (instruction_d != -1 and addr_mode_force == 1) or
-                (instruction_a != -1 and addr_mode_force == 2) or
-                (instruction_l != -1 and addr_mode_force == 3)):
+    return vals
 
-            if not (ignore_warn_msg and pass_num == 1):
-                pmsg(INFO, f"Forced addressing mode '{addr_mode_force}'", file_contents[line_num-1])
 
+# State of one assembly. Every assembly has its own Assembler, so several can run in the
+# same process (or on different threads) without sharing anything
+class Assembler:
+    def __init__(self, options=None, diagnostics=None, lex_cache=None):
+        if options is None:
+            options = Options()
+        if diagnostics is None:
+            diagnostics = Diagnostics(options.max_errors)
+        self.options = options
+        self.diagnostics = diagnostics
+        self.pmsg = diagnostics.pmsg
+        self.preprocessor = Preprocessor.Preprocessor(diagnostics, options.cache_dir, lex_cache)
+
+        self.ignore_info_msg = options.ignore_info
+        self.ignore_warn_msg = options.ignore_warn
+        self.exp_precedence = options.precedence
+
+        self.symbol_table = Symbols.SymbolTable()
+        self.sym_lines = {}      # SYM, number of the line with its latest definition
+        self.pc = -1
+        self.line_num = 0
+        self.file_contents = LineStore()
+        self.rom_size = options.rom_size
+        self.rom_offset = 0
+        self.rom_contents = bytearray()
+        self.sparse_rom = None  # Rom.SparseRom when --sparse is used, rom_contents is not used then
+        if options.sparse:
+            self.sparse_rom = Rom.SparseRom()
+        self.pass_num = 0
+        self.needs_another_pass = False
+        self.exp_cache = {}      # (STRING, starts with paren), compiled expression
+        self.num_cache = {}      # STRING, compiled number
+        self.postfix_cache = {}  # STRING, compiled postfix expression
+        self.pratt_cache = {}    # STRING, compiled --precedence expression
+        self.stmt_cache = {}     # STRING, decoded statements of a line
+        self.line_trace = None   # LineTrace of the line being parsed, None if the line is not being recorded
+        self.build_num = options.build_num  # Read from BUILD.NUM file
+
+        # For reg widths
+        self.al = False
+        self.xl = False
+
+    # Stops the line being parsed from being replayed on the next pass
+    def keepdirty(self):
+        if self.line_trace is not None:
+            self.line_trace.replayable = False
+
+    # Returns true if a message is hidden because of the ignore option on the first pass.
+    # The line is parsed again on the next pass, so the message is not lost
+    def hidemsg(self, ignore):
+        if ignore and self.pass_num == 1:
+            self.keepdirty()
+            return True
+        return False
+
+    # Returns the line being assembled, which messages about expressions are reported against.
+    # None if no line is being assembled
+    def curline(self):
+        if self.line_num < 1 or self.line_num > len(self.file_contents):
+            return None
+        return self.file_contents[self.line_num-1]
+
+    # Updates the PC symbol. PC updates are not reported as symbol changes
+    def setpcsym(self, lpc):
+        self.symbol_table.define(INTERNAL_PC_SYM, lpc, lpc, lpc, False)
+
+    def addsym(self, sym, val, exp, lpc):
+        if self.line_trace is not None:
+            self.line_trace.syms += ((sym, val, exp, lpc),)
+
+        symbol = self.symbol_table.get(sym)
+        if self.pass_num == 1 and symbol is not None and ( (symbol.pending and val != SYMVALUNK) or (symbol.resolved and symbol.val != val) ):
+            self.pmsg(ERROR,f"Multiple define symbol '{sym}'", self.curline())
+
+        self.symbol_table.define(sym, val, exp, lpc)
+        self.sym_lines[sym] = self.line_num
+
+    def getsym(self, sym, internal=False):
+        # print("SYM: ", sym, internal)
+
+        symbol = self.symbol_table.get(sym)
+        if symbol is not None:
+            return symbol.val
+
+        if not internal:
+            if (not self.hidemsg(self.ignore_info_msg)) and (len(sym) < 2 or sym[:2] != "__"): # Also ignore macro hidden labels
+                self.pmsg(INFO,f"Unknown symbol '{sym}'", self.curline(), APASS)
+            self.needs_another_pass = True
+        return SYMVALUNK
+
+    # Attempts to resolve a symbol. If successful, the symbol is no longer pending
+    def tryresolvesym(self, sym):
+        symbol = self.symbol_table.get(sym)
+        if symbol is not None and symbol.resolved:
+            return -1
+
+        if symbol is None or not symbol.pending:
+            self.pmsg(ERROR, f"Internal error, unable to find sym '{sym}' in unresolved table during resolution.\nContact someone (probably me or your neighbor) to fix this!", fatal=True)
+
+        self.setpcsym(symbol.lpc)  # Update the PC location
+        line_num = self.line_num
+        self.line_num = self.sym_lines.get(sym, 0)   # Messages are about the line that defined the symbol
+        try:
+            val = self.parseexp(symbol.exp)
+        finally:
+            self.line_num = line_num
+
+        if val != SYMVALUNK:
+            self.symbol_table.resolve(sym, val)
+            return 1
+
+        return 0
+
+    # Resolves every unresolved symbol in dependency order, so each symbol's expression is only
+    # evaluated once. Circular definitions are reported by name
+    def resolvesyms(self):
+        deps = {}
+        pending = set(self.symbol_table.pendingsyms())
+        for sym in self.symbol_table.pendingsyms():
+            exp = self.symbol_table.get(sym).exp
+            deps[sym] = []
+            if isinstance(exp, str):
+                deps[sym] = [dep for dep in self.compileexp(exp).syms if dep in pending]
+
+        # Depth first search, a symbol is added to order after everything it depends on
+        order = []
+        state = {}  # SYM, False while its dependencies are being visited, True when done
+        for root in deps:
+            if root in state:
+                continue
+            path = [root]
+            pending = [iter(deps[root])]
+            state[root] = False
+            while len(path) > 0:
+                for dep in pending[-1]:
+                    if dep not in state:
+                        path.append(dep)
+                        pending.append(iter(deps[dep]))
+                        state[dep] = False
+                        break
+                    if not state[dep]:
+                        cycle = path[path.index(dep):] + [dep]
+                        self.pmsg(ERROR, f"Circular symbol definition: {' -> '.join(cycle)}")
+                else:
+                    state[path[-1]] = True
+                    order.append(path.pop())
+                    pending.pop()
+
+        # An error in a symbol's expression leaves it unresolved, the other symbols are still resolved
+        for sym in order:
+            self.diagnostics.recover = True
+            try:
+                self.tryresolvesym(sym)
+            except LineError:
+                pass
+            finally:
+                self.diagnostics.recover = False
+
+        unresolved = self.symbol_table.pendingsyms()
+        if len(unresolved) > 0:
+            self.pmsg(ERROR, f"Unable to resolve symbol(s): {', '.join(unresolved)}")
+
+    def writerom8(self, addr, octet):
+        if octet > 0xff or octet < 0:
+            if not self.hidemsg(self.ignore_warn_msg):
+                self.pmsg(WARN, f"Value outside range [0..0xff]", self.curline())
+        if self.sparse_rom is not None:
+            if addr < 0 or addr >= Rom.ADDR_SPACE:
+                self.pmsg(ERROR, f"Data placed outside of 24-bit address space", self.curline())
+                return
+            self.sparse_rom.write(addr, bytes((octet & 0xff,)))
         else:
-            pmsg(ERROR, f"Forward reference or unresolved symbol, unable to determine addresssing mode", file_contents[line_num-1])
-
-    return returnbytes
+            if addr >= self.rom_offset + self.rom_size:
+                self.pmsg(ERROR, f"Data placed outside of ROM area", self.curline())
+                return
+            self.rom_contents[addr-self.rom_offset] = octet & 0xff
+        if self.line_trace is not None:
+            self.line_trace.wrote(addr, 1)
+
+    # Writes a list of bytes to ROM with a single slice write. Falls back to writerom8() for each
+    # byte if any of them would print a message, so the messages are the same
+    def writerom(self, addr, octets):
+        try:
+            data = bytes(octets)
+        except ValueError:  # A value is outside [0..0xff]
+            data = None
 
-# Calculates the branch offset for an 8-bit relative operation
-def calcrel8(from_addr, to_addr):
-    global line_num
+        if self.sparse_rom is not None:
+            start = 0
+            end = Rom.ADDR_SPACE
+        else:
+            start = self.rom_offset
+            end = self.rom_offset + self.rom_size
+
+        if data is None or addr < start or addr + len(data) > end:
+            for octet in octets:
+                self.writerom8(addr, octet)
+                addr += 1
+            return
+
+        self.storerom(addr, data)
+        if self.line_trace is not None:
+            self.line_trace.wrote(addr, len(data))
+
+    # Stores bytes that have already been checked in the ROM image
+    def storerom(self, addr, data):
+        if self.sparse_rom is not None:
+            self.sparse_rom.write(addr, data)
+        else:
+            self.rom_contents[addr-self.rom_offset:addr-self.rom_offset+len(data)] = data
+
+    def writerom16(self, addr, word):
+        if word > 0xffff or word < 0:
+            if not self.hidemsg(self.ignore_warn_msg):
+                self.pmsg(WARN, f"Value outside range [0..0xffff]", self.curline())
+        self.writerom8(addr, word & 0x00ff)           # Lowbyte
+        self.writerom8(addr+1, (word & 0xff00) >> 8)  # Highbyte
+
+    # Takes an instruction's address mode value and prints an error (and exits) if the address mode is not valid
+    # Returns the instruction's opcode value if valid
+    def checkreturnaddrmode(self, instruction_mode):
+        # print(f"IS {(instruction_mode):04X}") # DEBUG
+        if (instruction_mode < 0):
+            self.pmsg(ERROR, f"Invalid addressing mode", self.curline())
+        return instruction_mode
+
+    # Takes a string and returns the bytes for an instruction based on its addressing mode for an address or immediate data
+    def getopcodebytes(self, exp, force, instruction_d, instruction_a, instruction_l):
+        addr_mode_force = force
+
+        if self.file_contents[self.line_num - 1].addr_mode != 0:
+            addr_mode_force = self.file_contents[self.line_num - 1].addr_mode
+
+        val = self.evalexp(exp)
+
+        returnbytes = []
+
+        if (val < 0x000100 and val >= 0 and addr_mode_force == 0 and instruction_d != -1) \
+                or addr_mode_force == 1 \
+                or (val == SYMVALUNK and instruction_a == -1 and instruction_d != -1):
+            returnbytes.append(self.checkreturnaddrmode(instruction_d))
+            returnbytes.append(val & 0xff)
+            self.file_contents[self.line_num - 1].addr_mode = 1 # Force addressing mode for next pass
+        elif (val < 0x010000 and val >= 0x000000 and addr_mode_force == 0 and instruction_a != -1) \
+                or addr_mode_force == 2 \
+                or (val == SYMVALUNK and instruction_a != -1) \
+                or (instruction_d == -1 and instruction_a != -1 and instruction_l == -1):
+            returnbytes.append(self.checkreturnaddrmode(instruction_a))
+            returnbytes.append(val & 0xff)
+            returnbytes.append((val >> 8) & 0xff)
+            self.file_contents[self.line_num - 1].addr_mode = 2  # Force addressing mode for next pass
+        elif (val <= 0xffffff and val >= 0x000000 and addr_mode_force == 0 and instruction_l != -1) \
+                or addr_mode_force == 3:
+            returnbytes.append(self.checkreturnaddrmode(instruction_l))
+            returnbytes.append(val & 0xff)
+            returnbytes.append((val >> 8) & 0xff)
+            returnbytes.append((val >> 16) & 0xff)
+            self.file_contents[self.line_num - 1].addr_mode = 3 # Force addressing mode for next pass
+        else:
+            # print("getopcodebytes - unable to determine addressing mode operand length")
+            self.checkreturnaddrmode(-1)  # Error and exit
 
-    offset = to_addr - from_addr
+        # Value contains an unresolved symbol, assume an addressing mode
+        if val == SYMVALUNK:
+            self.needs_another_pass = True
+            if addr_mode_force == 0 and (val == SYMVALUNK and instruction_a != -1):
 
-    if from_addr < to_addr:
-        if offset > 0x7F:
-            pmsg(ERROR, f"Branch out of range (0x{offset:02X} > +0x7F)", file_contents[line_num-1])
-    else:
-        if offset < -0x80:
-            pmsg(ERROR, f" Branch out of range (0x{offset:02X} < -0x80)", file_contents[line_num-1])
-    return offset & 0xFF
+                self.file_contents[self.line_num - 1].addr_mode = 2  # Force addressing mode for next pass
 
+                if not self.hidemsg(self.ignore_warn_msg):
+                    self.pmsg(WARN, f"Forward reference or unresolved symbol, defaulting to absolute addressing", self.curline(), APASS)
 
-# Calculates the branch offset for an 16-bit relative operation
-def calcrel16(from_addr, to_addr):
-    global line_num
+            elif val == SYMVALUNK and (
+                    (instruction_d != -1 and addr_mode_force == 1) or
+                    (instruction_a != -1 and addr_mode_force == 2) or
+                    (instruction_l != -1 and addr_mode_force == 3)):
 
-    offset = to_addr - from_addr
+                if not self.hidemsg(self.ignore_warn_msg):
+                    self.pmsg(INFO, f"Forced addressing mode '{addr_mode_force}'", self.curline())
 
-    if from_addr < to_addr:
-        if offset > 0x7FFF:
-            pmsg(ERROR,
-                 f"Branch out of range (0x{offset:04X} > +0x7FFF)", file_contents[line_num-1])
-    else:
-        if offset < -0x8000:
-            pmsg(ERROR,
-                 f"Branch out of range (0x{offset:04X} < -0x8000)", file_contents[line_num-1])
-    return offset & 0xFFFF
-
-
-# Returns the value of the number contained in str. Whitespace padding is permitted
-def parsenum(string):
-    global re_symbol_table
-    global line_num
-    # print(f"PARSENUM: '{string}'")
-    string = string.strip()
-    if len(string) < 1:
-        pmsg(ERROR, f"Expected operand", file_contents[line_num-1])
-
-    shift = 0
-    mask = 0xffffffff
-    so = 0          # Selection Offset
-
-    # Check for byte selection operators
-    if string[0] == "<":
-        so = 1
-        mask = 0xff
-    elif string[0] == ">":
-        so = 1
-        shift = 8
-        mask = 0xff
-    elif string[0] == "^":
-        so = 1
-        shift = 16
-        mask = 0xff
-
-    val = 0
-    try:
-        if string[so].isdigit() or string[so] == '-':
-            val = int(string, base=10)
-        elif len(string) > so: # and (not strcontains(string, MATH_OPS) or strcontains(string, ["{", "}"])):
-            if string[so] == "$":
-                if string[so:] == "$":
-                    val = getsym(INTERNAL_PC_SYM)
-                else:
-                    val = int(string[so+1:], base=16)
-            elif string[so:] == ".":
-                val = getsym(INTERNAL_PC_SYM)
-            elif string[so] == "%":
-                val = int(string[so+1:], base=2)
-            elif string[so]== "&":
-                val = int(string[so+1:], base=8)
-            # elif string[so] == "{":
-            #     val = parsepostfixnum(string[so+1:])
-            # elif string[so] == "(":
-            #     val = parseexp(string[so:], True)
-            elif string[so] == "'" or string[so] == "\"":
-                if len(string) > so + 3 and string[so+1] == "\\":
-                    val = ord(escapestr(string[so+1:])[0])
-                elif len(string) > so + 2:
-                    val = ord(string[so+1])
-                else:
-                    pmsg(ERROR, f"Literal missing closing character", file_contents[line_num-1])
             else:
-                val = getsym(string)
-        # else:
-        #     val = parseexp(string, string[0] == "(")
-        else:
-            raise ValueError()
-
-    except ValueError:
-        pmsg(ERROR, f"Invalid number format '{string}'", file_contents[line_num-1])
-
-
-    # print(f"RET VAL: {(val >> shift) & mask:08x} | STR: '{string}'")
-    return (val >> shift) & mask
-
+                self.pmsg(ERROR, f"Forward reference or unresolved symbol, unable to determine addresssing mode", self.curline())
 
-# Preforms an operation on a string and accumulator, returns the results.
-# ONLY for use by the parseexp() function
-def performop(op, current_str, accumulator):
-    # print(f"PerformOP: '{op}':'{current_str}'")
-    # if i < len(str)-1 and ((character == "<" and str[i] == "<") or (character == ">" and str[i] == ">")):
-    if op in [">", "<"]:
-        op = 2 * op
-
-    arg = 0
+        return returnbytes
 
-    if current_str == "":
-        return accumulator
-    else:
-        arg = parsenum(current_str)
+    # Calculates the branch offset for an 8-bit relative operation
+    def calcrel8(self, from_addr, to_addr):
+        offset = to_addr - from_addr
 
-        # Still waiting for symbol value to be resolved, go for another pass
-        if arg == SYMVALUNK:
-            needs_another_pass = True
+        if from_addr < to_addr:
+            if offset > 0x7F:
+                self.pmsg(ERROR, f"Branch out of range (0x{offset:02X} > +0x7F)", self.curline())
+        else:
+            if offset < -0x80:
+                self.pmsg(ERROR, f" Branch out of range (0x{offset:02X} < -0x80)", self.curline())
+        return offset & 0xFF
+
+    # Calculates the branch offset for an 16-bit relative operation
+    def calcrel16(self, from_addr, to_addr):
+        offset = to_addr - from_addr
+
+        if from_addr < to_addr:
+            if offset > 0x7FFF:
+                self.pmsg(ERROR,
+                     f"Branch out of range (0x{offset:04X} > +0x7FFF)", self.curline())
+        else:
+            if offset < -0x8000:
+                self.pmsg(ERROR,
+                     f"Branch out of range (0x{offset:04X} < -0x8000)", self.curline())
+        return offset & 0xFFFF
+
+    # Returns the value of the number contained in str. Whitespace padding is permitted
+    def parsenum(self, string):
+        return self.compilenum(string)()
+
+    # Returns a function that reports an error about the current line when called. The value is
+    # unknown if the error does not stop the line (outside of a pass).
+    # Compiled expressions report errors when they are evaluated, not when they are compiled
+    def experror(self, msg):
+        def fail():
+            self.pmsg(ERROR, msg, self.curline())
             return SYMVALUNK
+        fail.syms = ()
+        return fail
+
+    # Returns a function that evaluates a number in the same way as parsenum().
+    # The function's dynamic attribute is true if its value comes from the symbol table.
+    # Every compiled number or expression has a syms attribute listing the symbols it reads
+    def compilenum(self, string):
+        num = self.num_cache.get(string)
+        if num is None:
+            try:
+                num = self.buildnum(string.strip())
+            except IndexError as e:   # Operand too short for its byte selector
+                err = e
+                def num():
+                    raise err
+                num.dynamic = False
+                num.syms = ()
+            self.num_cache[string] = num
+        return num
+
+    def buildnum(self, string):
+        if len(string) < 1:
+            num = self.experror(f"Expected operand")
+            num.dynamic = False
+            return num
+
+        shift = 0
+        mask = 0xffffffff
+        so = 0          # Selection Offset
+
+        # Check for byte selection operators
+        if string[0] == "<":
+            so = 1
+            mask = 0xff
+        elif string[0] == ">":
+            so = 1
+            shift = 8
+            mask = 0xff
+        elif string[0] == "^":
+            so = 1
+            shift = 16
+            mask = 0xff
+
+        sym = None
+        val = 0
+        try:
+            if string[so].isdigit() or string[so] == '-':
+                val = int(string, base=10)
+            elif len(string) > so:
+                if string[so] == "$":
+                    if string[so:] == "$":
+                        sym = INTERNAL_PC_SYM
+                    else:
+                        val = int(string[so+1:], base=16)
+                elif string[so:] == ".":
+                    sym = INTERNAL_PC_SYM
+                elif string[so] == "%":
+                    val = int(string[so+1:], base=2)
+                elif string[so]== "&":
+                    val = int(string[so+1:], base=8)
+                elif string[so] == "'" or string[so] == "\"":
+                    if len(string) > so + 3 and string[so+1] == "\\":
+                        val = ord(escapestr(string[so+1:])[0])
+                    elif len(string) > so + 2:
+                        val = ord(string[so+1])
+                    else:
+                        num = self.experror(f"Literal missing closing character")
+                        num.dynamic = False
+                        return num
+                else:
+                    sym = string
+            else:
+                raise ValueError()
+
+        except ValueError:
+            num = self.experror(f"Invalid number format '{string}'")
+            num.dynamic = False
+            return num
+
+        if sym is not None:
+            def num():
+                return (self.getsym(sym) >> shift) & mask
+            num.dynamic = True
+            num.syms = (sym,)
+        else:
+            val = (val >> shift) & mask
+            def num():
+                return val
+            num.dynamic = False
+            num.syms = ()
+        return num
+
+    # Converts a value calculated by a sub-expression into an operand in the same way as parsenum(str(val))
+    def tonum(self, val):
+        if type(val) is int and val.bit_length() < 4000:   # Huge values fail converting to a string
+            return val & 0xffffffff
+        return self.parsenum(str(val))
+
+    # Applies a binary operator (as written in an expression) to an accumulator and an operand
+    def applyop(self, op, accumulator, arg):
+        if op == "+":
+            return accumulator + arg
+        elif op == "-":
+            return accumulator - arg
+        elif op == "*":
+            return accumulator * arg
+        elif op == "/":
+            if arg == 0:
+                self.pmsg(ERROR, f"Division by zero", self.curline())
+                return SYMVALUNK
+            return int(accumulator / arg)
+        elif op == "%":
+            if arg == 0:
+                self.pmsg(ERROR, f"Division by zero", self.curline())
+                return SYMVALUNK
+            return accumulator % arg
+        elif op == ">":
+            return accumulator >> arg
+        elif op == "<":
+            return accumulator << arg
+        elif op == "|": # Bitwise OR
+            return accumulator | arg
+        elif op == "&":
+            return accumulator & arg
+        elif op == "^":
+            return accumulator ^ arg
+        elif op == "":
+            return arg
+
+        self.pmsg(ERROR, f"Unknown operator '{op}'", self.curline())
+        return SYMVALUNK
+
+    # Returns a step of an expression that applies an operator to the accumulator and a number.
+    # Symbols are looked up a second time after they have been checked, as parsenum() reports
+    # unknown symbols each time
+    def opstep(self, op, current_str):
+        num = self.compilenum(current_str)
+        if num.dynamic:
+            def step(accumulator):
+                if num() == SYMVALUNK:
+                    return SYMVALUNK
+                return self.applyop(op, accumulator, num())
+        else:
+            def step(accumulator):
+                arg = num()
+                if arg == SYMVALUNK:
+                    return SYMVALUNK
+                return self.applyop(op, accumulator, arg)
+        return step
+
+    # Returns a step of an expression that applies an operator to the accumulator and the
+    # value of a sub-expression
+    def substep(self, op, sub):
+        def step(accumulator):
+            arg = self.tonum(sub())
+            if arg == SYMVALUNK:
+                return SYMVALUNK
+            return self.applyop(op, accumulator, arg)
+        return step
+
+    # Returns a step of an expression that reports an error
+    def errorstep(self, msg):
+        fail = self.experror(msg)
+        def step(accumulator):
+            return fail()
+        return step
+
+    # Parses a normal expression. Expression ends on a non symbol, ',', or ')' character
+    def parseexp(self, string, starts_with_paren=False):
+        return self.evalexp(self.compileexp(string, starts_with_paren))
+
+    # Evaluates a compiled expression, recording the symbols it reads if the line is being traced
+    def evalexp(self, exp):
+        if self.line_trace is None:
+            return exp()
+
+        for sym in exp.syms:
+            if sym not in self.line_trace.reads and sym != INTERNAL_PC_SYM:   # The PC is checked by LineTrace itself
+                self.line_trace.reads.add(sym)
+                self.symbol_table.watch(sym, self.line_trace)
+        val = exp()
+        if val == SYMVALUNK:    # Unresolved values are handled differently on the first pass
+            self.keepdirty()
+        return val
+
+    # Returns a function that evaluates an expression against the current symbol table.
+    # Expressions are compiled once and the result is reused on every pass
+    def compileexp(self, string, starts_with_paren=False):
+        if self.exp_precedence:
+            return self.compileprattexp(string)
+
+        key = (string, starts_with_paren)
+        exp = self.exp_cache.get(key)
+        if exp is None:
+            exp = self.buildexp(string.strip(), starts_with_paren)
+            self.exp_cache[key] = exp
+        return exp
+
+    def buildexp(self, string, starts_with_paren):
+        sym = string
+        steps = []
+        syms = [sym]
+
+        string += "\n"
+
+        next_op = ""
+        current_str = ""
+        num_parens = 0
 
-    if op == "+":
-        return accumulator + parsenum(current_str)
-    elif op == "-":
-        return accumulator - parsenum(current_str)
-    elif op == "*":
-        return accumulator * parsenum(current_str)
-    elif op == "/":
-        return int(accumulator / parsenum(current_str))
-    elif op == "%":
-        return accumulator % parsenum(current_str)
-    elif op == ">>":
-        return accumulator >> parsenum(current_str)
-    elif op == "<<":
-        return accumulator << parsenum(current_str)
-    elif op == "|": # Bitwise OR
-        return accumulator | parsenum(current_str)
-    elif op == "&":
-        return accumulator & parsenum(current_str)
-    elif op == "^":
-        return accumulator ^ parsenum(current_str)
-    elif op == "":
-        return parsenum(current_str)
-
-    pmsg(ERROR, f"Unknown operator '{op}'", file_contents[line_num-1])
-
-
-# Returns true if a character is an operation in a string
-# def containsop(string, op):
-#     if op in ("+", "-", "*", "/", "<<", ">>"):
-#         return op in string
-#     elif op == "%":
-#         pass
-
+        i = 0
+        while i < len(string):
+            character = string[i]
+            if character != "\n" and character.strip() == "" and not (i > 0 and string[i-1] in ("'", '"')):
+                i += 1
+                continue
 
-# Parses a normal expression. Expression ends on a non symbol, ',', or ')' character
-def parseexp(string, starts_with_paren=False):
-    global needs_another_pass
-    global line_num
-    global pass_num
+            # Check for end of expression
+            if i == len(string) - 1:
+                if current_str != "":
+                    steps.append(self.opstep(next_op, current_str))
+                    syms += self.compilenum(current_str).syms
+                if num_parens != 0:
+                    steps.append(self.errorstep(f"Unexpected end of expression"))
+                break
 
-    string = string.strip()
+            # Perform operations on numbers
+            if (character in MATH_OPS or (character in MATH_ALT_OPS and i < len(string)-1 and string[i+1].strip() == "") \
+                or (character in (">", "<") and i < len(string)-1 and string[i+1] in (">", "<"))) \
+                and not (i > 0 and string[i-1] in ("'", '"')):
+
+                if current_str != "":
+                    steps.append(self.opstep(next_op, current_str))
+                    syms += self.compilenum(current_str).syms
+                next_op = character
+                current_str = ""
+                if character in (">", "<"):
+                    i += 1
 
-    # print(f"parseexp(): '{string}'")
+            elif character == "(" and not (i == 0 and starts_with_paren):
 
-    accumulator = getsym(string, True)
-    if (accumulator != SYMVALUNK or issym(string)):
-        return accumulator
+                # Allow '~' as an escape character to prevent indirect addressing mode assumption due to macro expansion
+                if not (current_str.strip() == "" or current_str == '~'):
+                    steps.append(self.errorstep(f"Unexpected expression '{current_str}'"))
+                    break
 
-    string += "\n"
+                current_str = ""
+                bcnt = 0
+                isave = i
+                while i < len(string) and not (string[i] == ")" and bcnt == 1):
+                    if string[i] == "(":
+                        bcnt += 1
+                    elif string[i] == ")":
+                        bcnt -= 1
+                    i += 1
 
-    accumulator = 0
-    next_op = ""
-    current_str = ""
-    num_parens = 0
-    # op_shift = False
+                subxpr = string[isave:i+1]
+                sub = self.compileexp(subxpr, True)
+                steps.append(self.substep(next_op, sub))
+                syms += sub.syms
+                if i == len(string):
+                    steps.append(self.errorstep(f"Expression missing terminating character '{string}'"))
+                    break
+            elif character == "(":
+                num_parens += 1
+            elif character == ")":
+                num_parens -= 1
+            elif character == "{":
+                subxpr = string[i+1:]
+                sub = self.compilepostfix(subxpr)
+                steps.append(self.substep(next_op, sub))
+                syms += sub.syms
+                current_str = ""
+                bcnt = 0
+                while i < len(string) and not (string[i] == "}" and bcnt == 1):
+                    if string[i] == "{":
+                        bcnt += 1
+                    elif string[i] == "}":
+                        bcnt -= 1
+                    i += 1
+                if i == len(string):
+                    steps.append(self.errorstep(f"Expression missing terminating character '{string}'"))
+                    break
+            else:
+                current_str += character
 
-    i = 0
-    while i < len(string):
-        character = string[i]
-        if character != "\n" and character.strip() == "" and not (i > 0 and string[i-1] in ("'", '"')):
             i += 1
-            continue
-
-        # op_shift = False
-        # if i < len(string)-1 and ((character == "<" and string[i+1] == "<") or (character == ">" and string[i+1] == ">")):
-        #     op_shift = True
-        #     i += 1
-
-        # Check for end of expression
-        if i == len(string) - 1:
-            accumulator = performop(next_op, current_str, accumulator)
-            if accumulator == SYMVALUNK:
-                return SYMVALUNK
-            if character == ")":
-                num_parens -= 1
-            if num_parens != 0:
-                pmsg(
-                    ERROR, f"Unexpected end of expression", file_contents[line_num-1])
-            # print(f"STR: '{string}'\n\tFINAL VALUE: ${accumulator&0xffffffff:08X}")
+        else:
+            steps.append(self.errorstep(f"Unexpected end of expression"))
+
+        def exp():
+            # The whole expression may be a symbol
+            symbol = self.symbol_table.get(sym)
+            if symbol is not None:
+                return symbol.val
+
+            accumulator = 0
+            for step in steps:
+                accumulator = step(accumulator)
+                if accumulator == SYMVALUNK:
+                    return SYMVALUNK
             return accumulator
-
-        # Perform operations on numbers
-        if (character in MATH_OPS or (character in MATH_ALT_OPS and i < len(string)-1 and string[i+1].strip() == "") \
-            or (character in (">", "<") and i < len(string)-1 and string[i+1] in (">", "<"))) \
-            and not (i > 0 and string[i-1] in ("'", '"')):
-
-            accumulator = performop(next_op, current_str, accumulator)
-            if accumulator == SYMVALUNK:
+        exp.syms = tuple(dict.fromkeys(syms))
+        return exp
+
+    # Returns a function that evaluates an expression with standard operator precedence (--precedence).
+    # Parts of the expression that only contain literals are calculated when it is compiled
+    def compileprattexp(self, string):
+        exp = self.pratt_cache.get(string)
+        if exp is None:
+            try:
+                exp = PrattParser(self, string.strip()).parseall()
+            except ExpressionError as e:
+                exp = self.experror(str(e))
+            self.pratt_cache[string] = exp
+        return exp
+
+    # Applies a binary operator in --precedence mode
+    def prattop(self, op, a, b):
+        if op == "+":
+            return a + b
+        elif op == "-":
+            return a - b
+        elif op == "*":
+            return a * b
+        elif op == "/":
+            if b == 0:
+                self.pmsg(ERROR, f"Division by zero", self.curline())
                 return SYMVALUNK
-            next_op = character
-            current_str = ""
-            if character in (">", "<"):
-                i += 1
-
-        elif character == "(" and not (i == 0 and starts_with_paren):
-
-            # Allow '~' as an escape character to prevent indirect addressing mode assumption due to macro expansion
-            if not (current_str.strip() == "" or current_str == '~'):
-                pmsg(ERROR, f"Unexpected expression '{current_str}'", file_contents[line_num-1])
-
-            current_str = ""
-            bcnt = 0
-            isave = i
-            while i < len(string) and not (string[i] == ")" and bcnt == 1):
-                if string[i] == "(":
-                    bcnt += 1
-                elif string[i] == ")":
-                    bcnt -= 1
-                i += 1
-
-            subxpr = string[isave:i+1]
-            next_val = parseexp(subxpr, True)
-            accumulator = performop(next_op, str(next_val), accumulator)
-
-            if accumulator == SYMVALUNK:
+            return int(a / b)
+        elif op == "%":
+            if b == 0:
+                self.pmsg(ERROR, f"Division by zero", self.curline())
                 return SYMVALUNK
-            if i == len(string):
-                pmsg(ERROR, f"Expression missing terminating character '{string}'", file_contents[line_num-1])
-        elif character == "(":
-            num_parens += 1
-        elif character == ")":
-            num_parens -= 1
-        elif character == "{":
-            subxpr = string[i+1:]
-            next_val = parsepostfixnum(subxpr)
-            accumulator = performop(next_op, str(next_val), accumulator)
-            if accumulator == SYMVALUNK:
+            return a % b
+        elif op in ("<<", ">>"):
+            if b < 0:
+                self.pmsg(ERROR, f"Negative shift count", self.curline())
+                return SYMVALUNK
+            return a << b if op == "<<" else a >> b
+        elif op == "|":
+            return a | b
+        elif op == "&":
+            return a & b
+        elif op == "^":
+            return a ^ b
+
+    def binaryexp(self, op, left, right):
+        if left.const and right.const:
+            a = left()
+            b = right()
+            if a == SYMVALUNK or b == SYMVALUNK:
+                return constexp(SYMVALUNK)
+            if not ((op in ("/", "%") and b == 0) or (op in ("<<", ">>") and b < 0)):  # Leave errors for evaluation
+                return constexp(self.prattop(op, a, b))
+
+        def exp():
+            a = left()
+            if a == SYMVALUNK:
+                return SYMVALUNK
+            b = right()
+            if b == SYMVALUNK:
+                return SYMVALUNK
+            return self.prattop(op, a, b)
+        exp.const = False
+        exp.syms = tuple(dict.fromkeys(left.syms + right.syms))
+        return exp
+
+    def symexp(self, sym):
+        def exp():
+            return self.getsym(sym)
+        exp.const = False
+        exp.syms = (sym,)
+        return exp
+
+    def postfixexp(self, sub):
+        def exp():
+            return self.tonum(sub())
+        exp.const = False
+        exp.syms = sub.syms
+        return exp
+
+    # Returns the result of a prefix-notation expression. String must be terminated with "}"
+    def parsepostfixnum(self, string):
+        return self.compilepostfix(string)()
+
+    # Returns a function that evaluates a postfix expression in the same way as parsepostfixnum()
+    def compilepostfix(self, string):
+        exp = self.postfix_cache.get(string)
+        if exp is None:
+            exp = self.buildpostfix(string)
+            self.postfix_cache[string] = exp
+        return exp
+
+    def postfixnum(self, sub):
+        def run(args):
+            arg = sub()
+
+            # Still waiting for symbol value to be resolved, go for another pass
+            if arg == SYMVALUNK:
+                self.needs_another_pass = True
                 return SYMVALUNK
-            current_str = ""
-            bcnt = 0
-            while i < len(string) and not (string[i] == "}" and bcnt == 1):
-                if string[i] == "{":
-                    bcnt += 1
-                elif string[i] == "}":
-                    bcnt -= 1
-                i += 1
-            if i == len(string):
-                pmsg(ERROR, f"Expression missing terminating character '{string}'", file_contents[line_num-1])
-        else:
-            current_str += character
-
-        i += 1
-
-    pmsg(ERROR, f"Unexpected end of expression", file_contents[line_num-1])
 
+            args.append(arg)
+        return run
 
-# Returns the result of a prefix-notation expression. String must be terminated with "}"
-def parsepostfixnum(string):
-    global needs_another_pass
-    global line_num
+    def postfixend(self, args):
+        val = args.pop()
+        if len(args) != 0:
+            self.pmsg(ERROR, f"Extra symbols in expression", self.curline())
+        return val
 
-    # print("POSTFIX: ", string)
-    string = string.strip()
+    def postfixerror(self, msg):
+        fail = self.experror(msg)
+        def run(args):
+            return fail()
+        return run
 
-    args = []
+    def buildpostfix(self, string):
+        string = string.strip()
+        ops = []
+        syms = []
 
-    try:
-        # Go through elements
-        #for num in str.split(" ")
         nums = string.split(" ")
         i = 0
         while i < len(nums):
@@ -507,43 +1149,11 @@ def parsepostfixnum(string):
 
             # Check for end of expression
             if num == "}":
-                val = args.pop()
-                if len(args) != 0:
-                    pmsg(ERROR, f"Extra symbols in expression", file_contents[line_num-1])
-                return val
-
-            # Perform operations on numbers
+                ops.append(self.postfixend)
+                break
 
-            if num == "+":
-                args.append(args.pop() + args.pop())
-            elif num == "-":
-                num1 = args.pop()
-                num2 = args.pop()
-                args.append(num2 - num1)
-            elif num == "*":
-                args.append(args.pop() * args.pop())
-            elif num == "/":
-                num1 = args.pop()
-                num2 = args.pop()
-                args.append(num2 / num1)
-            elif num == "%":
-                num1 = args.pop()
-                num2 = args.pop()
-                args.append(num2 % num1)
-            elif num == ">>":
-                num1 = args.pop()
-                num2 = args.pop()
-                args.append(num2 >> num1)
-            elif num == "<<":
-                num1 = args.pop()
-                num2 = args.pop()
-                args.append(num2 << num1)
-            elif num == "|":
-                args.append(args.pop() | args.pop())
-            elif num == "&":
-                args.append(args.pop() & args.pop())
-            elif num == "^":
-                args.append(args.pop() ^ args.pop())
+            if num in ("+", "-", "*", "/", "%", ">>", "<<", "|", "&", "^"):
+                ops.append(postfixop(num))
             elif "(" in num:
                 bcnt = 0
                 isave = i
@@ -554,16 +1164,18 @@ def parsepostfixnum(string):
                         bcnt -= 1
                     i += 1
                 subxpr = " ".join(nums[isave:i+1])
-                # print("SUBXPE: ", subxpr)
-                arg = parseexp(subxpr, True)
-                args.append(arg)
+                sub = self.compileexp(subxpr, True)
+                ops.append(postfixpush(sub))
+                syms += sub.syms
 
                 if i == len(nums):
-                    pmsg(ERROR, f"Expression missing terminating character '{string}'", file_contents[line_num-1])
+                    ops.append(self.postfixerror(f"Expression missing terminating character '{string}'"))
+                    break
             elif "{" in num:
                 subxpr = " ".join(nums[i+1:])
-                arg = parsepostfixnum(subxpr)
-                args.append(arg)
+                sub = self.compilepostfix(subxpr)
+                ops.append(postfixpush(sub))
+                syms += sub.syms
                 bcnt = 0
                 while i < len(nums) and not ("}" in nums[i] and bcnt == 1):
                     if "{" in nums[i]:
@@ -572,400 +1184,726 @@ def parsepostfixnum(string):
                         bcnt -= 1
                     i += 1
                 if i == len(nums):
-                    pmsg(ERROR, f"Expression missing terminating character '{string}'", file_contents[line_num-1])
+                    ops.append(self.postfixerror(f"Expression missing terminating character '{string}'"))
+                    break
             elif num in ("'", '"'):
-                arg = ord(' '[0])
-                args.append(arg)
+                ops.append(postfixpush(lambda: ord(' '[0])))
                 i += 1
             else:
-                arg = parseexp(num)
-                # print(f"arg: {arg} | num: {num}") # DEBUG
-
-                # Still waiting for symbol value to be resolved, go for another pass
-                if arg == SYMVALUNK:
-                    needs_another_pass = True
-                    return SYMVALUNK
-
-                args.append(arg)
+                sub = self.compileexp(num)
+                ops.append(self.postfixnum(sub))
+                syms += sub.syms
 
             i += 1
 
-    except IndexError:
-        pmsg(ERROR, f"Missing value or extra operation", file_contents[line_num-1])
-
-    pmsg(ERROR, f"Unexpected end of expression", file_contents[line_num-1])
-
-
-# Parses arguments to an instruction
-def parseargs(i, line, sym):
-    # print(f"ARGS: {line[i:]}")
-
-    global al
-    global xl
-    global line_num
-    global pc
-
-    operand = line[i:].strip()
-    instruction = Instructions.INSTRUCTIONS[sym.upper()]
-
-    # Implied
-    if len(operand) == 0:
-
-        if instruction.impd == -1:
-            checkreturnaddrmode(-1)  # Error and exit
-
-        return [ instruction.impd ]
-
-    # Immediate addressing
-    if operand[0] == "#":
-
-        if instruction.immd == -1:
-            checkreturnaddrmode(-1)  # Error and exit
-
-        val = parseexp(operand[1:])
-
-        returnbytes = [ instruction.immd, val & 0xff ]
-
-        # Check if value is 8 or 16 bit
-        if (instruction.reg == "A" and al) or (instruction.reg == "X" and xl):
-            returnbytes.append((val >> 8) & 0xff)
-            if ((val < 0 or val > 0xffff) and
-                    not (pass_num == 1 and val == SYMVALUNK) and
-                    not (ignore_warn_msg and pass_num == 1)):
-                pmsg(WARN, f"Value is outside range [0..0xffff] with 16 bit reg", file_contents[line_num-1])
-        elif val > 0xff or val < 0:
-            if not (pass_num == 1 and val == SYMVALUNK) and not (ignore_warn_msg and pass_num == 1):
-                pmsg(WARN, f"Value is outside range [0..0xff] with 8 bit reg", file_contents[line_num-1])
+        def exp():
+            args = []
+            try:
+                for op in ops:
+                    val = op(args)
+                    if val is not None:
+                        return val
+            except IndexError:
+                self.pmsg(ERROR, f"Missing value or extra operation", self.curline())
+                return SYMVALUNK
 
-        return returnbytes
+            self.pmsg(ERROR, f"Unexpected end of expression", self.curline())
+            return SYMVALUNK
+        exp.syms = tuple(dict.fromkeys(syms))
+        return exp
+
+    # Decodes an instruction's operand into its addressing mode and operand expressions
+    def decodeinstruction(self, sym, operand):
+        stmt = Statement(STMT_INSTRUCTION, sym)
+        instruction = Instructions.INSTRUCTIONS[sym.upper()]
+        stmt.instruction = instruction
+
+        # Implied
+        if len(operand) == 0:
+            if instruction.impd != -1:
+                stmt.mode = MODE_IMPLIED
+            return stmt
+
+        # Immediate addressing
+        if operand[0] == "#":
+            if instruction.immd != -1:
+                stmt.mode = MODE_IMMEDIATE
+                stmt.exps = (self.compileexp(operand[1:]),)
+            return stmt
+
+        # Indirect
+        if operand[0] == "(":
+            match = re.search(",\W*(x|X)\W*\)$", operand)
+            if match:
+                return self.decodeaddress(stmt, operand[1:match.span()[0]], instruction.idrctx, instruction.iabsx, -1)
+            match = re.search(",\W*(s|S)\W*\)\W*,\W*(y|Y)$", operand)
+            if match:
+                return self.decodeaddress(stmt, operand[1:match.span()[0]], instruction.istacksy, -1, -1)
+            match = re.search("\)\W*,\W*(y|Y)$", operand)
+            if match:
+                return self.decodeaddress(stmt, operand[1:match.span()[0]], instruction.idrcty, -1, -1)
+            if re.search("\)$", operand):
+                return self.decodeaddress(stmt, operand[1:-1], instruction.idrct, instruction.iabs, -1)
+
+            stmt.warn = True
+
+        # Indirect long
+        if operand[0] == "[":
+
+            match = re.search("]\W*,\W*(y|Y)$", operand)
+            if match:
+                return self.decodeaddress(stmt, operand[1:match.span()[0]], instruction.ildrcty, -1, -1)
+            elif re.search("]$", operand):
+                return self.decodeaddress(stmt, operand[1:-1], instruction.ildrct, instruction.ilabs, -1)
+            else:
+                return stmt
 
-    # Indirect
-    if operand[0] == "(":
-        match = re.search(",\W*(x|X)\W*\)$", operand)
+        # Y-indexed
+        match = re.search(",\W*(y|Y)$", operand)
         if match:
-            return getopcodebytes(operand[1:match.span()[0]], instruction.idrctx, instruction.iabsx, -1)
-        match = re.search(",\W*(s|S)\W*\)\W*,\W*(y|Y)$", operand)
-        if match:
-            return getopcodebytes(operand[1:match.span()[0]], instruction.istacksy, -1, -1)
-        match = re.search("\)\W*,\W*(y|Y)$", operand)
-        if match:
-            return getopcodebytes(operand[1:match.span()[0]], instruction.idrcty, -1, -1)
-        if re.search("\)$", operand):
-            return getopcodebytes(operand[1:-1], instruction.idrct, instruction.iabs, -1)
-
-        #checkreturnaddrmode(-1)  # Error and exit
-        if not (ignore_warn_msg and pass_num == 1):
-            pmsg(WARN, f"Potentially invalid addressing mode specified", file_contents[line_num-1])
-
-
-    # Indirect long
-    if operand[0] == "[":
+            return self.decodeaddress(stmt, operand[:match.span()[0]], instruction.drcty, instruction.absy, -1)
 
-        match = re.search("]\W*,\W*(y|Y)$", operand)
+        # X-indexed
+        match = re.search(",\W*(x|X)$", operand)
         if match:
-            return getopcodebytes(operand[1:match.span()[0]], instruction.ildrcty, -1, -1)
-        elif re.search("]$", operand):
-            return getopcodebytes(operand[1:-1], instruction.ildrct, instruction.ilabs, -1)
-        else:
-            checkreturnaddrmode(-1)  # Error and exit
-
-    # Y-indexed
-    match = re.search(",\W*(y|Y)$", operand)
-    if match:
-        return getopcodebytes(operand[:match.span()[0]], instruction.drcty, instruction.absy, -1)
-
-    # X-indexed
-    match = re.search(",\W*(x|X)$", operand)
-    if match:
-        return getopcodebytes(operand[:match.span()[0]], instruction.drctx, instruction.absx, instruction.longx)
-
-    # Stack addressing
-    match = re.search(",\W*(s|S)$", operand)
-    if match:
-        return getopcodebytes(operand[:match.span()[0]], instruction.stacks, -1, -1)
-
-    # Relative addressing
-    if instruction.rel8 != -1:
-        to_addr = parseexp(operand)
-        if to_addr == SYMVALUNK:
-            to_addr = pc+2
-        return [ instruction.rel8, calcrel8(pc+2, to_addr) ]
-
-    # Relative long
-    if instruction.rel16 != -1:
-        to_addr = parseexp(operand)
-        if to_addr == SYMVALUNK:
-            to_addr = pc+3
-        to_addr = calcrel16(pc+3, to_addr)
-        return [ instruction.rel16, to_addr & 0xff, (to_addr >> 8) & 0xff ]
-
-    # Block move
-    match = re.search(",", operand)
-    if match:
-        src_bank = parseexp(operand[:match.span()[0]])
-        des_bank = parseexp(operand[match.span()[1]:])
-        return [instruction.srcdes, des_bank, src_bank ]
-
-    # Operand must be an address:
-    return getopcodebytes(operand, instruction.drct, instruction.absu, instruction.lng)
-
-
-# Escapes a string
-def escapestr(string):
-    return string.replace("\\r", "\r") \
-                .replace("\\0", chr(0)) \
-                .replace("\\n", "\n") \
-                .replace("\\t", "\t") \
-                .replace("^G", chr(7)) \
-                .replace("^H", chr(8)) \
-                .replace("^I", chr(9)) \
-                .replace("^J", chr(0xA)) \
-                .replace("^L", chr(0xC)) \
-                .replace("^M", chr(0xD)) \
-                .replace("^[", chr(0x1B)) \
-                .replace("ESC[", chr(0x1B)) \
-                .replace("\\x1b", chr(0x1B))
+            return self.decodeaddress(stmt, operand[:match.span()[0]], instruction.drctx, instruction.absx, instruction.longx)
 
+        # Stack addressing
+        match = re.search(",\W*(s|S)$", operand)
+        if match:
+            return self.decodeaddress(stmt, operand[:match.span()[0]], instruction.stacks, -1, -1)
+
+        # Relative addressing
+        if instruction.rel8 != -1:
+            stmt.mode = MODE_REL8
+            stmt.exps = (self.compileexp(operand),)
+            return stmt
+
+        # Relative long
+        if instruction.rel16 != -1:
+            stmt.mode = MODE_REL16
+            stmt.exps = (self.compileexp(operand),)
+            return stmt
+
+        # Block move
+        match = re.search(",", operand)
+        if match:
+            stmt.mode = MODE_BLOCK
+            stmt.exps = (self.compileexp(operand[:match.span()[0]]), self.compileexp(operand[match.span()[1]:]))
+            return stmt
+
+        # Operand must be an address:
+        return self.decodeaddress(stmt, operand, instruction.drct, instruction.absu, instruction.lng)
+
+    # Sets up a direct/absolute/long operand, the addressing mode may be forced with a prefix
+    def decodeaddress(self, stmt, operand, instruction_d, instruction_a, instruction_l):
+        mo = 0
+        if operand[0] == "<":
+            mo = 1
+            stmt.force = 1
+        elif operand[0] in ["!"]:#, "|"]: # Not using '|' since it is used for bitwise OR
+            mo = 1
+            stmt.force = 2
+        elif operand[0] == ">":
+            mo = 1
+            stmt.force = 3
+
+        stmt.mode = MODE_ADDRESS
+        stmt.opcodes = (instruction_d, instruction_a, instruction_l)
+        stmt.exps = (self.compileexp(operand[mo:]),)
+        return stmt
+
+    # Returns the bytes of a decoded instruction
+    def getinstructionbytes(self, stmt):
+        instruction = stmt.instruction
+
+        if stmt.warn and not self.hidemsg(self.ignore_warn_msg):
+            self.pmsg(WARN, f"Potentially invalid addressing mode specified", self.curline())
+
+        if stmt.mode == MODE_ADDRESS:
+            return self.getopcodebytes(stmt.exps[0], stmt.force, *stmt.opcodes)
+
+        # Implied
+        if stmt.mode == MODE_IMPLIED:
+            return [ instruction.impd ]
+
+        # Immediate addressing
+        if stmt.mode == MODE_IMMEDIATE:
+            val = self.evalexp(stmt.exps[0])
+
+            returnbytes = [ instruction.immd, val & 0xff ]
+
+            # Check if value is 8 or 16 bit
+            if (instruction.reg == "A" and self.al) or (instruction.reg == "X" and self.xl):
+                returnbytes.append((val >> 8) & 0xff)
+                if ((val < 0 or val > 0xffff) and
+                        not (self.pass_num == 1 and val == SYMVALUNK) and
+                        not self.hidemsg(self.ignore_warn_msg)):
+                    self.pmsg(WARN, f"Value is outside range [0..0xffff] with 16 bit reg", self.curline())
+            elif val > 0xff or val < 0:
+                if not (self.pass_num == 1 and val == SYMVALUNK) and not self.hidemsg(self.ignore_warn_msg):
+                    self.pmsg(WARN, f"Value is outside range [0..0xff] with 8 bit reg", self.curline())
+
+            return returnbytes
+
+        # Relative addressing
+        if stmt.mode == MODE_REL8:
+            to_addr = self.evalexp(stmt.exps[0])
+            if to_addr == SYMVALUNK:
+                to_addr = self.pc+2
+            return [ instruction.rel8, self.calcrel8(self.pc+2, to_addr) ]
+
+        # Relative long
+        if stmt.mode == MODE_REL16:
+            to_addr = self.evalexp(stmt.exps[0])
+            if to_addr == SYMVALUNK:
+                to_addr = self.pc+3
+            to_addr = self.calcrel16(self.pc+3, to_addr)
+            return [ instruction.rel16, to_addr & 0xff, (to_addr >> 8) & 0xff ]
+
+        # Block move
+        if stmt.mode == MODE_BLOCK:
+            src_bank = self.evalexp(stmt.exps[0])
+            des_bank = self.evalexp(stmt.exps[1])
+            return [instruction.srcdes, des_bank, src_bank ]
+
+        self.checkreturnaddrmode(-1)  # Error and exit
+
+    # Decodes a line into the statements that are run on each pass
+    def decodeline(self, line):
+        statements = []
+
+        line = line.strip()
+        if (line == ""):
+            return statements
+
+        sym = ""
+        prev_sym = ""
+        line_content = False
 
-# Parses a string and returns a list of comma-separated elements
-def parsecsv(str):
+        i = 0
+        while i <= len(line):
+            if i < len(line):
+                c = line[i]
+            else:
+                c = ""
+
+            if c.isalnum() or c in ('_', '.'):
+                sym += c
+            elif len(sym) > 0:
+                line_content = True # The line contains interesting content
+                directive = self.finddirective(sym)
+
+                # It is the ORG directive, it is checked before instructions and labels
+                if directive is self.directives["org"]:
+                    statements.append(self.decodeorg(prev_sym, line, i))
+                    i = len(line)   # Done with line
+
+                # Check for instructions
+                elif sym.upper() in Instructions.INSTRUCTIONS:
+                    statements.append(self.decodeinstruction(sym, line[i:].strip()))
+                    i = len(line)   # Done with line
+
+                # Ignore comments
+                elif sym[0] == ";":
+                    i = len(line)   # Done with line
+
+                # If it's a label, append it to the table
+                elif c == ":":
+                    statements.append(Statement(STMT_LABEL, sym))
+
+                elif directive is not None:
+                    decoder, ends_line = directive
+                    stmt = decoder(self, prev_sym, line, i)
+                    if stmt is not None:
+                        statements.append(stmt)
+                    if ends_line:
+                        i = len(line)   # Done with line
+
+                # Unknown
+                else:
+                    if prev_sym != "":
+                        statements.append(Statement(STMT_ERROR, text=f"Unknown symbol '{prev_sym}'"))
+                        return statements
+                    prev_sym = sym
 
-    i = 0
-    s = 0
-    iq = False
-    vals = []
+                    line_content = False
 
-    while i < len(str):
-        if (str[i] == "," and not iq) or i == len(str)-1:
-            if i == len(str)-1:
-                i += 1
-            if str[s:i].strip() != "":
-                vals.append(escapestr(str[s:i].strip()))
-                s = i + 1
+                sym = ""
 
-        elif str[i] == "\"":
-            iq = not iq
-        elif str[i] == "\\" and len(str) > i+1 and str[i+1] == "\"":
             i += 1
-        i += 1
-
-    return vals
-
-
-# Parses a single line
-def parseline(line):
-    global pc
-    global rom_size
-    global rom_offset
-    global re_symbol_table
-    global line_num
-    global pass_num
-    global needs_another_pass
-    global al
-    global xl
-    global build_num
-
-    line = line.strip()
-    if (line == ""):
-        return
 
-    sym = ""
-    prev_sym = ""
-    line_content = False
-
-    i = 0
-    while i <= len(line):
-        if i < len(line):
-            c = line[i]
-        else:
-            c = ""
-
-        # print(f"Char: {c}\tSymbol: {sym}")
-        if c.isalnum() or c in ('_', '.'):
-            sym += c
-        elif len(sym) > 0:
-            line_content = True # The line contains interesting content
-
-            # It is the ORG directive, change the PC
-            if re.search(r"^.?org$", sym, flags=re.IGNORECASE):
-                tpc = parseexp(line[i+1:])
-                if pc == -1:    # On first ORG statement, set ROM offset
-                    rom_offset = tpc
-                elif tpc > rom_offset + rom_size or tpc < rom_offset:
-                    pmsg(ERROR, f"ORG directive outside of ROM area", file_contents[line_num-1])
-                pc = tpc        # Update PC location
-                i = len(line)   # Done with line
-
-            # Check for instructions
-            elif sym.upper() in Instructions.INSTRUCTIONS:
-
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-
-                # print("YES, found instruction")  # DEBUG
-                file_contents[line_num-1].rawbytes = []
-                for byte in parseargs(i, line, sym):
-                    writerom8(pc, byte)
-                    file_contents[line_num-1].rawbytes.append(byte)
-                    pc += 1
-
-                i = len(line)   # Done with line
-
-            # Ignore comments
-            elif sym[0] == ";":
-                i = len(line)   # Done with line
-
-            # If it's a label, append it to the table
-            elif c == ":":
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-                    
-                addsym(sym, pc, pc, pc)
-                # print(f"Found Label: {sym} = ${pc:04X}")  # DEBUG
-
-            # DataByte directive
-            elif re.search(r"^.?byte?$", sym, flags=re.IGNORECASE):
-
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-                    
-                # Allow comma-delimited values
-                nums = parsecsv(line[i+1:])
-
-                # Go over all values on line
-                for num in nums:
-                    num = num.strip()
-
-                    # Here's a string literal
-                    if num[0] == "\"":
-
-                        for s in bytes(num[1:-1], "utf_8").decode("unicode_escape"):    # Only works with values [0..127]
-                            val = ord(s)
-                            writerom8(pc, val)
-                            file_contents[line_num-1].rawbytes.append(val)
-                            pc += 1
-
-                    # Here's a direct number
-                    else:
-                        val = parseexp(num)
-                        if pass_num == 1 and val == SYMVALUNK:  # Suppress warning about SYMVALUNK being > 0xff
-                            val = SYMVALUNK & 0xff
-                        writerom8(pc, val)
-                        file_contents[line_num-1].rawbytes .append(val)
-                        pc += 1
-
-                i = len(line)   # Done with line
-
-            # DataWord directive
-            elif re.search(r"^.?word$", sym, flags=re.IGNORECASE):
-
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-                    
-                # Allow comma-delimited values
-                nums = parsecsv(line[i+1:])
-
-                # Go over all values on line
-                for num in nums:
-                    num = num.strip()
-
-                    # Here's a string literal
-                    if num[0] == "\"":
-
-                        # Only works with values [0..127]?
-                        for s in bytes(num[1:-1], "utf_16").decode("unicode_escape"):
-                            val = ord(s)
-                            writerom16(pc, val)
-                            file_contents[line_num-1].rawbytes.append(val & 0xff)
-                            file_contents[line_num-1].rawbytes.append((val >> 8) & 0xff)
-                            pc += 2
-
-                    # Here's a direct number
-                    else:
-                        val = parseexp(num)
-                        if pass_num == 1 and val == SYMVALUNK: # Suppress warning about SYMVALUNK being > 0xffff
-                            val = SYMVALUNK & 0xffff
-                        writerom16(pc, val)
-                        file_contents[line_num-1].rawbytes.append(val & 0xff)
-                        file_contents[line_num-1].rawbytes.append((val >> 8) & 0xff)
-                        pc += 2
-
-                i = len(line)   # Done with line
-
-            # Date directive
-            elif re.search(r"^.?date$", sym, flags=re.IGNORECASE):
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-                    
-                for b in bytes(datetime.now().isoformat(timespec='minutes'), "utf_8").decode("unicode_escape"):
-                    val = ord(b)
-                    writerom8(pc, val)
-                    file_contents[line_num-1].rawbytes.append(val & 0xff)
-                    pc += 1
-
-            #BuildNum directive
-            elif re.search(r"^.?build$", sym, flags=re.IGNORECASE):
-                # Make sure that an origin has been set
-                if pc == -1:
-                    pmsg(ERROR, "Missing ORG directive", file_contents[line_num-1])
-                    
-                for b in bytes(f"{build_num:06}", "utf_8").decode("unicode_escape"):
-                    val = ord(b)
-                    writerom8(pc, val)
-                    file_contents[line_num-1].rawbytes.append(val & 0xff)
-                    pc += 1
-
-            # Equate
-            elif re.search(r"^.?equ$", sym, flags=re.IGNORECASE):
-                exp = line[i:]
-                val = parseexp(exp)
-                addsym(prev_sym, val, exp, pc)
-                i = len(line)   # Done with line
-
-            # ROM directive, ignored on pass != 1
-            elif re.search(r"^.?rom$", sym, flags=re.IGNORECASE):
-                i = len(line)   # Done with line
-
-            # Register width directives
-            elif re.search(r"^.?al$", sym, flags=re.IGNORECASE):
-                al = True
-                i = len(line)   # Done with line
-            elif re.search(r"^.?xl$", sym, flags=re.IGNORECASE):
-                xl = True
-                i = len(line)   # Done with line
-            elif re.search(r"^.?as$", sym, flags=re.IGNORECASE):
-                al = False
-                i = len(line)   # Done with line
-            elif re.search(r"^.?xs$", sym, flags=re.IGNORECASE):
-                xl = False
-                i = len(line)   # Done with line
-
-            # Unknown
+        if not line_content:
+            statements.append(Statement(STMT_ERROR, text=f"Unknown symbol '{prev_sym}'"))
+
+        return statements
+
+    # Returns the (decoder, ends line) entry of a directive, None if sym is not a directive.
+    # Directives may have any one character in front of their name, usually '.'
+    def finddirective(self, sym):
+        name = sym.lower()
+        if name in self.directives:
+            return self.directives[name]
+        return self.directives.get(name[1:])
+
+    # Directive decoders are passed the symbol in front of the directive, the line and the index
+    # of the character after the directive's name. They return the statement to run on each pass
+    def decodeorg(self, prev_sym, line, i):
+        return Statement(STMT_ORG, exps=(self.compileexp(line[i+1:]),))
+
+    def decodebyte(self, prev_sym, line, i):
+        return Statement(STMT_BYTE, args=self.decodedata(line[i+1:], "utf_8"))
+
+    def decodeword(self, prev_sym, line, i):
+        return Statement(STMT_WORD, args=self.decodedata(line[i+1:], "utf_16"))
+
+    def decodedate(self, prev_sym, line, i):
+        return Statement(STMT_DATE)
+
+    def decodebuild(self, prev_sym, line, i):
+        return Statement(STMT_BUILD)
+
+    def decodeequ(self, prev_sym, line, i):
+        return Statement(STMT_EQU, prev_sym, line[i:], (self.compileexp(line[i:]),))
+
+    # ROM directive, handled by the command line and ignored here
+    def decoderom(self, prev_sym, line, i):
+        return None
+
+    def decodeal(self, prev_sym, line, i):
+        return Statement(STMT_AL)
+
+    def decodexl(self, prev_sym, line, i):
+        return Statement(STMT_XL)
+
+    def decodeas(self, prev_sym, line, i):
+        return Statement(STMT_AS)
+
+    def decodexs(self, prev_sym, line, i):
+        return Statement(STMT_XS)
+
+    # Lowercase directive name, (decoder, True if the directive uses the rest of the line)
+    directives = {
+        "org": (decodeorg, True),
+        "byte": (decodebyte, True),
+        "byt": (decodebyte, True),
+        "word": (decodeword, True),
+        "date": (decodedate, False),
+        "build": (decodebuild, False),
+        "equ": (decodeequ, True),
+        "rom": (decoderom, True),
+        "al": (decodeal, True),
+        "xl": (decodexl, True),
+        "as": (decodeas, True),
+        "xs": (decodexs, True),
+    }
+
+    # Decodes the arguments of a .byte or .word directive. String literals are converted to
+    # character values, everything else is compiled as an expression
+    def decodedata(self, string, encoding):
+        args = []
+        for num in parsecsv(string):
+            num = num.strip()
+
+            # Here's a string literal
+            if num[0] == "\"":
+                # Only works with values [0..127]?
+                args.append([ord(s) for s in bytes(num[1:-1], encoding).decode("unicode_escape")])
+
+            # Here's a direct number
             else:
-                if prev_sym != "":
-                    pmsg(ERROR,f"Unknown symbol '{prev_sym}'", file_contents[line_num-1])
-                prev_sym = sym
-
-                line_content = False
-
-            sym = ""
-
-        elif c in [' ', '\t']:
-            # Whitespace resets symbol being parsed
-            sym = ""
+                args.append(self.compileexp(num))
+        return args
+
+    # Returns the decoded statements of a line. Lines with the same text share their statements
+    def getstatements(self, line):
+        if line.statements is None:
+            statements = self.stmt_cache.get(line.ppline)
+            if statements is None:
+                statements = self.decodeline(line.ppline)
+                self.stmt_cache[line.ppline] = statements
+            line.statements = statements
+        return line.statements
+
+    # Parses a single line
+    def parseline(self, line):
+        for stmt in self.getstatements(line):
+            self.stmt_handlers[stmt.kind](self, stmt)
+
+    # Make sure that an origin has been set
+    def checkorg(self):
+        if self.pc == -1:
+            self.pmsg(ERROR, "Missing ORG directive", self.curline())
+
+    def runerror(self, stmt):
+        self.pmsg(ERROR, stmt.text, self.curline())
+
+    # It is the ORG directive, change the PC
+    def runorg(self, stmt):
+        tpc = self.evalexp(stmt.exps[0])
+        if self.sparse_rom is not None:
+            # Every ORG starts a new segment anywhere in the address space
+            if tpc < 0 or tpc >= Rom.ADDR_SPACE:
+                self.pmsg(ERROR, f"ORG directive outside of 24-bit address space", self.curline())
+            self.sparse_rom.org(tpc)
+            self.keepdirty()     # Segments are found again on every pass
+            if self.pc == -1:
+                self.rom_offset = tpc
+        elif self.pc == -1:    # On first ORG statement, set ROM offset
+            self.rom_offset = tpc
+        elif tpc > self.rom_offset + self.rom_size or tpc < self.rom_offset:
+            self.pmsg(ERROR, f"ORG directive outside of ROM area", self.curline())
+        self.pc = tpc        # Update PC location
+
+    def runinstruction(self, stmt):
+        self.checkorg()
+        returnbytes = self.getinstructionbytes(stmt)
+        self.writerom(self.pc, returnbytes)
+        self.file_contents[self.line_num-1].rawbytes = returnbytes
+        self.pc += len(returnbytes)
+
+    # Labels are added to the symbol table
+    def runlabel(self, stmt):
+        self.checkorg()
+        self.addsym(stmt.name, self.pc, self.pc, self.pc)
+
+    # DataByte directive
+    def runbyte(self, stmt):
+        self.checkorg()
+        for arg in stmt.args:
+
+            # Here's a string literal
+            if isinstance(arg, list):
+                self.writerom(self.pc, arg)
+                self.file_contents[self.line_num-1].addbytes(arg)
+                self.pc += len(arg)
+
+            # Here's a direct number
+            else:
+                val = self.evalexp(arg)
+                if self.pass_num == 1 and val == SYMVALUNK:  # Suppress warning about SYMVALUNK being > 0xff
+                    val = SYMVALUNK & 0xff
+                self.writerom8(self.pc, val)
+                self.file_contents[self.line_num-1].addbytes((val,))
+                self.pc += 1
+
+    # DataWord directive
+    def runword(self, stmt):
+        self.checkorg()
+        for arg in stmt.args:
+
+            # Here's a string literal
+            if isinstance(arg, list):
+                for val in arg:
+                    self.writerom16(self.pc, val)
+                    self.file_contents[self.line_num-1].addbytes((val & 0xff, (val >> 8) & 0xff))
+                    self.pc += 2
+
+            # Here's a direct number
+            else:
+                val = self.evalexp(arg)
+                if self.pass_num == 1 and val == SYMVALUNK: # Suppress warning about SYMVALUNK being > 0xffff
+                    val = SYMVALUNK & 0xffff
+                self.writerom16(self.pc, val)
+                self.file_contents[self.line_num-1].addbytes((val & 0xff, (val >> 8) & 0xff))
+                self.pc += 2
+
+    # Date directive
+    def rundate(self, stmt):
+        self.checkorg()
+        self.keepdirty()     # The date is read again on every pass
+        data = bytes(datetime.now().isoformat(timespec='minutes'), "utf_8")
+        self.writerom(self.pc, data)
+        self.file_contents[self.line_num-1].addbytes(data)
+        self.pc += len(data)
+
+    #BuildNum directive
+    def runbuild(self, stmt):
+        self.checkorg()
+        data = bytes(f"{self.build_num:06}", "utf_8")
+        self.writerom(self.pc, data)
+        self.file_contents[self.line_num-1].addbytes(data)
+        self.pc += len(data)
+
+    # Equate
+    def runequ(self, stmt):
+        val = self.evalexp(stmt.exps[0])
+        self.addsym(stmt.name, val, stmt.text, self.pc)
+
+    # Register width directives
+    def runal(self, stmt):
+        self.al = True
+
+    def runxl(self, stmt):
+        self.xl = True
+
+    def runas(self, stmt):
+        self.al = False
+
+    def runxs(self, stmt):
+        self.xl = False
+
+    # Statement kind, function that runs the statement on each pass
+    stmt_handlers = {
+        STMT_ERROR: runerror,
+        STMT_LABEL: runlabel,
+        STMT_ORG: runorg,
+        STMT_INSTRUCTION: runinstruction,
+        STMT_BYTE: runbyte,
+        STMT_WORD: runword,
+        STMT_DATE: rundate,
+        STMT_BUILD: runbuild,
+        STMT_EQU: runequ,
+        STMT_AL: runal,
+        STMT_XL: runxl,
+        STMT_AS: runas,
+        STMT_XS: runxs,
+    }
+
+    # Checks that every emitted instruction decodes back to the mnemonic it was assembled from,
+    # with the same length. Register widths follow the width directives in source order
+    def verifylisting(self):
+        lal = False
+        lxl = False
+        count = 0
+        for line in self.file_contents:
+            if line.ismacdef or line.statements is None:
+                continue
+            for stmt in line.statements:
+                if stmt.kind == STMT_AL:
+                    lal = True
+                elif stmt.kind == STMT_XL:
+                    lxl = True
+                elif stmt.kind == STMT_AS:
+                    lal = False
+                elif stmt.kind == STMT_XS:
+                    lxl = False
+                elif stmt.kind == STMT_INSTRUCTION:
+                    data = line.rawbytes
+                    opcode = data[0]
+                    decoded = None
+                    if 0 <= opcode <= 0xff:
+                        decoded = Instructions.DECODE_TABLE[opcode]
+                    mne_id = Instructions.MNEMONIC_IDS[stmt.instruction.mne]
+                    if decoded is None or Instructions.OPCODE_MATRIX[mne_id][decoded[1]] != opcode \
+                            or 1 + Instructions.operandsize(opcode, lal, lxl) != len(data):
+                        disassembly = Instructions.disassemble(bytes(b & 0xff for b in data), line.pc, lal, lxl)
+                        self.pmsg(ERROR, f"Verification failed, bytes decode as '{'; '.join(text for _, _, text in disassembly)}'", line)
+                    count += 1
+        self.pmsg(INFO, f"Verified {count} instructions")
+
+    # Preprocesses and expands the macros of a file, or of the source in text if it is given
+    def load(self, filename, text=None):
+        if self.sparse_rom is not None:
+            self.pmsg(INFO, f"ROM SIZE: 24-bit address space, sparse")
         else:
-            # print("ERROR!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")  # DEBUG
-            pass
+            self.pmsg(INFO, f"ROM SIZE: {self.rom_size} bytes.")
+            self.rom_contents = bytearray(self.rom_size)
 
-        i += 1
+        # The preprocessor and macro expander are generators, lines stream through both stages
+        self.pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting Preprocessor ***{Style.RESET_ALL}")
+        if self.options.jobs > 1 and text is None:
+            self.preprocessor.prefetch(filename, self.options.base_dir, self.options.jobs)
+        source_lines = self.preprocessor.preprocess(filename, self.options.base_dir, text=text)
 
-    if not line_content:
-        pmsg(ERROR, f"Unknown symbol '{prev_sym}'", file_contents[line_num - 1])
+        self.pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting Macro Expansion ***{Style.RESET_ALL}")
+        try:
+            self.file_contents = LineStore(Macro.process(source_lines, self.diagnostics))  # Stores the lines of source
+        finally:
+            self.preprocessor.endprefetch()
+        self.diagnostics.stopiferrors()
+
+    # Runs passes over the loaded lines until every symbol is resolved
+    def run(self):
+        while self.pass_num < 2 or self.needs_another_pass:
+            self.pass_num += 1
+            self.line_num = 0
+            self.needs_another_pass = False
+            self.al = False
+            self.xl = False
+            self.pc = -1
+            self.diagnostics.newpass()
+            self.pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting pass #{self.pass_num} ***{Style.RESET_ALL}")
+            if self.sparse_rom is not None:
+                self.sparse_rom.newpass()
+
+            parsed_lines = 0
+            changed_syms = self.symbol_table.clearchanges()  # Symbols that changed since the last pass started
+            self.file_contents.compact()    # Drops the bytes of lines that were parsed again
+            for line in self.file_contents:
+                self.line_num += 1
+                # Only process lines if they are not ASM macro definitions
+                line.pc = self.pc
+                if not line.ismacdef:
+                    self.setpcsym(self.pc)  # Update the PC location
+
+                    # Lines that read nothing that changed since the last pass are replayed
+                    if line.trace is not None and line.trace.isclean(line):
+                        line.trace.replay(line)
+                        continue
+
+                    parsed_lines += 1
+                    line.rawbytes = []
+                    prev_needs_another_pass = self.needs_another_pass
+                    prev_msg_count = self.diagnostics.count
+                    self.needs_another_pass = False
+                    line_trace = LineTrace(self, line)
+                    self.line_trace = line_trace
+
+                    # An error stops the line, the pass carries on to find more errors
+                    self.diagnostics.recover = True
+                    try:
+                        self.parseline(line) # Parse the preprocessed line
+                    except LineError:
+                        pass
+                    finally:
+                        self.diagnostics.recover = False
+
+                    # Lines that printed a message or need another pass are parsed again, as are lines
+                    # whose bytes are not the ones written to ROM
+                    if self.needs_another_pass or self.diagnostics.count != prev_msg_count or line_trace.written != line.countbytes():
+                        line_trace.replayable = False
+                    line_trace.out_pc = self.pc
+                    line_trace.out_al = self.al
+                    line_trace.out_xl = self.xl
+                    line_trace.out_rom_offset = self.rom_offset
+                    line.trace = line_trace
+                    self.line_trace = None
+                    self.needs_another_pass = self.needs_another_pass or prev_needs_another_pass
+
+            if self.pass_num > 1:
+                self.pmsg(INFO, f"Parsed {parsed_lines} of {len(self.file_contents)} lines, {len(changed_syms)} symbol(s) changed since the last pass")
+            if self.sparse_rom is not None:
+                self.sparse_rom.close()
+            self.diagnostics.stopiferrors()  # Errors in this pass are reported before more passes run
+
+            if self.pass_num == 1:
+                self.resolvesyms()
+                self.diagnostics.stopiferrors()
+
+            if self.pass_num == MAX_PASSES:
+                for sym in self.symbol_table.pendingsyms(): # Mark all symbols as resolved, even if they are not
+                    val = self.parseexp(self.symbol_table.get(sym).exp)
+                    self.symbol_table.force(sym, val)
+                self.reportsymtable()
+                self.pmsg(ERROR, "Allowable passes exhausted, check for recursive or undefined symbols", fatal=True)
+
+        # Done with assembling operation, remove the "PC" symbol from table
+        self.symbol_table.remove(INTERNAL_PC_SYM)
+
+        if self.options.verify:
+            self.verifylisting()
+        if self.sparse_rom is not None:
+            for seg_a, seg_b in self.sparse_rom.overlaps:
+                self.pmsg(ERROR, f"Segment ${seg_a.start:06X}-${seg_a.end-1:06X} overlaps segment ${seg_b.start:06X}-${seg_b.end-1:06X}")
+        self.diagnostics.stopiferrors()  # Nothing is written if there were errors
+
+    # Reports the resolved symbols as one message
+    def reportsymtable(self, inc_hidden_sym=True):
+        if not inc_hidden_sym:
+            self.pmsg(INFO, "Hiding private symbols")
+        text = "Symbol table:"
+        for sym in sorted(self.symbol_table.resolvedsyms()):
+            if inc_hidden_sym or sym[0] != '_':
+                val = self.symbol_table.value(sym)
+                if val == SYMVALUNK:
+                    text += f"\n     * {sym.ljust(25)}: ?????????"
+                else:
+                    text += f"\n     * {sym.ljust(25)}: ${val&0xffffffff:08X}"
+        self.pmsg(INFO, text)
+
+    # Returns a view of the assembled ROM image, which is not copied. None for a sparse ROM
+    def getrom(self):
+        if self.sparse_rom is not None:
+            return None
+        return memoryview(self.rom_contents)
+
+    # Returns the (start address, bytes) of each segment of a sparse ROM
+    def getsegments(self):
+        if self.sparse_rom is None:
+            return []
+        return [(seg.start, self.sparse_rom.read(seg.start, seg.end)) for seg in self.sparse_rom.segments]
+
+    # Returns the text of the listing file
+    def getlisting(self):
+        text = []
+        for line in self.file_contents:
+            printed_line = False
+            line_width = 7
+            if line.pc < 0:
+                text.append("??????:")
+            else:
+                text.append(f"{line.pc:06X}:")     # Print the address
+            for byt in line.rawbytes:       # Print the bytes
+                text.append(f" {byt:02X}")
+                line_width += 3
+                if line_width >= LIST_LINE_BREAK - 3:
+                    if not printed_line:
+                        text.append(' '*(LIST_LINE_BREAK-line_width))
+                        text.append(line.line)  # Add to listing the raw lines
+                        printed_line = True
+                    text.append('\n       ')
+                    line_width = 7
+
+            if not printed_line:
+                text.append(' '*(LIST_LINE_BREAK-line_width))
+                text.append(line.line)  # Add to listing the raw lines
+
+            text.append('\n')
+        return "".join(text)
+
+    # Returns the text of an includable symbol file. Symbols starting with '_' are commented out
+    # if hide_private is set
+    def getsymfile(self, sym_file, hide_private=False):
+        inc_name = re.sub("[^a-zA-Z0-9_]", "_", os.path.split(sym_file.upper())[1]) + "_H"
+        text = ["; Auto-generated listing file\n", f"#ifndef {inc_name}\n", f"#define {inc_name}\n"]
+        for sym in sorted(self.symbol_table.resolvedsyms()):
+            if hide_private and sym[0] == '_': # Ignore any labels starting with '_'
+                text.append("; ")
+            val = self.symbol_table.value(sym)
+            text.append(f"{sym.ljust(24)} equ ${val&0xffffffff:08X}\n")
+        text.append(f"#endif")
+        return "".join(text)
+
+    # Returns the resolved symbols, SYM, value
+    def getsymbols(self):
+        return {sym: self.symbol_table.value(sym) for sym in self.symbol_table.resolvedsyms()}
+
+
+# Outcome of assemble(). Outputs are None if the assembly stopped because of errors
+class Result:
+    def __init__(self, asm, ok):
+        self.ok = ok
+        self.messages = asm.diagnostics.messages    # Diagnostics in the order they were reported
+        self.errors = asm.diagnostics.errors
+        self.passes = asm.pass_num
+        self.rom = None
+        self.rom_offset = asm.rom_offset
+        self.segments = []
+        self.symbols = {}
+        self.listing = None
+        if ok:
+            self.rom = asm.getrom()
+            self.segments = asm.getsegments()
+            self.symbols = asm.getsymbols()
+            self.listing = asm.getlisting()
+
+
+# Assembles a file without printing anything. Source text is assembled instead if text is given,
+# filename is then only used in messages and to find include files. Returns a Result
+def assemble(filename=None, options=None, text=None):
+    if filename is None and text is None:
+        raise ValueError("assemble() needs a filename or text")
+    asm = Assembler(options)
+    try:
+        if text is not None:
+            asm.load(os.fspath(filename) if filename is not None else "<source>", text=text)
+        else:
+            asm.load(os.fspath(filename))
+        asm.run()
+    except StopAssembly:
+        return Result(asm, False)
+    return Result(asm, True)
 
 
 def printhelp():
@@ -984,226 +1922,428 @@ def printhelp():
     print("  -s, --sym <filename>     Save an includable symbol table")
     print("  -b, --build <filename>   Use file for build number storage")
     print("  -d, --base-dir <dir>     Use directory as base during include lookups")
+    print("  --cache-dir <dir>        Cache preprocessed include files in directory")
+    print("  -j, --jobs <n>           Preprocess included files in n worker processes")
+    print("  --precedence             Use standard operator precedence in expressions")
+    print("  --sparse                 Allow ORG anywhere in the 24-bit address space, each")
+    print("                           segment is written to its own output file")
+    print("  --verify                 Check that every instruction disassembles back to its source")
+    print("  --max-errors <n>         Report up to n errors before stopping, 0 for no limit")
+    print("  --depfile <filename>     Write a make dependency file for the output file")
+    print("  --if-changed             Skip the build if no inputs changed since the last one")
+    print("  --batch <filename>       Assemble every program listed in a manifest file")
+    print("  --batch-jobs <n>         Assemble a batch in n worker processes (default one per core)")
     print("  -h, --hidden             Don't include _labels in listings")
     print("")
 
 
-def printsymtable(inc_hidden_sym=True):
-
-    if not inc_hidden_sym:
-        pmsg(INFO, "Hiding private symbols")
-    pmsg(INFO, "Symbol table:")
-    sorted_sym_table = sorted(re_symbol_table.keys())
-    for sym in sorted_sym_table:
-        if inc_hidden_sym or sym[0] != '_':
-            val = re_symbol_table[sym].val
-            if val == SYMVALUNK:
-                print(f"     * {sym.ljust(25)}: ?????????")
-            else:
-                print(f"     * {sym.ljust(25)}: ${val&0xffffffff:08X}")
-
-
-if __name__ == "__main__":
-    argv = sys.argv[1:]
+# Escapes a filename for use in a makefile rule
+def makeescape(filename):
+    return filename.replace("$", "$$").replace(" ", "\\ ").replace("#", "\\#")
 
-    print("HIEPA: The Highly InEfficient Python Assembler")
-    print("              for the 65816 CPU               ")
-    print("        (C) Zach Baldwin 2021 - 2023          ")
-    print("")
 
-    if len(sys.argv) == 1:
-        printhelp()
-        exit(-2)
+# Writes a make rule listing every file the output was built from, plus an empty rule
+# for each one so make does not fail when a file is deleted
+def writedepfile(dep_file, targets, files):
+    deps = list(dict.fromkeys(files.values()))
+    with open(dep_file, "w") as df:
+        df.write(f"{' '.join(makeescape(target) for target in targets)}:")
+        for dep in deps:
+            df.write(f" \\\n  {makeescape(dep)}")
+        df.write("\n")
+        for dep in deps[1:]:    # First dep is the input file itself
+            df.write(f"\n{makeescape(dep)}:\n")
 
-    format_o64 = False
-    rom_size = parseexp("$8000")
-    out_file = "output.bin"
-    in_file = ""
-    listing_file = ""
-    pplisting_file = ""
-    sym_file = ""
-    build_file = ""
-    base_dir = "./" # Default to relative file paths
-    inc_hidden_sym = False
 
+# Returns true if the build recorded in a stamp file used the same options and inputs
+def checkstamp(stamp_file, argv, outputs, build_file):
     try:
-        opts, args = getopt.getopt(argv, "r:a:o:iwl:s:b:d:h", ["rom=", "asm=", "out=", "ignoreinfo", "ignorewarn", "o64", "listing=", "pplisting=", "sym=", "build=", "base-dir=", "hidden", "help"])
-    except getopt.GetoptError:
-        printhelp()
-        exit(-2)
+        with open(stamp_file, "r") as sf:
+            stamp = json.load(sf)
+    except Exception:   # No previous build (or an unreadable stamp), so build
+        return False
+
+    if stamp.get("argv") != argv:
+        return False
+    if build_file != "" and Preprocessor.hashfile(build_file) != stamp.get("build"):
+        return False
+    for filename in outputs + stamp.get("outputs", []):  # Segment files are only known after a build
+        if not os.path.isfile(filename):
+            return False
+    for (filename, parentfilename, resolved, digest) in stamp.get("inputs", []):
+        if Preprocessor.resolvefile(filename, parentfilename) != resolved or Preprocessor.hashfile(resolved) != digest:
+            return False
+    return True
+
+
+# Records the options and the hash of every input of a build
+def writestamp(stamp_file, argv, outputs, build_file, files, diagnostics):
+    inputs = [(filename, parentfilename, resolved, Preprocessor.hashfile(resolved)) for ((filename, parentfilename), resolved) in files.items()]
+    build = None
+    if build_file != "":
+        build = Preprocessor.hashfile(build_file)
+    try:
+        with open(stamp_file, "w") as sf:
+            json.dump({"argv": argv, "outputs": outputs, "inputs": inputs, "build": build}, sf)
+    except OSError:
+        diagnostics.pmsg(WARN, f"Unable to write build stamp file {stamp_file}")
+
+
+# Output files and settings of one build, from the command line or a line of a batch manifest
+class BuildArgs:
+    def __init__(self, argv):
+        self.argv = argv
+        self.opts = []      # (OPTION, ARGUMENT) in the order they were given
+        self.options = Options()
+        self.format_o64 = False
+        self.out_file = "output.bin"
+        self.in_file = ""
+        self.listing_file = ""
+        self.pplisting_file = ""
+        self.sym_file = ""
+        self.build_file = ""
+        self.inc_hidden_sym = False
+        self.dep_file = ""
+        self.if_changed = False
+        self.batch_file = ""
+        self.batch_jobs = 0     # Worker processes of a batch, 0 for one per core
+        self.help = False
+
+
+# Parses the options of a build. Errors are reported against line, a line of a batch manifest,
+# if it is given. Raises getopt.GetoptError for unknown options
+def parseargs(argv, diagnostics, line=None):
+    args = BuildArgs(argv)
+    opts, rest = getopt.getopt(argv, SHORT_OPTS, LONG_OPTS)
+    applyopts(args, opts, diagnostics, line)
+    return args
+
+
+# Sets the (OPTION, ARGUMENT) pairs returned by getopt in args
+def applyopts(args, opts, diagnostics, line=None):
+    options = args.options
+    args.opts += opts
     for opt, arg in opts:
         if opt == "--o64":
-            format_o64 = True
+            args.format_o64 = True
         elif opt in ("-r", "--rom"):
-            rom_size = parseexp(arg)
+            options.rom_size = Assembler(diagnostics=diagnostics).parseexp(arg)
         elif opt in ("-o", "--out"):
-            out_file = arg
+            args.out_file = arg
         elif opt in ("-i", "--ignoreinfo"):
-            ignore_info_msg = True
+            options.ignore_info = True
         elif opt in ("-w", "--ignorewarn"):
-            ignore_warn_msg = True
+            options.ignore_warn = True
         elif opt in ("-a", "--asm"):
-            in_file = arg
+            args.in_file = arg
         elif opt in ("-l", "--listing"):
-            listing_file = arg
-        elif opt in ("--pplisting"):
-            pplisting_file = arg
+            args.listing_file = arg
+        elif opt == "--pplisting":
+            args.pplisting_file = arg
         elif opt in ("-s", "--sym"):
-            sym_file = arg
+            args.sym_file = arg
         elif opt in ("-b", "--build"):
-            build_file = arg
+            args.build_file = arg
         elif opt in ("-d", "--base-dir"):
-            base_dir = arg
+            options.base_dir = arg
+        elif opt == "--cache-dir":
+            options.cache_dir = arg
+        elif opt in ("-j", "--jobs"):
+            try:
+                options.jobs = int(arg)
+            except ValueError:
+                options.jobs = 0
+            if options.jobs < 1:
+                diagnostics.pmsg(ERROR, "Number of jobs must be > 0", line, fatal=True)
+        elif opt == "--depfile":
+            args.dep_file = arg
+        elif opt == "--if-changed":
+            args.if_changed = True
+        elif opt == "--precedence":
+            options.precedence = True
+        elif opt == "--sparse":
+            options.sparse = True
+        elif opt == "--verify":
+            options.verify = True
+        elif opt == "--max-errors":
+            try:
+                options.max_errors = int(arg)
+            except ValueError:
+                options.max_errors = -1
+            if options.max_errors < 0:
+                diagnostics.pmsg(ERROR, "Maximum number of errors must be >= 0", line, fatal=True)
+        elif opt == "--batch":
+            args.batch_file = arg
+        elif opt == "--batch-jobs":
+            try:
+                args.batch_jobs = int(arg)
+            except ValueError:
+                args.batch_jobs = 0
+            if args.batch_jobs < 1:
+                diagnostics.pmsg(ERROR, "Number of batch jobs must be > 0", line, fatal=True)
         elif opt in ("-h", "--hidden"):
-            inc_hidden_sym = True
-        elif opt in ("--help"):
-            printhelp()
-            exit(0)
+            args.inc_hidden_sym = True
+        elif opt == "--help":
+            args.help = True
+            break
         else:
-            pmsg(ERROR, "Unknown option. Run without arguments for help menu.")
-
-    if in_file == "":
-        printhelp()
-        pmsg(ERROR, "I need an input file!")
-
-    if rom_size < 1:
-        printhelp()
-        pmsg(ERROR, "Rom size must be > 0")
-
-    pmsg(INFO, f"ROM SIZE: {rom_size} bytes.")
+            diagnostics.pmsg(ERROR, "Unknown option. Run without arguments for help menu.", line, fatal=True)
 
-    for i in range(rom_size):
-        rom_contents.append(0)
 
-    pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting Preprocessor ***{Style.RESET_ALL}")
-    file_contents = Preprocessor.preprocess(in_file, base_dir)  # Stores the lines of source
-
-    pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting Macro Expansion ***{Style.RESET_ALL}")
-    file_contents = Macro.process(file_contents)  # Stores the lines of source
+# Stops if a build is missing an input file or has no ROM. The help menu is shown unless
+# the build is from a line of a batch manifest
+def checkargs(args, diagnostics, line=None):
+    if args.in_file == "":
+        if line is None:
+            printhelp()
+        diagnostics.pmsg(ERROR, "I need an input file!", line, fatal=True)
 
-    if pplisting_file != "":
-        pmsg(INFO, f"Writing preprocessor listing file {pplisting_file}")
-        with open(pplisting_file, "w") as lf:
-            for line in file_contents:
+    if args.options.rom_size < 1:
+        if line is None:
+            printhelp()
+        diagnostics.pmsg(ERROR, "Rom size must be > 0", line, fatal=True)
+
+
+# Assembles a program and writes its output files. Returns false if the build was skipped
+# because no inputs changed since the last one
+def build(args, asm):
+    diagnostics = asm.diagnostics
+
+    # Outputs that must still exist for an unchanged build to be skipped
+    stamp_file = f"{args.out_file}.stamp"
+    outputs = [f for f in (args.out_file, args.listing_file, args.pplisting_file, args.sym_file, args.dep_file) if f != ""]
+    bin_files = [args.out_file]
+    if args.options.sparse:  # Replaced by one file per segment
+        outputs.remove(args.out_file)
+        bin_files = []
+    if args.if_changed and checkstamp(stamp_file, args.argv, outputs, args.build_file):
+        diagnostics.pmsg(INFO, f"No inputs changed since the last build of {args.out_file}")
+        return False
+
+    asm.load(args.in_file)
+
+    if args.pplisting_file != "":
+        diagnostics.pmsg(INFO, f"Writing preprocessor listing file {args.pplisting_file}")
+        with open(args.pplisting_file, "w") as lf:
+            for line in asm.file_contents:
                 lf.write(line.ppline)  # Add to listing the raw lines
                 lf.write('\n')
 
     # Read build number
-    if build_file != "":
+    if args.build_file != "":
         try:
-            with open(build_file, "r") as bf:
+            with open(args.build_file, "r") as bf:
                 try:
-                    build_num = int(bf.readline()) + 1
-                    pmsg(INFO, f"Build number {build_num}")
+                    asm.build_num = int(bf.readline()) + 1
+                    diagnostics.pmsg(INFO, f"Build number {asm.build_num}")
                 except:
-                    pmsg(WARN, f"Invalid integer in {build_file} file.")
+                    diagnostics.pmsg(WARN, f"Invalid integer in {args.build_file} file.")
         except:
-            build_num = 0
-            pmsg(WARN, f"Unable to open {build_file} for reading.")
-
-    while pass_num < 2 or needs_another_pass:
-        pass_num += 1
-        line_num = 0
-        needs_another_pass = False
-        al = False
-        xl = False
-        pc = -1
-        pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Starting pass #{pass_num} ***{Style.RESET_ALL}")
-
-        for line in file_contents:
-            line_num += 1
-            # Only process lines if they are not ASM macro definitions
-            file_contents[line_num-1].pc = pc
-            file_contents[line_num-1].rawbytes = []
-            if not line.ismacdef:
-                re_symbol_table[INTERNAL_PC_SYM] = getpcsym(pc)  # Update the PC location
-                parseline(line.ppline) # Parse the preprocessed line
-
-        if pass_num == 1:
-            rei = 0
-            while rei <= MAX_PASSES and len(un_symbol_table) > 0:
-                unsymtbl = un_symbol_table.copy() # Shallow copy
-                for sym in unsymtbl:
-                    tryresolvesym(sym)
-
-                if rei == MAX_PASSES and len(un_symbol_table) > 0:
-                    pmsg(ERROR, "Symbol resolver pass limit reached.")
-
-                rei += 1
-
-        if pass_num == MAX_PASSES:
-            for sym in un_symbol_table: # Copy all symbols, resolved or not into the resolved table
-
-                exp = un_symbol_table[sym].exp
-                lpc = un_symbol_table[sym].lpc
-                val = parseexp(exp)
-                re_symbol_table[sym] = Symbols.Symbol(sym, val, exp, lpc)
-            printsymtable()
-            pmsg(ERROR, "Allowable passes exhausted, check for recursive or undefined symbols")
-
-    # Done with assembling operation, remove the "PC" symbol from table
-    re_symbol_table.pop(INTERNAL_PC_SYM)
+            asm.build_num = 0
+            diagnostics.pmsg(WARN, f"Unable to open {args.build_file} for reading.")
+
+    asm.run()
 
     # Generate output binary
-    with open(out_file, "wb") as file:
-        if format_o64:
-            file.write(bytearray([rom_offset & 0xff, (rom_offset >> 8) & 0xff]))
-        file.write(bytearray(rom_contents))
-
-
-    if listing_file != "":
-        pmsg(INFO, f"Writing listing file {listing_file}")
-        with open(listing_file, "w") as lf:
-            for line in file_contents:
-                printed_line = False
-                line_width = 7
-                if line.pc < 0:
-                    lf.write("??????:")
-                else:
-                    lf.write(f"{line.pc:06X}:")     # Print the address
-                for byt in line.rawbytes:       # Print the bytes
-                    lf.write(f" {byt:02X}")
-                    line_width += 3
-                    if line_width >= LIST_LINE_BREAK - 3:
-                        if not printed_line:
-                            lf.write(' '*(LIST_LINE_BREAK-line_width))
-                            lf.write(line.line)  # Add to listing the raw lines
-                            printed_line = True
-                        lf.write('\n       ')
-                        line_width = 7
-
-                if not printed_line:
-                    lf.write(' '*(LIST_LINE_BREAK-line_width))
-                    lf.write(line.line)  # Add to listing the raw lines
+    if args.options.sparse:
+        # Each segment is written to its own file, named after its start address
+        out_base, out_ext = os.path.splitext(args.out_file)
+        for seg_start, seg_data in asm.getsegments():
+            seg_file = f"{out_base}_{seg_start:06X}{out_ext}"
+            bin_files.append(seg_file)
+            outputs.append(seg_file)
+            diagnostics.pmsg(INFO, f"Writing segment ${seg_start:06X}-${seg_start+len(seg_data)-1:06X} to {seg_file}")
+            with open(seg_file, "wb") as file:
+                if args.format_o64:
+                    file.write(bytearray([seg_start & 0xff, (seg_start >> 8) & 0xff]))
+                file.write(seg_data)
+    else:
+        with open(args.out_file, "wb") as file:
+            if args.format_o64:
+                file.write(bytearray([asm.rom_offset & 0xff, (asm.rom_offset >> 8) & 0xff]))
+            file.write(asm.getrom())
+
+    if args.listing_file != "":
+        diagnostics.pmsg(INFO, f"Writing listing file {args.listing_file}")
+        with open(args.listing_file, "w") as lf:
+            lf.write(asm.getlisting())
+
+    if args.sym_file != "":
+        diagnostics.pmsg(INFO, f"Writing symbol file {args.sym_file}")
+        with open(args.sym_file, "w") as sf:
+            sf.write(asm.getsymfile(args.sym_file, args.inc_hidden_sym))
+
+    if args.build_file != "":
+        try:
+            with open(args.build_file, "w") as bf:
+                bf.write(str(asm.build_num))
+        except:
+            diagnostics.pmsg(WARN, f"Unable to update {args.build_file} file.")
 
-                lf.write('\n')
+    if args.dep_file != "":
+        diagnostics.pmsg(INFO, f"Writing dependency file {args.dep_file}")
+        writedepfile(args.dep_file, bin_files, asm.preprocessor.files)
 
+    if args.if_changed:
+        writestamp(stamp_file, args.argv, outputs, args.build_file, asm.preprocessor.files, diagnostics)
 
-    if sym_file != "":
-        sorted_sym_table = sorted(re_symbol_table.keys())
-        pmsg(INFO, f"Writing symbol file {sym_file}")
-        inc_name = re.sub("[^a-zA-Z0-9_]", "_", os.path.split(sym_file.upper())[1]) + "_H"
-        with open(sym_file, "w") as sf:
-            sf.write("; Auto-generated listing file\n")
-            sf.write(f"#ifndef {inc_name}\n")
-            sf.write(f"#define {inc_name}\n")
-            for sym in sorted_sym_table:
-                if inc_hidden_sym and sym[0] == '_': # Ignore any labels starting with '_'
-                    sf.write("; ")
-                val = re_symbol_table[sym].val
-                sf.write(f"{sym.ljust(24)} equ ${val&0xffffffff:08X}\n")
-
-            sf.write(f"#endif")
+    diagnostics.pmsg(INFO, f"Total Passes: {asm.pass_num}")
 
-    if build_file != "":
+    asm.reportsymtable(args.inc_hidden_sym)
+    return True
+
+
+# Returns the BuildArgs of every line of a batch manifest. Each line holds an input file, an
+# output file and any other options of the build, with paths relative to the manifest. Options on
+# the command line apply to every build
+def readmanifest(args, diagnostics):
+    # Every command line option except the batch ones is passed on to the builds
+    common = [(opt, arg) for opt, arg in args.opts if opt not in ("--batch", "--batch-jobs")]
+    manifest_dir = os.path.dirname(args.batch_file)
+
+    try:
+        with open(args.batch_file, "r") as mf:
+            text = mf.read()
+    except OSError:
+        diagnostics.pmsg(ERROR, f"Batch manifest '{args.batch_file}' not found.", fatal=True)
+
+    jobs = []
+    line_num = 0
+    for text_line in text.splitlines():
+        line_num += 1
+        line = FileLine("", args.batch_file, line_num, text_line, text_line)
         try:
-            with open(build_file, "w") as bf:
-                bf.write(str(build_num))
-        except:
-            pmsg(WARN, f"Unable to update {build_file} file.")
+            fields = shlex.split(text_line, comments=True)
+        except ValueError:
+            diagnostics.pmsg(ERROR, "Unterminated quote in batch manifest", line, fatal=True)
+        if len(fields) == 0:
+            continue
+        if len(fields) < 2:
+            diagnostics.pmsg(ERROR, "Expected an input file and an output file", line, fatal=True)
+        try:
+            opts, rest = getopt.getopt(["-a", fields[0], "-o", fields[1]] + fields[2:], SHORT_OPTS, LONG_OPTS)
+        except getopt.GetoptError as e:
+            diagnostics.pmsg(ERROR, f"Invalid option in batch manifest, {e.msg}", line, fatal=True)
+        if len(rest) > 0:
+            diagnostics.pmsg(ERROR, f"Unexpected argument '{rest[0]}' in batch manifest", line, fatal=True)
+        opts = [(opt, os.path.join(manifest_dir, arg) if opt in PATH_OPTS else arg) for opt, arg in opts]
+        # The options of a build are recorded in its stamp file, see --if-changed
+        job = BuildArgs([list(opt) for opt in common + opts])
+        applyopts(job, common + opts, diagnostics, line)
+        if job.help or job.batch_file != "":
+            diagnostics.pmsg(ERROR, "Option not allowed in batch manifest", line, fatal=True)
+        checkargs(job, diagnostics, line)
+        jobs.append(job)
+    return jobs
+
+
+# Starts a batch worker process with the tokens of the files lexed by the main process
+def initbatchworker(lex_cache):
+    global batch_lex_cache
+    batch_lex_cache = lex_cache
+
+
+# Runs one build of a batch in a worker process. Returns (exit code, built, passes, seconds, messages)
+def runbatchjob(args):
+    start = time.perf_counter()
+    asm = Assembler(args.options, Diagnostics(args.options.max_errors), batch_lex_cache)
+    code = 0
+    built = False
+    try:
+        built = build(args, asm)
+    except StopAssembly:
+        code = -1
+    except Exception:
+        asm.diagnostics.add(ERROR, f"Build of {args.out_file} crashed\n{traceback.format_exc()}")
+        code = BATCH_CRASHED
+    return (code, built, asm.pass_num, time.perf_counter() - start, asm.diagnostics.messages)
+
+
+# Assembles every program of a batch manifest in a pool of worker processes, --batch-jobs of them
+# or one per core. Returns -1 if any build failed or crashed, else 0
+def runbatch(args, diagnostics):
+    jobs = readmanifest(args, diagnostics)
+    workers = args.batch_jobs
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    # Files included by several programs are only lexed once, here
+    lex_cache = {}
+    for job in jobs:
+        Preprocessor.lexincludes(job.in_file, job.options.base_dir, lex_cache)
+    diagnostics.pmsg(INFO, f"Assembling {len(jobs)} program(s) in {workers} worker process(es), {len(lex_cache)} file(s) lexed")
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initbatchworker, initargs=(lex_cache,)) as executor:
+        futures = [executor.submit(runbatchjob, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                code, built, passes, seconds, messages = future.result()
+            except Exception as e:  # The worker process died
+                code, built, passes, seconds, messages = (BATCH_CRASHED, False, 0, 0.0, [])
+                diagnostics.add(ERROR, f"Build of {job.out_file} crashed: {e}")
+
+            # Messages of each build are printed together, in manifest order
+            diagnostics.pmsg(INFO, f"{Style.BRIGHT}{Fore.MAGENTA}*** Batch build {job.in_file} -> {job.out_file} ***{Style.RESET_ALL}")
+            diagnostics.flush()
+            for diag in messages:
+                print(diag)
+            results.append((job, code, built, passes, seconds))
+
+    text = f"Batch summary:\n     {'Output'.ljust(25)} {'Result'.ljust(9)} Passes     Time"
+    for job, code, built, passes, seconds in results:
+        if code == 0:
+            result = "OK" if built else "UNCHANGED"
+        elif code == BATCH_CRASHED:
+            result = "CRASHED"
+        else:
+            result = "FAILED"
+        text += f"\n     {job.out_file.ljust(25)} {result.ljust(9)} {passes:6} {seconds:7.2f}s"
+    diagnostics.pmsg(INFO, text)
+    if any(code != 0 for job, code, built, passes, seconds in results):
+        return -1
+    return 0
+
+
+def main(argv):
+    print("HIEPA: The Highly InEfficient Python Assembler")
+    print("              for the 65816 CPU               ")
+    print("        (C) Zach Baldwin 2021 - 2023          ")
+    print("")
 
-    pmsg(INFO, f"Total Passes: {pass_num}")
+    if len(argv) == 0:
+        printhelp()
+        exit(-2)
 
-    printsymtable(inc_hidden_sym)
+    diagnostics = Diagnostics()
+    try:
+        try:
+            args = parseargs(argv, diagnostics)
+        except getopt.GetoptError:
+            printhelp()
+            exit(-2)
+        if args.help:
+            printhelp()
+            exit(0)
+        diagnostics.max_errors = args.options.max_errors
 
+        if args.batch_file != "":
+            code = runbatch(args, diagnostics)
+            if code != 0:
+                diagnostics.flush()
+                exit(code)
+        else:
+            checkargs(args, diagnostics)
+            if not build(args, Assembler(args.options, diagnostics)):
+                diagnostics.flush()
+                exit(0)
+    except StopAssembly:
+        diagnostics.flush()
+        exit(-1)
+
+    diagnostics.flush()
     print(Fore.GREEN + "=================> DONE! <=================" + Fore.RESET)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
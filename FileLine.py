@@ -1,14 +1,20 @@
+from array import array
+
 class FileLine:
-    def __init__(self, parentfilename, filename, line_num, line, ppline, rawbytes=[], addr_mode=0, pc=-1, ismacdef=False):
+    __slots__ = ("parentfilename", "filename", "line_num", "line", "ppline", "rawbytes", "addr_mode", "pc", "ismacdef", "statements", "trace")
+
+    def __init__(self, parentfilename, filename, line_num, line, ppline, rawbytes=None, addr_mode=0, pc=-1, ismacdef=False):
         self.parentfilename = parentfilename
         self.filename = filename
         self.line_num = line_num
         self.line = line
         self.ppline = ppline
-        self.rawbytes = rawbytes
+        self.rawbytes = () if rawbytes is None else rawbytes    # Lines only get bytes once they are in a LineStore
         self.addr_mode = addr_mode
         self.pc = pc
         self.ismacdef = ismacdef
+        self.statements = None  # Decoded statements, see Statement.py
+        self.trace = None       # Inputs and outputs of the last pass that parsed the line
 
     @classmethod
     def dupfileline(cls, line):
@@ -17,10 +23,232 @@ class FileLine:
                    line.line_num,
                    line.line,
                    line.ppline,
-                   line.rawbytes,
+                   tuple(line.rawbytes),
                    line.addr_mode,
                    line.pc,
                    line.ismacdef)
 
     def __str__(self):
-        return self.line
\ No newline at end of file
+        return self.line
+
+
+# Column storage for the lines being assembled. Filenames are stored once, numbers are stored
+# in arrays and the bytes emitted for every line share one bytearray
+class LineStore:
+    def __init__(self, lines=()):
+        self.filenames = []         # File ID, filename
+        self.file_ids = {}          # Filename, file ID
+        self.parents = array('I')   # File ID of each line's parent file
+        self.files = array('I')     # File ID of each line's file
+        self.line_nums = array('I')
+        self.lines = []
+        self.pplines = []
+        self.addr_modes = bytearray()
+        self.pcs = array('q')
+        self.big_pcs = {}           # Line index, PC that does not fit in pcs
+        self.ismacdefs = bytearray()
+        self.statements = []
+        self.traces = []
+        self.data = bytearray()     # Bytes emitted by every line
+        self.offsets = array('I')   # Offset of each line's bytes in data
+        self.lengths = array('I')
+        self.wide = {}              # Line index, emitted values that do not fit in a byte
+
+        for line in lines:
+            self.append(line)
+
+    def fileid(self, filename):
+        file_id = self.file_ids.get(filename)
+        if file_id is None:
+            file_id = len(self.filenames)
+            self.filenames.append(filename)
+            self.file_ids[filename] = file_id
+        return file_id
+
+    def append(self, line):
+        index = len(self.lines)
+        self.parents.append(self.fileid(line.parentfilename))
+        self.files.append(self.fileid(line.filename))
+        self.line_nums.append(line.line_num)
+        self.lines.append(line.line)
+        self.pplines.append(line.ppline)
+        self.addr_modes.append(line.addr_mode)
+        self.pcs.append(0)
+        self.setpc(index, line.pc)
+        self.ismacdefs.append(line.ismacdef)
+        self.statements.append(line.statements)
+        self.traces.append(line.trace)
+        self.offsets.append(0)
+        self.lengths.append(0)
+        self.setbytes(index, line.rawbytes)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.lines)
+        if index < 0 or index >= len(self.lines):
+            raise IndexError("line index out of range")
+        return StoredLine(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.lines)):
+            yield StoredLine(self, index)
+
+    def getpc(self, index):
+        if index in self.big_pcs:
+            return self.big_pcs[index]
+        return self.pcs[index]
+
+    def setpc(self, index, pc):
+        if -0x8000000000000000 <= pc <= 0x7fffffffffffffff:
+            self.pcs[index] = pc
+            self.big_pcs.pop(index, None)
+        else:
+            self.big_pcs[index] = pc
+
+    # Drops the bytes that no line uses. A line that is given new bytes leaves its old ones in data,
+    # so data is rebuilt once more than half of it is unused
+    def compact(self):
+        if len(self.data) <= 2 * sum(self.lengths):
+            return
+        data = bytearray()
+        for index in range(len(self.lines)):
+            length = self.lengths[index]
+            if length > 0:
+                offset = self.offsets[index]
+                self.offsets[index] = len(data)
+                data += self.data[offset:offset+length]
+        self.data = data
+
+    def getbytes(self, index):
+        if index in self.wide:
+            return list(self.wide[index])
+        offset = self.offsets[index]
+        return list(self.data[offset:offset+self.lengths[index]])
+
+    # Returns the bytes of a line as a bytes object, values that do not fit in a byte are masked
+    def getdata(self, index):
+        if index in self.wide:
+            return bytes(val & 0xff for val in self.wide[index])
+        offset = self.offsets[index]
+        return bytes(self.data[offset:offset+self.lengths[index]])
+
+    def countbytes(self, index):
+        if index in self.wide:
+            return len(self.wide[index])
+        return self.lengths[index]
+
+    def setbytes(self, index, values):
+        self.wide.pop(index, None)
+        self.lengths[index] = 0
+        self.addbytes(index, values)
+
+    def addbytes(self, index, values):
+        if index in self.wide:
+            self.wide[index].extend(values)
+            return
+        try:
+            data = bytes(values)
+        except ValueError:  # Only out of range values are kept as a list
+            self.wide[index] = self.getbytes(index) + list(values)
+            self.lengths[index] = 0
+            return
+        if len(data) == 0:
+            return
+
+        # The line's bytes are moved to the end of data unless they are there already
+        offset = self.offsets[index]
+        length = self.lengths[index]
+        if length == 0 or offset + length != len(self.data):
+            self.offsets[index] = len(self.data)
+            self.data += self.data[offset:offset+length]
+        self.data += data
+        self.lengths[index] = length + len(data)
+
+
+# FileLine compatible view of a line in a LineStore
+class StoredLine:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def parentfilename(self):
+        return self.store.filenames[self.store.parents[self.index]]
+
+    @property
+    def filename(self):
+        return self.store.filenames[self.store.files[self.index]]
+
+    @property
+    def line_num(self):
+        return self.store.line_nums[self.index]
+
+    @property
+    def line(self):
+        return self.store.lines[self.index]
+
+    @property
+    def ppline(self):
+        return self.store.pplines[self.index]
+
+    @property
+    def rawbytes(self):
+        return self.store.getbytes(self.index)
+
+    @rawbytes.setter
+    def rawbytes(self, values):
+        self.store.setbytes(self.index, values)
+
+    # Adds values to the line's emitted bytes
+    def addbytes(self, values):
+        self.store.addbytes(self.index, values)
+
+    def getdata(self):
+        return self.store.getdata(self.index)
+
+    def countbytes(self):
+        return self.store.countbytes(self.index)
+
+    @property
+    def addr_mode(self):
+        return self.store.addr_modes[self.index]
+
+    @addr_mode.setter
+    def addr_mode(self, addr_mode):
+        self.store.addr_modes[self.index] = addr_mode
+
+    @property
+    def pc(self):
+        return self.store.getpc(self.index)
+
+    @pc.setter
+    def pc(self, pc):
+        self.store.setpc(self.index, pc)
+
+    @property
+    def ismacdef(self):
+        return bool(self.store.ismacdefs[self.index])
+
+    @property
+    def statements(self):
+        return self.store.statements[self.index]
+
+    @statements.setter
+    def statements(self, statements):
+        self.store.statements[self.index] = statements
+
+    @property
+    def trace(self):
+        return self.store.traces[self.index]
+
+    @trace.setter
+    def trace(self, trace):
+        self.store.traces[self.index] = trace
+
+    def __str__(self):
+        return self.line
@@ -148,3 +148,107 @@ INSTRUCTIONS = {
     
     
 }
+
+
+# Addressing modes, in the same order as the opcode columns above
+AM_IMMD = 0
+AM_ABSU = 1
+AM_LNG = 2
+AM_DRCT = 3
+AM_IMPD = 4
+AM_IDRCTY = 5
+AM_ILDRCTY = 6
+AM_IDRCTX = 7
+AM_DRCTX = 8
+AM_DRCTY = 9
+AM_ABSX = 10
+AM_LONGX = 11
+AM_ABSY = 12
+AM_REL8 = 13
+AM_REL16 = 14
+AM_IABS = 15
+AM_IDRCT = 16
+AM_ILDRCT = 17
+AM_ILABS = 18
+AM_IABSX = 19
+AM_STACKS = 20
+AM_ISTACKSY = 21
+AM_SRCDES = 22
+
+# Instruction attribute and operand size in bytes of each addressing mode. Immediate operands
+# are one byte longer with a 16 bit A or X register
+MODE_ATTRS = ("immd", "absu", "lng", "drct", "impd", "idrcty", "ildrcty", "idrctx", "drctx", "drcty", "absx", "longx", "absy",
+              "rel8", "rel16", "iabs", "idrct", "ildrct", "ilabs", "iabsx", "stacks", "istacksy", "srcdes")
+MODE_SIZES = (1, 2, 3, 1, 0, 1, 1, 1, 1, 1, 2, 3, 2, 1, 2, 2, 1, 1, 2, 2, 1, 1, 2)
+
+# Mnemonic ID, mnemonic
+MNEMONICS = list(INSTRUCTIONS)
+MNEMONIC_IDS = {mne: mne_id for mne_id, mne in enumerate(MNEMONICS)}
+
+# OPCODE_MATRIX[mnemonic ID][addressing mode] is the opcode, -1 if the mode is not supported
+OPCODE_MATRIX = [[getattr(INSTRUCTIONS[mne], attr) for attr in MODE_ATTRS] for mne in MNEMONICS]
+
+# DECODE_TABLE[opcode] is (mnemonic, addressing mode, operand size). Opcodes shared by
+# aliases (DEC A/DEA, INC A/INA) decode to the first mnemonic in INSTRUCTIONS
+DECODE_TABLE = [None] * 256
+for mne_id in range(len(MNEMONICS)):
+    for mode in range(len(MODE_ATTRS)):
+        opcode = OPCODE_MATRIX[mne_id][mode]
+        if opcode != -1 and DECODE_TABLE[opcode] is None:
+            DECODE_TABLE[opcode] = (MNEMONICS[mne_id], mode, MODE_SIZES[mode])
+
+
+# Returns the operand size of an instruction that starts with opcode, -1 for an unknown opcode.
+# al and xl are the register widths for immediate operands
+def operandsize(opcode, al=False, xl=False):
+    decoded = DECODE_TABLE[opcode]
+    if decoded is None:
+        return -1
+    mne, mode, size = decoded
+    reg = INSTRUCTIONS[mne].reg
+    if mode == AM_IMMD and ((reg == "A" and al) or (reg == "X" and xl)):
+        size += 1
+    return size
+
+
+# Operand format of each addressing mode, {0} is the operand value
+MODE_FORMATS = ("#${0:0{1}X}", "${0:04X}", "${0:06X}", "${0:02X}", "", "(${0:02X}),y", "[${0:02X}],y", "(${0:02X},x)", "${0:02X},x",
+                "${0:02X},y", "${0:04X},x", "${0:06X},x", "${0:04X},y", "${0:04X}", "${0:04X}", "(${0:04X})", "(${0:02X})",
+                "[${0:02X}]", "[${0:04X}]", "(${0:04X},x)", "${0:02X},s", "(${0:02X},s),y", "")
+
+
+# Disassembles data loaded at addr. Returns a list of (ADDR, BYTES, TEXT), one per instruction.
+# Register widths start at al and xl and follow REP and SEP instructions
+def disassemble(data, addr, al=False, xl=False):
+    lines = []
+    i = 0
+    while i < len(data):
+        opcode = data[i]
+        size = operandsize(opcode, al, xl)
+        if size == -1 or i + 1 + size > len(data):   # Unknown or cut off
+            lines.append((addr + i, bytes(data[i:i+1]), f".byte ${opcode:02X}"))
+            i += 1
+            continue
+
+        mne, mode, _ = DECODE_TABLE[opcode]
+        operand = int.from_bytes(bytes(data[i+1:i+1+size]), "little")
+        if mode == AM_REL8:
+            operand = (addr + i + 2 + operand - (0x100 if operand & 0x80 else 0)) & 0xffff
+        elif mode == AM_REL16:
+            operand = (addr + i + 3 + operand - (0x10000 if operand & 0x8000 else 0)) & 0xffff
+        elif mode == AM_IMMD and mne == "REP":
+            al = al or bool(operand & 0x20)
+            xl = xl or bool(operand & 0x10)
+        elif mode == AM_IMMD and mne == "SEP":
+            al = al and not (operand & 0x20)
+            xl = xl and not (operand & 0x10)
+
+        if mode == AM_SRCDES:
+            text = f"{mne} ${data[i+2]:02X},${data[i+1]:02X}"
+        elif mode == AM_IMPD:
+            text = mne
+        else:
+            text = f"{mne} {MODE_FORMATS[mode].format(operand, size * 2)}"
+        lines.append((addr + i, bytes(data[i:i+1+size]), text))
+        i += 1 + size
+    return lines
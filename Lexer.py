@@ -0,0 +1,91 @@
+# Single-pass line classifier for the preprocessor
+
+import re
+
+# Prepressor directive character
+PREPROC_CHAR = '#'
+
+# Token kinds
+DIRECTIVE = 0
+CODE = 1
+
+# Everything up to the first ';' that is not inside a quote (either quote character toggles quoting)
+re_semicolon = re.compile(r"""(?:[^;"']+|["'][^"']*["']?)*""")
+re_directive = re.compile(f"^{PREPROC_CHAR}\\W*(endif|ifdef|ifndef|undef|include|define|once)", flags=re.IGNORECASE)
+
+
+class Token:
+    def __init__(self, kind, line_num, line, text, directive="", args=""):
+        self.kind = kind
+        self.line_num = line_num
+        self.line = line            # Unmodified line (for use in syntax warning/error messages)
+        self.text = text            # Line with comments removed
+        self.directive = directive  # Lowercase directive name (DIRECTIVE only)
+        self.args = args            # Everything after the directive name (DIRECTIVE only)
+
+
+# Classifies each line of a file as a directive or code, dropping blank lines and comments
+# Line numbers in the returned tokens match the line numbers in the file
+def lex(lines):
+    tokens = []
+    line_num = 0
+    in_multi_comment = False
+
+    for line in lines:
+        line_num += 1
+
+        text = line
+        if ';' in text:
+            text = re_semicolon.match(text).group() # Ignore comments
+        text = text.strip()
+
+        # Ignore blank lines
+        if text == "":
+            continue
+
+        # Other form of single-line comments uses '//'
+        if text.startswith("//"):
+            continue
+
+        # */ - MUST be at beginning of line
+        if text.startswith("*/"):
+            in_multi_comment = False
+            continue
+
+        # /* - MUST be at beginning of line
+        if text.startswith("/*"):
+            if not text.endswith("*/"):
+                in_multi_comment = True
+            continue
+
+        # Ignore anything within a multi-line comment
+        if in_multi_comment:
+            continue
+
+        # Remove end-of-line comments
+        text = text.split("//")[0]
+
+        match = re_directive.match(text)
+        if match:
+            tokens.append(Token(DIRECTIVE, line_num, line.rstrip(), text, match.group(1).lower(), text[match.end():]))
+        else:
+            tokens.append(Token(CODE, line_num, line.rstrip(), text))
+
+    return tokens
+
+
+# Reads and classifies a file. Raises FileNotFoundError if the file does not exist
+# If a cache is given (FILENAME, (contents, tokens)), a file is only lexed again if its contents changed
+def lexfile(filename, cache=None):
+    with open(filename, "r") as file:
+        if cache is None:
+            return lex(file)
+        lines = file.readlines()
+
+    text = "".join(lines)
+    entry = cache.get(filename)
+    if entry is not None and entry[0] == text:
+        return entry[1]
+    tokens = lex(lines)
+    cache[filename] = (text, tokens)
+    return tokens
@@ -3,21 +3,619 @@
 from numpy import block
 from FileLine import FileLine
 from Msg import *
+from collections import deque
 import re
 
 ASM_MACRO_CHAR = '!'
 
+# Label definitions local to a macro expansion ('__name:')
+re_local_label = re.compile(r"__[a-zA-Z0-9_\.]*\W*:")
+
 class Macro:
     def __init__(self, name, lines, args):
         self.name = name
         self.lines = lines
         self.args = args
+        self.template = []      # MacroLine for each line, built by compilemacro()
+        self.labels = []        # Local labels defined in lines without arguments
+        self.re_labels = None   # Matches any of labels
+        self.cacheable = False  # Lines without arguments only use conditionals
+        self.line_ops = []      # Compiled ops of each line, see compileops()
+
+
+# A line of a macro body split into slots. Even entries of segments are literal text and odd
+# entries are either an argument index (hasargs) or a local label
+class MacroLine:
+    def __init__(self, text, segments, hasargs, labels):
+        self.text = text            # Line as written in the macro
+        self.segments = segments
+        self.hasargs = hasargs
+        self.labels = labels        # Local labels defined by the line (lines without arguments only)
+        self.ops = compileops(segments if hasargs else [text])
+
+
+# Returns a regex matching any of the local labels
+def compilelabels(labels):
+    names = sorted(set(labels), key=len, reverse=True) # Longest first so a label does not match part of another
+    return re.compile(r"\b(?:" + "|".join(re.escape(l) for l in names) + r")\b")
+
+
+# Splits text on the matches of a regex. Odd entries of the result are the matched text
+def splitslots(regex, text):
+    segments = []
+    start = 0
+    for match in regex.finditer(text):
+        segments.append(text[start:match.start()])
+        segments.append(match.group(0))
+        start = match.end()
+    segments.append(text[start:])
+    return segments
+
+
+# Builds the argument and local label slots of a macro's lines
+def compilemacro(mac):
+    re_args = None
+    if len(mac.args) > 0:
+        names = sorted(mac.args, key=len, reverse=True)
+        re_args = re.compile("(?:" + "|".join(re.escape(a) for a in names) + ")(?![a-zA-Z0-9_])")
+
+    # Fill in arguments first, since they may form labels
+    mac.template = []
+    mac.labels = []
+    for text in mac.lines:
+        segments = [text]
+        if re_args is not None:
+            segments = splitslots(re_args, text)
+        if len(segments) > 1:
+            for i in range(1, len(segments), 2):
+                segments[i] = mac.args.index(segments[i])
+            mac.template.append(MacroLine(text, segments, True, []))
+        else:
+            labels = [m[:-1] for m in re_local_label.findall(text)]
+            mac.labels += labels
+            mac.template.append(MacroLine(text, segments, False, labels))
+
+    # Macros using the stack or variables in lines without arguments are never reused
+    mac.cacheable = True
+    for ml in mac.template:
+        if not ml.hasargs:
+            for (op, bang, length) in ml.ops:
+                if op not in (MOP_IF, MOP_IFVAR, MOP_ENDIF, MOP_ELSE):
+                    mac.cacheable = False
+
+    mac.line_ops = [ml.ops for ml in mac.template]
+
+    mac.re_labels = None
+    if len(mac.labels) > 0:
+        mac.re_labels = compilelabels(mac.labels)
+        for ml in mac.template:
+            if not ml.hasargs:
+                ml.segments = splitslots(mac.re_labels, ml.text)
+
+
+# Fills in a macro's argument slots for one invocation. Returns the expanded lines split into
+# local label slots (odd entries are label names) and every local label definition, in the order
+# the labels are numbered
+def expandmacro(mac, args):
+    texts = []
+    labels = []
+    for ml in mac.template:
+        if ml.hasargs:
+            text = "".join([args[s] if i % 2 else s for (i, s) in enumerate(ml.segments)])
+            if "__" in text:
+                labels += [m[:-1] for m in re_local_label.findall(text)]
+            texts.append(text)
+        else:
+            labels += ml.labels
+            texts.append(None)
+
+    if len(labels) == 0:
+        return ([[ml.text] if t is None else [t] for (ml, t) in zip(mac.template, texts)], labels)
+
+    # Lines without arguments can use their label slots unless an argument introduced another label
+    static = set(labels) == set(mac.labels)
+    if static:
+        re_labels = mac.re_labels
+    else:
+        re_labels = compilelabels(labels)
+
+    segments = []
+    for (ml, text) in zip(mac.template, texts):
+        if text is None and static:
+            segments.append(ml.segments)
+        else:
+            segments.append(splitslots(re_labels, ml.text if text is None else text))
+    return (segments, labels)
+
+
+# Numbers the local labels of an expanded macro starting at label_num.
+# Returns the lines and the next free label number
+def numbermacro(expansion, label_num):
+    (segments, labels) = expansion
+    if len(labels) == 0:
+        return ([s[0] for s in segments], label_num)
+
+    local_labels = {}
+    for l in labels:
+        local_labels[l] = f"{l}_{label_num}"
+        label_num += 1
+    lines = ["".join([local_labels[s] if i % 2 else s for (i, s) in enumerate(seg)]) for seg in segments]
+    return (lines, label_num)
+
+
+# Returns the names of the macro variables that an expansion's lines depend on, or None if
+# the lines use the macro stack, change variables, print anything, or compare local labels.
+# Only expansions that are not None can be reused for identical invocations
+def getmemovars(expansion, lines, line_ops, mac_ops):
+    var_names = []
+    for (seg, text, ops) in zip(expansion[0], lines, line_ops):
+        if ops is None:
+            ops = getops(text, mac_ops)
+        elif ops:
+            ops = placeops(ops, text)
+        for (op, start, end) in ops:
+            if op not in (MOP_IF, MOP_IFVAR, MOP_ENDIF, MOP_ELSE) or len(seg) > 1:
+                return None
+            if op == MOP_IFVAR:
+                args = text[end:].split()
+                if len(args) > 0:
+                    var_names.append(args[0])
+    return tuple(var_names)
+
+
+# Macro directives, in the order they are checked for on each expanded line
+MOP_MPOPD = 0
+MOP_MPEEK = 1
+MOP_MPEEK_KEY = 2
+MOP_MPOP = 3
+MOP_MPUSH = 4
+MOP_MTEST = 5
+MOP_MROT = 6
+MOP_MSWAP = 7
+MOP_MDUPI = 8
+MOP_MDROP = 9
+MOP_MSTACKDUMP = 10
+MOP_IF = 11
+MOP_IFVAR = 12
+MOP_ENDIF = 13
+MOP_ELSE = 14
+MOP_FAIL = 15
+MOP_WARN = 16
+MOP_SETVAR = 17
+MOP_MVARDUMP = 18
+
+re_mops = [
+    re.compile(rf"{ASM_MACRO_CHAR}\bmpopd\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmpeek\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmpeek_key\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmpop\b", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bmpush\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmtest\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmrot\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmswap\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmdupi\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmdrop\b", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmstackdump\b", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bif\b", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bifvar\b", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bendif", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\belse", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bfail", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bwarn", flags=re.IGNORECASE),
+    re.compile(rf"^{ASM_MACRO_CHAR}\bsetvar", flags=re.IGNORECASE),
+    re.compile(rf"{ASM_MACRO_CHAR}\bmvardump\b", flags=re.IGNORECASE),
+]
+
+# The substitutions done by MPOPD, MPEEK and MPEEK_KEY are case sensitive
+re_mpopd_sub = re.compile(rf"{ASM_MACRO_CHAR}\bmpopd\b")
+re_mpeek_sub = re.compile(rf"{ASM_MACRO_CHAR}\bmpeek\b")
+re_mpeek_key_sub = re.compile(rf"{ASM_MACRO_CHAR}\bmpeek_key\b")
+
+# A directive name cut off by the end of a segment, which an argument could complete
+re_mop_partial = re.compile(rf"{ASM_MACRO_CHAR}\w*$")
+
+# Finds the macro directives in a macro line when the macro is compiled. Takes the line's segments,
+# literal text with argument slots between. Returns (MOP, BANG, LENGTH) for each directive, in the
+# order they are handled, where BANG is the number of '!'s before it. This finds the directive in
+# any expansion of the line whose arguments add no '!'. Returns None if an argument next to a
+# directive could change whether it matches, so the expanded line has to be scanned
+def compileops(segments):
+    if not any(ASM_MACRO_CHAR in segments[i] for i in range(0, len(segments), 2)):
+        return []
+    found = {}  # MOP, (BANG, LENGTH)
+    bangs = 0
+    for i in range(0, len(segments), 2):
+        text = segments[i]
+        slot_next = i < len(segments) - 1
+        if slot_next and re_mop_partial.search(text):
+            return None
+        for op in range(len(re_mops)):
+            if op in found:
+                continue
+            match = re_mops[op].search(text)
+            if match is None:
+                continue
+            if i > 0 and re_mops[op].pattern.startswith("^"):
+                # Only at the start of the line if the arguments before it are empty
+                if all(segments[k] == "" for k in range(0, i, 2)):
+                    return None
+                continue
+            if slot_next and match.end() == len(text) and re_mops[op].pattern.endswith(r"\b"):
+                return None
+            found[op] = (bangs + text.count(ASM_MACRO_CHAR, 0, match.start()), match.end() - match.start())
+        bangs += text.count(ASM_MACRO_CHAR)
+    return [(op, bang, length) for (op, (bang, length)) in sorted(found.items())]
+
+
+# Returns the (MOP, start, end) of the ops compiled for a macro line in its expanded text
+def placeops(ops, text):
+    bangs = [text.find(ASM_MACRO_CHAR)]    # Position of each '!' up to the last one an op starts at
+    placed = []
+    for (op, bang, length) in ops:
+        while len(bangs) <= bang:
+            bangs.append(text.find(ASM_MACRO_CHAR, bangs[-1] + 1))
+        placed.append((op, bangs[bang], bangs[bang] + length))
+    return placed
+
+
+# Returns the (MOP, start, end) of each macro directive in a line, in the order they are handled.
+# Only ops after first_op are returned. The ops found in each line are kept in mac_ops
+def getops(text, mac_ops, first_op=-1):
+    if ASM_MACRO_CHAR not in text:  # Every directive starts with '!'
+        return []
+    ops = mac_ops.get(text)
+    if ops is None:
+        ops = []
+        for op in range(len(re_mops)):
+            match = re_mops[op].search(text)
+            if match:
+                ops.append((op, match.start(), match.end()))
+        mac_ops[text] = ops
+    if first_op >= 0:
+        return [o for o in ops if o[0] > first_op]
+    return ops
+
+
+# Runs the macro stack and conditional assembly directives in the expanded lines of a macro
+# invoked by line. line_ops holds the compiled ops of each line, or None for lines that have to
+# be scanned. Directive lines are blanked and lines in false blocks are removed
+def runops(temp_lines, line_ops, line, mac_stack, mac_vars, mac_ops, diagnostics):
+    pmsg = diagnostics.pmsg
+    block_level = 0
+    block_use_stack = []
+    for i in range(len(temp_lines)):
+        # MPEEK and MPEEK_KEY must come after MPOPD in the order of operations
+        # This is to guarantee the ability to substitute a peeked value into the
+        # other stack operators and for popd to substitute before the substitution
+        # performed by peek
+        text = temp_lines[i]
+        ops = line_ops[i]
+        if ops is None:
+            ops = getops(text, mac_ops)
+        elif ops:
+            ops = placeops(ops, text)
+        k = 0
+        while k < len(ops):
+            (op, start, end) = ops[k]
+            k += 1
+            active = block_level == 0 or (block_level > 0 and block_use_stack[-1])
+            new_text = text
+
+            # MPOPD - Macro Pop (and Don't care about key)
+            if op == MOP_MPOPD:
+                if active:
+                    if len(mac_stack) == 0:
+                        pmsg(ERROR, "Attempted popa from empty macro stack", line)
+                    else:
+                        val = mac_stack.pop()   # Replace !mpop with a some string
+                        s = str(list(val.values())[0])
+                        new_text = re_mpopd_sub.sub(s, text)
+
+            # MPEEK - Get the top of stack without popping
+            elif op == MOP_MPEEK:
+                if len(mac_stack) == 0:
+                    pmsg(ERROR, "Attempted peek from empty macro stack", line)
+                else:
+                    val = mac_stack[-1]
+                    new_text = re_mpeek_sub.sub(str(list(val.values())[0]), text)
+
+            # MPEEK_KEY - Get the top key on the stack without popping
+            elif op == MOP_MPEEK_KEY:
+                if len(mac_stack) == 0:
+                    pmsg(ERROR, "Attempted peek key from empty macro stack", line)
+                else:
+                    val = mac_stack[-1]
+                    new_text = re_mpeek_key_sub.sub(str(list(val.keys())[0]), text)
+
+            # MPOP
+            elif op == MOP_MPOP:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 1:
+                        pmsg(ERROR, f"Expected 1 argument to !mpop, got {len(args)}", line)
+                    elif len(mac_stack) == 0:
+                        pmsg(ERROR, "Attempted pop from empty macro stack", line)
+                    else:
+                        val = mac_stack.pop()
+                        if not args[0] in val:
+                            pmsg(ERROR, f"Mismatched macro stack key identifier. Got '{args[0]}' but expected '{list(val.keys())[0]}'", line)
+                        elif val[args[0]] == None: # No label given in mpush, don't convert line
+                            text = f"{text[:start]}"
+                        else:   # Replace !mpop with a label
+                            text = f"{text[:start]}{val[args[0]]}"
+                    break
+
+            # MPUSH
+            elif op == MOP_MPUSH:
+                if active:
+                    args = text[end:].split()
+                    len_args = len(args)
+                    if len_args < 1 or len_args > 2:
+                        pmsg(ERROR, f"Expected 1-2 arguments for !mpush, got {len_args}", line)
+                    else:
+                        elem = {args[0]:None}
+                        if len_args == 2:
+                            elem[args[0]] = args[1] # Assign value to label name
+                        mac_stack.append(elem)
+                        text = ""
+                    break
+
+            # MTEST - Check the top of the stack without popping (basically an ASSERT)
+            elif op == MOP_MTEST:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 1:
+                        pmsg(ERROR, f"Expected 1 argument to !mtest, got {len(args)}", line)
+                    elif len(mac_stack) == 0:
+                        pmsg(ERROR, "Attempted test on empty macro stack", line)
+                    else:
+                        val = mac_stack[-1]
+                        if not args[0] in val:
+                            pmsg(ERROR, f"Mismatched macro stack key identifier. Got '{args[0]}' but expected '{list(val.keys())[0]}'", line)
+                        else: # Hide line from assembler
+                            text = ""
+                    break
+
+            # MROT - Rotate the top three elements on the macro stack ( 1 2 3 ==> 2 3 1)
+            elif op == MOP_MROT:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 0:
+                        pmsg(ERROR, f"Expected 0 arguments to !mrot, got {len(args)}", line)
+                    elif len(mac_stack) < 3:
+                        pmsg(ERROR, "Attempted rotate on short macro stack", line)
+                    else:
+                        val = mac_stack[-3]
+                        mac_stack[-3] = mac_stack[-2]
+                        mac_stack[-2] = mac_stack[-1]
+                        mac_stack[-1] = val
+                        text = "" # Hide line from assembler
+                    break
+
+            # MSWAP - Swap the top two elements on the macro stack
+            elif op == MOP_MSWAP:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 0:
+                        pmsg(ERROR, f"Expected 0 arguments to !mswap, got {len(args)}", line)
+                    elif len(mac_stack) < 2:
+                        pmsg(ERROR, "Attempted swap on short macro stack", line)
+                    else:
+                        val = mac_stack[-1]
+                        mac_stack[-1] = mac_stack[-2]
+                        mac_stack[-2] = val
+                        text = "" # Hide line from assembler
+                    break
+
+            # MDUPI - Duplicate a stack item at an index to the top of the stack
+            elif op == MOP_MDUPI:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 1:
+                        pmsg(ERROR, f"Expected 1 argument to !mdupi, got {len(args)}", line)
+                    elif not args[0].isdigit():
+                        pmsg(ERROR, f"Expected base-10 number for !mdupi, got '{args[0]}'", line)
+                    elif len(mac_stack) < int(args[0], 10)+1:
+                        pmsg(ERROR, "Attempted dupi on short macro stack", line)
+                    else:
+                        mac_stack.append(mac_stack[-int(args[0], 10)-1])
+                        text = "" # Hide line from assembler
+                    break
+
+            # MDROP - Remove the top element from the macro stack
+            elif op == MOP_MDROP:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 0:
+                        pmsg(ERROR, f"Expected 0 arguments to !mdrop, got {len(args)}", line)
+                    elif len(mac_stack) == 0:
+                        pmsg(ERROR, "Attempted drop from empty macro stack", line)
+                    else:
+                        mac_stack.pop()
+                        text = ""
+                    break
+
+            # MSTACKDUMP - Print the entire macro stack
+            elif op == MOP_MSTACKDUMP:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 0:
+                        pmsg(ERROR, f"Expected 0 arguments to !mstackdump, got {len(args)}", line)
+
+                    dump_text = "MACRO STACK DUMP:\n"
+                    for f in mac_stack:
+                        key = str(list(f.keys())[0])
+                        val = list(f.values())[0]
+                        l = len(key)
+                        dump_text += f"{key} {(16-l)*'.'} : {val}\n"
+
+                    pmsg(INFO, dump_text, line)
+
+                    text = ""
+                    break
+
+            # IF
+            elif op == MOP_IF:
+                args = text[end:].split()
+                len_args = len(args)
+                if len_args != 3:
+                    print(args, text)
+                    pmsg(ERROR, f"Expected 3 arguments to !if, got {len(args)}", line)
+                else:
+                    block_level += 1
+                    text = ""
+                    if block_level > 1 and not block_use_stack[-1]:
+                        block_use_stack.append(False)
+                    elif args[1] == "==":
+                        if args[0] == args[2]:
+                            block_use_stack.append(True)
+                        else:
+                            block_use_stack.append(False)
+                    elif args[1] == "!=":
+                        if args[0] != args[2]:
+                            block_use_stack.append(True)
+                        else:
+                            block_use_stack.append(False)
+                    else:
+                        pmsg(ERROR, f"Unknown macro comparison operator '{args[1]}'", line)
+                        block_use_stack.append(False)
+                break
+
+            # IFVAR
+            elif op == MOP_IFVAR:
+                args = text[end:].split()
+                len_args = len(args)
+                if len_args != 3:
+                    pmsg(ERROR, f"Expected 3 arguments to !ifvar, got {len(args)}", line)
+                else:
+                    block_level += 1
+                    text = ""
+                    if block_level > 1 and not block_use_stack[-1]:
+                        block_use_stack.append(False)
+                    else:
+                        if args[0] not in mac_vars:
+                            pmsg(WARN, f"Unset macro variable '{args[0]}', defaulting to FALSE", line)
+                            block_use_stack.append(False)
+                        else:
+                            if args[1] == "==":
+                                if mac_vars[args[0]] == args[2]:
+                                    block_use_stack.append(True)
+                                else:
+                                    block_use_stack.append(False)
+                            elif args[1] == "!=":
+                                if mac_vars[args[0]] != args[2]:
+                                    block_use_stack.append(True)
+                                else:
+                                    block_use_stack.append(False)
+                            else:
+                                pmsg(ERROR, f"Unknown macro comparison operator '{args[1]}'", line)
+                                block_use_stack.append(False)
+                break
+
+            # ENDIF
+            elif op == MOP_ENDIF:
+                args = text[end:].split()
+                len_args = len(args)
+                if len_args != 0:
+                    pmsg(ERROR, f"Expected 0 arguments to !endif, got {len(args)}", line)
+                elif block_level == 0:
+                    pmsg(ERROR, f"Encountered end of block when not in block", line)
+                else:
+                    block_level -= 1
+                    block_use_stack.pop()
+                    text = ""
+                break
+
+            # ELSE
+            elif op == MOP_ELSE:
+                args = text[end:].split()
+                len_args = len(args)
+                if len_args != 0:
+                    pmsg(ERROR, f"Expected 0 arguments to !else, got {len(args)}", line)
+                elif block_level == 0:
+                    pmsg(ERROR, f"Encountered !else when not in block", line)
+                else:
+                    text = ""
+                    if block_level == 1 or (block_level > 1 and block_use_stack[-2]):
+                        # Invert the use stack value
+                        val = not block_use_stack.pop()
+                        block_use_stack.append(val)
+                break
+
+            # FAIL
+            elif op == MOP_FAIL:
+                if active:
+                    msg = text[end:].strip()
+                    if msg != "":
+                        pmsg(ERROR, f"Encountered !FAIL\n\tMessage: '{msg}'", line)
+                    else:
+                        pmsg(ERROR, f"Encountered !FAIL", line)
+
+            # WARN
+            elif op == MOP_WARN:
+                if active:
+                    msg = text[end:].strip()
+                    if msg != "":
+                        pmsg(WARN, f"Encountered !WARN\n\tMessage: '{msg}'", line)
+                    else:
+                        pmsg(WARN, f"Encountered !WARN", line)
+                    text = ""
+                    break
+
+            # SETVAR
+            elif op == MOP_SETVAR:
+                if active:
+                    args = text[end:].split()
+                    len_args = len(args)
+                    if len_args != 2:
+                        pmsg(ERROR, f"Expected 2 arguments to !setvar, got {len(args)}", line)
+                    else:
+                        mac_vars[args[0]] = args[1]
+                        new_text = ""
+
+            # MVARDUMP - Print all macro variables
+            elif op == MOP_MVARDUMP:
+                if active:
+                    args = text[end:].split()
+                    if len(args) != 0:
+                        pmsg(ERROR, f"Expected 0 arguments to !mvardump, got {len(args)}", line)
+
+                    dump_text = "MACRO VARIABLE DUMP:\n"
+                    for (key, val) in mac_vars.items():
+                        l = len(key)
+                        dump_text += f"{key} {(16-l)*'.'} : {val}\n"
+
+                    pmsg(INFO, dump_text, line)
+
+                    text = ""
+                    break
+
+            # Later directives are looked for in the changed line
+            if new_text != text:
+                text = new_text
+                ops = getops(text, mac_ops, op)
+                k = 0
+
+        else:
+            # Done checking for structure, now handle including of lines
+            if block_level > 0 and not block_use_stack[-1]:
+                text = ""
+
+        temp_lines[i] = text
 
+    if block_level != 0:
+        pmsg(ERROR, "Unbalanced macro stack at end", line)
 
-def process(lines):
 
+# Expands macros and enums. Takes an iterable of FileLines and yields the resulting FileLines.
+# Messages are reported to diagnostics
+def process(lines, diagnostics):
+    pmsg = diagnostics.pmsg
+    source = deque()    # Every line has to be seen before expanding since macros may be forward referenced
     in_mac = False
-    macs = []
+    mac_ops = {}    # Line text, (MOP, start, end) of each directive found by getops(). Only kept for one assembly
+    macs = {}   # NAME, Macro (the first definition of a name is the one used)
+    mac = None
     in_enum = False
     enum_val = 0
     enum_base = 0
@@ -26,6 +624,7 @@ def process(lines):
 
     # Perform macro/enum search
     for line in lines:
+        source.append(line)
         content = line.ppline
 
         # ENUM was found, update its contents
@@ -50,7 +649,7 @@ def process(lines):
             if content == "}":  # Detect end of macro
                 in_mac = False
             else:               # Otherwise, add the line to the macro's contents
-                macs[-1].lines.append(content)
+                mac.lines.append(content)
             continue
 
         # Found an ENUM, add it to table
@@ -60,7 +659,7 @@ def process(lines):
             enum_base = 0
             bargs = content[match.span()[1]:].split()
 
-            if len(bargs) < 2:
+            if len(bargs) < 1:
                 pmsg(ERROR, "Expected opening bracket for enum", line)
 
             # There's args for the enum, then the user specified an enum identifier
@@ -88,7 +687,7 @@ def process(lines):
                             pmsg(WARN, "Enum name does not require '@'. Did you mean to use a macro?", line)
                         enum_name = bargs[i]
 
-            if len_bargs == 1 and bargs[1] != '{':
+            if len_bargs == 1 and bargs[0] != '{':
                 pmsg(ERROR, "Missing opening bracket on enum", line)
 
             in_enum = True
@@ -100,8 +699,13 @@ def process(lines):
         match = re.search(f"^{ASM_MACRO_CHAR}\W*macro", content, flags=re.IGNORECASE)
         if match:
             macro = content[match.span()[1]:].split(maxsplit=1)
+            if len(macro) == 0:
+                pmsg(ERROR, "Expected name for macro", line)
+                line.ismacdef = True
+                continue
             if len(macro) < 2:
                 pmsg(ERROR, "Expected opening bracket for macro", line)
+                macro.append("{")   # The macro's lines still follow
 
             bargs = macro[1].split()
             args = []
@@ -123,429 +727,129 @@ def process(lines):
             if len_bargs == 1 and macro[1] != '{':
                 pmsg(ERROR, "Missing opening bracket on macro", line)
             in_mac = True
-            macs.append(Macro(macro[0], [], args))
+            mac = Macro(macro[0], [], args)
+            if mac.name not in macs:
+                macs[mac.name] = mac
             line.ismacdef = True
             # print(macro[0], args)  # DEBUG
             continue
 
+    for mac in macs.values():
+        compilemacro(mac)
+
     # DEBUG
     # print("MACS FOUND")
-    # for mac in macs:
+    # for mac in macs.values():
     #     print(mac.name, mac.lines, mac.args)
     # END DEBUG
 
     # Perform macro/enum replacement
-    new_lines = []
     mac_label_num = 0
     mac_stack = []
     mac_vars = {}
-    for line in lines:
-        new_lines.append(line)
-
+    mac_memo = {}   # (NAME, args), False if not reusable or (variable names, {variable values: (expansion, kept lines)})
+    # Lines are dropped as they are passed on, so they are not held here and by the caller at once
+    while len(source) > 0:
+        line = source.popleft()
         if line.ismacdef:   # Don't try replacement on macro definition lines (Can't have nested macros)
+            yield line
             continue
 
         content = line.ppline
-        for mac in macs:
-            # if line is a macro, perform a replacement
-            if re.search(rf'\b{mac.name}\b', content):
-                parts = content.split(maxsplit=1)
-                macro = parts[0]
-                # print(mac.args, len(mac.args), len(parts)) # DEBUG
-
-                # Only handle argument substitution if the macro has arguments
-                args = []
-                if len(mac.args) > 0:
-                    if len(parts) < 2:
-                        pmsg(ERROR, f"Macro '{mac.name}' expected args but none were given", line)
-                    else:
-                        # args = parts[1].split() # ','
-                        args = re.split("\s+(?![^\(]*\))", parts[1]) # Don't split on whitespace inside single level ()'s
-                elif len(mac.args) == 0 and len(parts) > 1:
-                    pmsg(ERROR, f"Macro '{mac.name}' expected no arguments but some were given", line)
-
-                if len(args) != len(mac.args):
-                    pmsg(ERROR, f"Macro '{mac.name}' expected {len(mac.args)} args, got {len(args)}", line)
-
-                for i in range(len(args)):
-                    args[i] = args[i].strip()
-                    if ' ' in args[i]:
-                        pmsg(WARN, f"Whitespace detected in macro argument '{args[i]}',\n\t this may not be the intended value", line)
-
-                # We now have the args being passed, do the text replacement
-                temp_lines = mac.lines.copy()
-                for i in range(len(mac.lines)):
-                    for j in range(len(mac.args)):
-                        temp_lines[i] = re.sub(mac.args[j], repr(args[j])[1:-1], temp_lines[i]) # Note the (terrible) use of repr[1:-1]
-
-                # Find local labels
-                local_labels = {}
-                for l in temp_lines: # Build up list of defined labels
-                    matches = re.findall('__[a-zA-Z0-9_\.]*\W*:', l)
-                    if matches:
-                        for m in matches:
-                            local_labels[m[:-1]] = f"{m[:-1]}_{mac_label_num}"
-                            mac_label_num += 1
-
-                # Handle naming of local labels
-                for i in range(len(temp_lines)):
-                    for l in local_labels.keys():
-                        temp_lines[i] = re.sub(rf"\b{l}\b", local_labels[l], temp_lines[i])
-
-                # Handle macro stack and conditional assembly operations
-                block_level = 0
-                block_use_stack = []
-                for i in range(len(temp_lines)):
-                    # MPEEK and MPEEK_KEY must come after MPOPD in the order of operations
-                    # This is to guarantee the ability to substitute a peeked value into the
-                    # other stack operators and for popd to substitute before the substitution
-                    # performed by peek
-
-                    # MPOPD - Macro Pop (and Don't care about key)
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmpopd\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(mac_stack) == 0:
-                                pmsg(ERROR, "Attempted popa from empty macro stack", line)
-                            else:
-                                val = mac_stack.pop()   # Replace !mpop with a some string
-                                s = str(list(val.values())[0])
-                                if s == None:
-                                    s = ""
-                                temp_lines[i] = re.sub(rf"{ASM_MACRO_CHAR}\bmpopd\b", s, temp_lines[i])
-                            # continue
-
-                    # MPEEK - Get the top of stack without popping
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmpeek\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if len(mac_stack) == 0:
-                            pmsg(ERROR, "Attempted peek from empty macro stack", line)
-                        else:
-                            val = mac_stack[-1]
-                            temp_lines[i] = re.sub(rf"{ASM_MACRO_CHAR}\bmpeek\b", str(list(val.values())[0]), temp_lines[i])
-                        # continue
-
-                    # MPEEK_KEY - Get the top key on the stack without popping
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmpeek_key\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        args = temp_lines[i][match.span()[1]:].split()
-                        if len(mac_stack) == 0:
-                            pmsg(ERROR, "Attempted peek key from empty macro stack", line)
-                        else:
-                            val = mac_stack[-1]
-                            temp_lines[i] = re.sub(rf"{ASM_MACRO_CHAR}\bmpeek_key\b", str(list(val.keys())[0]), temp_lines[i])
-                        # continue
-
-                    # MPOP
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmpop\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 1:
-                                pmsg(ERROR, f"Expected 1 argument to !mpop, got {len(args)}", line)
-                            elif len(mac_stack) == 0:
-                                pmsg(ERROR, "Attempted pop from empty macro stack", line)
-                            else:
-                                val = mac_stack.pop()
-                                if not args[0] in val:
-                                    pmsg(ERROR, f"Mismatched macro stack key identifier. Got '{args[0]}' but expected '{list(val.keys())[0]}'", line)
-                                elif val[args[0]] == None: # No label given in mpush, don't convert line
-                                    temp_lines[i] = f"{temp_lines[i][:match.span()[0]]}"
-                                else:   # Replace !mpop with a label
-                                    temp_lines[i] = f"{temp_lines[i][:match.span()[0]]}{val[args[0]]}"
-                            continue
-
-                    # MPUSH
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bmpush\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            len_args = len(args)
-                            if len_args < 1 or len_args > 2:
-                                pmsg(ERROR, f"Expected 1-2 arguments for !mpush, got {len_args}", line)
-                            else:
-                                elem = {args[0]:None}
-                                if len_args == 2:
-                                    elem[args[0]] = args[1] # Assign value to label name
-                                mac_stack.append(elem)
-                                temp_lines[i] = ""
-                            continue
-
-                    # MTEST - Check the top of the stack without popping (basically an ASSERT)
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmtest\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 1:
-                                pmsg(ERROR, f"Expected 1 argument to !mtest, got {len(args)}", line)
-                            elif len(mac_stack) == 0:
-                                pmsg(ERROR, "Attempted test on empty macro stack", line)
-                            else:
-                                val = mac_stack[-1]
-                                if not args[0] in val:
-                                    pmsg(ERROR, f"Mismatched macro stack key identifier. Got '{args[0]}' but expected '{list(val.keys())[0]}'", line)
-                                else: # Hide line from assembler
-                                    temp_lines[i] = ""
-                            continue
-
-                    # MROT - Rotate the top three elements on the macro stack ( 1 2 3 ==> 2 3 1)
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmrot\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 0:
-                                pmsg(ERROR, f"Expected 0 arguments to !mrot, got {len(args)}", line)
-                            elif len(mac_stack) < 3:
-                                pmsg(ERROR, "Attempted rotate on short macro stack", line)
-                            else:
-                                val = mac_stack[-3]
-                                mac_stack[-3] = mac_stack[-2]
-                                mac_stack[-2] = mac_stack[-1]
-                                mac_stack[-1] = val
-                                temp_lines[i] = "" # Hide line from assembler
-                            continue
-
-                    # MSWAP - Swap the top two elements on the macro stack
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmswap\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 0:
-                                pmsg(ERROR, f"Expected 0 arguments to !mswap, got {len(args)}", line)
-                            elif len(mac_stack) < 2:
-                                pmsg(ERROR, "Attempted swap on short macro stack", line)
-                            else:
-                                val = mac_stack[-1]
-                                mac_stack[-1] = mac_stack[-2]
-                                mac_stack[-2] = val
-                                temp_lines[i] = "" # Hide line from assembler
-                            continue
-
-                    # MDUPI - Duplicate a stack item at an index to the top of the stack
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmdupi\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 1:
-                                pmsg(ERROR, f"Expected 1 argument to !mdupi, got {len(args)}", line)
-                            if not args[0].isdigit():
-                                pmsg(ERROR, f"Expected base-10 number for !mdupi, got '{args[0]}'", line)
-                            val = int(args[0], 10)
-                            if len(mac_stack) < val+1:
-                                pmsg(ERROR, "Attempted dupi on short macro stack", line)
-                            else:
-                                mac_stack.append(mac_stack[-val-1])
-                                temp_lines[i] = "" # Hide line from assembler
-                            continue
-
-                    # MDROP - Remove the top element from the macro stack
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmdrop\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 0:
-                                pmsg(ERROR, f"Expected 0 arguments to !mdrop, got {len(args)}", line)
-                            elif len(mac_stack) == 0:
-                                pmsg(ERROR, "Attempted drop from empty macro stack", line)
-                            else:
-                                mac_stack.pop()
-                                temp_lines[i] = ""
-                            continue
-
-                    # MSTACKDUMP - Print the entire macro stack
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmstackdump\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 0:
-                                pmsg(ERROR, f"Expected 0 arguments to !mstackdump, got {len(args)}", line)
-
-                            dump_text = "MACRO STACK DUMP:\n"
-                            for f in mac_stack:
-                                key = str(list(f.keys())[0])
-                                val = list(f.values())[0]
-                                l = len(key)
-                                dump_text += f"{key} {(16-l)*'.'} : {val}\n"
-
-                            pmsg(INFO, dump_text, line)
-
-                            temp_lines[i] = ""
-                            continue
-
-                    # IF
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bif\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        args = temp_lines[i][match.span()[1]:].split()
-                        len_args = len(args)
-                        if len_args != 3:
-                            print(args, temp_lines[i])
-                            pmsg(ERROR, f"Expected 3 arguments to !if, got {len(args)}", line)
-                        else:
-                            block_level += 1
-                            temp_lines[i] = ""
-                            if block_level > 1 and not block_use_stack[-1]:
-                                block_use_stack.append(False)
-                            elif args[1] == "==":
-                                if args[0] == args[2]:
-                                    block_use_stack.append(True)
-                                else:
-                                    block_use_stack.append(False)
-                            elif args[1] == "!=":
-                                if args[0] != args[2]:
-                                    block_use_stack.append(True)
-                                else:
-                                    block_use_stack.append(False)
-                            else:
-                                pmsg(ERROR, f"Unknown macro comparison operator '{args[1]}'", line)
-                        continue
-
-                    # IFVAR
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bifvar\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        args = temp_lines[i][match.span()[1]:].split()
-                        len_args = len(args)
-                        if len_args != 3:
-                            pmsg(ERROR, f"Expected 3 arguments to !ifvar, got {len(args)}", line)
-                        else:
-                            block_level += 1
-                            temp_lines[i] = ""
-                            if block_level > 1 and not block_use_stack[-1]:
-                                block_use_stack.append(False)
-                            else:
-                                if args[0] not in mac_vars:
-                                    pmsg(WARN, f"Unset macro variable '{args[0]}', defaulting to FALSE", line)
-                                    block_use_stack.append(False)
-                                else:
-                                    if args[1] == "==":
-                                        if mac_vars[args[0]] == args[2]:
-                                            block_use_stack.append(True)
-                                        else:
-                                            block_use_stack.append(False)
-                                    elif args[1] == "!=":
-                                        if mac_vars[args[0]] != args[2]:
-                                            block_use_stack.append(True)
-                                        else:
-                                            block_use_stack.append(False)
-                                    else:
-                                        pmsg(ERROR, f"Unknown macro comparison operator '{args[1]}'", line)
-                        continue
-
-                    # ENDIF
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bendif", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        args = temp_lines[i][match.span()[1]:].split()
-                        len_args = len(args)
-                        if len_args != 0:
-                            pmsg(ERROR, f"Expected 0 arguments to !endif, got {len(args)}", line)
-                        elif block_level == 0:
-                            pmsg(ERROR, f"Encountered end of block when not in block", line)
-                        else:
-                            block_level -= 1
-                            block_use_stack.pop()
-                            temp_lines[i] = ""
-                        continue
-
-                    # ELSE
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\belse", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        args = temp_lines[i][match.span()[1]:].split()
-                        len_args = len(args)
-                        if len_args != 0:
-                            pmsg(ERROR, f"Expected 0 arguments to !else, got {len(args)}", line)
-                        elif block_level == 0:
-                            pmsg(ERROR, f"Encountered !else when not in block", line)
-                        else:
-                            temp_lines[i] = ""
-                            if block_level == 1 or (block_level > 1 and block_use_stack[-2]):
-                                # Invert the use stack value
-                                val = not block_use_stack.pop()
-                                block_use_stack.append(val)
-                        continue
-
-                    # FAIL
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bfail", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            msg = temp_lines[i][match.span()[1]:].strip()
-                            if msg != "":
-                                pmsg(ERROR, f"Encountered !FAIL\n\tMessage: '{msg}'", line)
-                            else:
-                                pmsg(ERROR, f"Encountered !FAIL", line)
-
-                    # WARN
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bwarn", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            msg = temp_lines[i][match.span()[1]:].strip()
-                            if msg != "":
-                                pmsg(WARN, f"Encountered !WARN\n\tMessage: '{msg}'", line)
-                            else:
-                                pmsg(WARN, f"Encountered !WARN", line)
-                            temp_lines[i] = ""
-                            continue
-
-                    # SETVAR
-                    match = re.search(rf"^{ASM_MACRO_CHAR}\bsetvar", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            len_args = len(args)
-                            if len_args != 2:
-                                pmsg(ERROR, f"Expected 2 arguments to !setvar, got {len(args)}", line)
-                            else:
-                                mac_vars[args[0]] = args[1]
-                                temp_lines[i] = ""
-
-                    # MVARDUMP - Print all macro variables
-                    match = re.search(rf"{ASM_MACRO_CHAR}\bmvardump\b", temp_lines[i], flags=re.IGNORECASE)
-                    if match:
-                        if block_level == 0 or (block_level > 0 and block_use_stack[-1]):
-                            args = temp_lines[i][match.span()[1]:].split()
-                            if len(args) != 0:
-                                pmsg(ERROR, f"Expected 0 arguments to !mvardump, got {len(args)}", line)
-
-                            dump_text = "MACRO VARIABLE DUMP:\n"
-                            for (key, val) in mac_vars.items():
-                                l = len(key)
-                                dump_text += f"{key} {(16-l)*'.'} : {val}\n"
-
-                            pmsg(INFO, dump_text, line)
-
-                            temp_lines[i] = ""
-                            continue
-
-                    # Done checking for structure, now handle including of lines
-                    if block_level > 0 and not block_use_stack[-1]:
-                        temp_lines[i] = ""
-
-                if block_level != 0:
-                    pmsg(ERROR, "Unbalanced macro stack at end", line)
-
-                # Get indentation level of original line (for listing file)
-                indent = re.search("^\W*", line.line).span()[1]
-
-                # Handle line replacement for returning to the assembler
-                spacing = 32 # Spaces from start of indent block to mac expansion comment
-                line.ismacdef = True # Ignore original line in assembler
-                line.line = f";{line.line[1:]}"
-                for l in temp_lines:
-                    if l.strip() == "":
-                        continue
-                    tline = FileLine.dupfileline(line)
-                    tline.ppline = l
-                    ind = indent
-                    spa = spacing
-                    if l[:2] == "__":   # Unindent labels one level
-                        ind -= 4
-                        spa += 4
-                    tline.line = f"{' '*ind}{l}{(spa - len(l))*' '}; MAC expansion of '{mac.name}'"
-                    tline.ismacdef = False
-                    new_lines.append(tline)
-
-                break # Done with line, move on to the next
-
-    # for line in new_lines:
-    #     if not line.ismacdef: print(line.ppline)
-    # exit(0)
-    return new_lines
\ No newline at end of file
+        parts = content.split(maxsplit=1)
+
+        # Only lines starting with the name of a macro are invocations
+        mac = None
+        if len(parts) > 0:
+            mac = macs.get(parts[0])
+        if mac is None:
+            yield line
+            continue
+
+        macro = parts[0]
+        # print(mac.args, len(mac.args), len(parts)) # DEBUG
+
+        # Only handle argument substitution if the macro has arguments
+        args = []
+        if len(mac.args) > 0:
+            if len(parts) < 2:
+                pmsg(ERROR, f"Macro '{mac.name}' expected args but none were given", line)
+                continue
+            else:
+                # args = parts[1].split() # ','
+                args = re.split("\s+(?![^\(]*\))", parts[1]) # Don't split on whitespace inside single level ()'s
+        elif len(mac.args) == 0 and len(parts) > 1:
+            pmsg(ERROR, f"Macro '{mac.name}' expected no arguments but some were given", line)
+
+        if len(args) != len(mac.args):
+            pmsg(ERROR, f"Macro '{mac.name}' expected {len(mac.args)} args, got {len(args)}", line)
+            continue
+
+        for i in range(len(args)):
+            args[i] = args[i].strip()
+            if ' ' in args[i]:
+                pmsg(WARN, f"Whitespace detected in macro argument '{args[i]}',\n\t this may not be the intended value", line)
+
+        # Invocations with the same args (and macro variables) give the same lines,
+        # only the local label numbers change
+        key = (mac.name, tuple(args))
+        entry = mac_memo.get(key)
+        hit = None
+        if entry:
+            values = tuple([mac_vars.get(v) for v in entry[0]])
+            if None not in values:  # Unset variables print a warning, so always run them
+                hit = entry[1].get(values)
+
+        if hit is not None:
+            (expansion, keep) = hit
+            (temp_lines, mac_label_num) = numbermacro(expansion, mac_label_num)
+            temp_lines = [l if k else "" for (l, k) in zip(temp_lines, keep)]
+        else:
+            # We now have the args being passed, fill in the macro's argument and local label slots
+            expansion = expandmacro(mac, args)
+            (temp_lines, mac_label_num) = numbermacro(expansion, mac_label_num)
+            line_ops = mac.line_ops
+            if any(ASM_MACRO_CHAR in a for a in args):  # The compiled ops only hold if args add no directives
+                line_ops = [None] * len(temp_lines)
+
+            if entry is None:
+                var_names = None
+                if mac.cacheable:
+                    var_names = getmemovars(expansion, temp_lines, line_ops, mac_ops)
+                entry = False
+                if var_names is not None:
+                    entry = (var_names, {})
+                mac_memo[key] = entry
+            values = None
+            if entry:
+                values = tuple([mac_vars.get(v) for v in entry[0]])
+
+            # Handle macro stack and conditional assembly operations
+            prev_msg_count = diagnostics.count
+            runops(temp_lines, line_ops, line, mac_stack, mac_vars, mac_ops, diagnostics)
+
+            # Expansions that reported anything are run again, so each invocation reports it
+            if entry and None not in values and diagnostics.count == prev_msg_count:
+                entry[1][values] = (expansion, [l != "" for l in temp_lines])
+
+        # Get indentation level of original line (for listing file)
+        indent = re.search("^\W*", line.line).span()[1]
+
+        # Handle line replacement for returning to the assembler
+        spacing = 32 # Spaces from start of indent block to mac expansion comment
+        line.ismacdef = True # Ignore original line in assembler
+        line.line = f";{line.line[1:]}"
+        yield line
+        for l in temp_lines:
+            if l.strip() == "":
+                continue
+            tline = FileLine.dupfileline(line)
+            tline.ppline = l
+            ind = indent
+            spa = spacing
+            if l[:2] == "__":   # Unindent labels one level
+                ind -= 4
+                spa += 4
+            tline.line = f"{' '*ind}{l}{(spa - len(l))*' '}; MAC expansion of '{mac.name}'"
+            tline.ismacdef = False
+            yield tline
@@ -8,20 +8,106 @@ ERROR = 20
 # Another PASS needed
 APASS = True
 
-def pmsg(level, msg, line=None, apass=False):
-    if level == INFO:
-        print(f"{Fore.CYAN}[INFO]{Fore.RESET} {msg}", end="")
-    elif level == WARN:
-        print(f"{Fore.YELLOW}[WARN]{Fore.RESET} {msg}", end="")
-    elif level == ERROR:
-        print(f"{Fore.RED}[ERROR]{Fore.RESET} {msg}", end="")
-
-    if line:
-        print(f" on line {line.line_num} of '{line.filename}':\n{line.line}")
-        if apass:
-            print(" Going for another pass ...")
-
-    print()
-
-    if level == ERROR:
-        exit(-1)
+
+# Raised when an assembly has to stop because of an error, the messages are kept in its Diagnostics
+class StopAssembly(Exception):
+    pass
+
+
+# Raised by pmsg() for an error while recover is set, so the caller can skip the rest
+# of the line and carry on with the next one
+class LineError(Exception):
+    pass
+
+
+class Diagnostic:
+    __slots__ = ("level", "msg", "filename", "line_num", "line", "apass", "count")
+
+    def __init__(self, level, msg, line, apass):
+        self.level = level
+        self.msg = msg
+        self.filename = None
+        self.line_num = 0
+        self.line = None
+        if line:
+            self.filename = line.filename
+            self.line_num = line.line_num
+            self.line = line.line
+        self.apass = apass
+        self.count = 1      # Times the message was reported
+
+    def __str__(self):
+        if self.level == INFO:
+            text = f"{Fore.CYAN}[INFO]{Fore.RESET} {self.msg}"
+        elif self.level == WARN:
+            text = f"{Fore.YELLOW}[WARN]{Fore.RESET} {self.msg}"
+        elif self.level == ERROR:
+            text = f"{Fore.RED}[ERROR]{Fore.RESET} {self.msg}"
+        else:
+            text = ""
+
+        if self.line is not None:
+            text += f" on line {self.line_num} of '{self.filename}':\n{self.line}\n"
+            if self.apass:
+                text += " Going for another pass ...\n"
+            if self.count > 1:
+                text += f" Reported {self.count} times\n"
+        return text
+
+
+# Collects the messages of an assembly so they are only formatted and printed when flushed. A message
+# about a line that was already reported in the same pass is merged into the first one
+class Diagnostics:
+    def __init__(self, max_errors=1):
+        self.max_errors = max_errors    # Errors reported before stopping, 0 for no limit
+        self.errors = 0
+        self.count = 0                  # Number of messages reported, including merged ones
+        self.recover = False
+        self.messages = []              # Diagnostics in the order they were reported
+        self.printed = 0                # Number of messages printed by flush()
+        self.merged = {}                # (LEVEL, MSG, FILENAME, LINE_NUM, LINE), Diagnostic of this pass
+
+    # Returns the new Diagnostic, None if it was merged into an earlier one
+    def add(self, level, msg, line=None, apass=False):
+        self.count += 1
+        key = None
+        if line:
+            key = (level, msg, line.filename, line.line_num, line.line) # Macro expansions share a line number
+            diag = self.merged.get(key)
+            if diag is not None:
+                diag.count += 1
+                return None
+
+        diag = Diagnostic(level, msg, line, apass)
+        if key is not None:
+            self.merged[key] = diag
+        self.messages.append(diag)
+        if level == ERROR:
+            self.errors += 1
+        return diag
+
+    # Messages of a new pass are not merged with the ones of earlier passes
+    def newpass(self):
+        self.merged = {}
+
+    # Reports a message. Errors stop the assembly once max_errors have been reported, or straight
+    # away if they are fatal
+    def pmsg(self, level, msg, line=None, apass=False, fatal=False):
+        self.add(level, msg, line, apass)
+
+        if level == ERROR:
+            if fatal or (self.max_errors > 0 and self.errors >= self.max_errors):
+                raise StopAssembly(msg)
+            if self.recover:
+                raise LineError(msg)
+
+    # Stops the assembly if any errors have been reported
+    def stopiferrors(self):
+        if self.errors > 0:
+            raise StopAssembly(f"{self.errors} error(s)")
+
+    # Prints the messages that have not been printed yet
+    def flush(self):
+        for diag in self.messages[self.printed:]:
+            print(diag)
+        self.printed = len(self.messages)
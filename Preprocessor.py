@@ -1,169 +1,535 @@
 from FileLine import FileLine
 from Msg import *
+import Lexer
 
 import re
 import os
+import hashlib
+import pickle
+import concurrent.futures
 
 # Prepressor directive character
-PREPROC_CHAR = '#'
+PREPROC_CHAR = Lexer.PREPROC_CHAR
 PREPROC_MAX_RECURSION = 7
 PREPROC_MAX_NEST = 7
-
-# Preprocessor
-pre_defines = {}  # DEFINE, VALUE
-pre_recursion_count = 0
-
-
-# Loads in includes
-def preprocess(filename, base_dir="", parentfilename="", parentlinenum=-1):
-    global pre_defines
-    global pre_recursion_count
-    
-    if pre_recursion_count > PREPROC_MAX_RECURSION:
-        pmsg(ERROR, f"Max preprocessor recursion limit reached, check for recursive includes. Last file: {filename}, parent file: {parentfilename}")
-    pre_recursion_count += 1
-
-    file_contents = []
-
-    line_num = 0
-    in_multi_comment = False
-    stack = [] # False for not included, True for included
-    stack.append(True) # Start off including stuff
-
-
+PREPROC_CACHE_VERSION = 3
+PREPROC_CACHE_VARIANTS = 8  # Max number of define states remembered per file
+
+
+# Either a string/char literal (group 1, never substituted) or an identifier (group 2)
+re_define_token = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(?<![A-Za-z0-9_.$])([A-Za-z_.][A-Za-z0-9_.]*)""")
+
+
+# What a cached file read from and did to the preprocessor state while it was being processed
+class IncludeRecord:
+    def __init__(self, pre, filename, parentfilename, base_dir, digest):
+        self.filename = filename
+        self.parentfilename = parentfilename
+        self.base_dir = base_dir
+        self.digest = digest
+        self.defines = dict(pre.defines)          # Define table on entry
+        self.define_index = dict(pre.define_index)
+        self.names = set()  # Every define name looked up (whether or not it was defined)
+        self.deps = []      # (filename, parentfilename, resolved filename, digest) of nested includes
+        self.depth = 0      # Deepest include nesting below this file
+        self.once_reads = {}  # FILENAME, whether it was already included with #once when first checked
+        self.onces = set()    # FILENAMEs marked with #once
+        self.guards = {}      # FILENAME, (include guard DEFINE, digest) of files that were read
+
+
+# Applies the local-over-remote lookup rule for a file included from parentfilename
+def resolvefile(filename, parentfilename):
+    chead, ctail = os.path.split(filename)
+    phead, ptail = os.path.split(parentfilename)
+    potential_child = os.path.join(phead, ctail)
+    if os.path.isfile(potential_child): # Prefer local files over remote ones
+        return potential_child
+    return filename
+
+
+# Returns the hex digest of a file's contents, or None if it cannot be read
+def hashfile(filename):
     try:
-        chead, ctail = os.path.split(filename)
-        phead, ptail = os.path.split(parentfilename)
-        potential_child = os.path.join(phead, ctail)
-        if os.path.isfile(potential_child): # Prefer local files over remote ones
-            filename = potential_child
-        with open(filename, "r") as file:
-
-            for line in file.readlines():
-                nomod_line = line # Non-modified line (for use in syntax warning/error messages)
-
-                chr_index = 0
-                in_quote = False
-                while chr_index < len(line) and (in_quote or line[chr_index] != ';'):
-                    if line[chr_index] == "\"" or line[chr_index] == "'":
-                        in_quote = not in_quote
-                    chr_index += 1
-                line = line[:chr_index] # Ignore comments
-                # line = line.split(';')[0] # Ignore comments
-
-                line = line.strip()
-
-                line_num += 1
-
-                # Ignore blank lines
-                if line == "":
-                    continue
-
-                # Other form of single-line comments uses '//'
-                if line.startswith("//"):
-                    continue
+        with open(filename, "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    except OSError:
+        return None
 
-                # */ - MUST be at beginning of line
-                if re.search(f"^\*/", line):
-                    in_multi_comment = False
-                    continue
 
-                # /* - MUST be at beginning of line
-                if re.search(f"^/\*", line):
-                    if not line.endswith("*/"):
-                        in_multi_comment = True
-                    continue
-
-                # Ignore anything within a multi-line comment
-                if in_multi_comment:
-                    continue
+# Returns the (name, value) pairs of the current define table that are in names, in definition order
+def getdefinestate(names, defines):
+    return [(name, val) for (name, val) in defines.items() if name in names]
 
-                # Remove end-of-line comments
-                line = line.split("//")[0]
 
-                # ENDIF
-                match = re.search(f"^{PREPROC_CHAR}\W*endif", line, flags=re.IGNORECASE)
-                if match:
-                    stack.pop()
-                    if len(stack) < 1:
-                        pmsg(ERROR, f"Extra '{PREPROC_CHAR}endif' encountered on line {line_num} of file '{filename}'")
-                    continue
-
-                # IFDEF
-                match = re.search(f"^{PREPROC_CHAR}\W*ifdef", line, flags=re.IGNORECASE)
-                if match:
-                    macro = line[match.span()[1]:].strip()
-                    stack.append(macro in pre_defines) # True: exists, False: does not exist
-                    continue
-
-                # IFNDEF
-                match = re.search(f"^{PREPROC_CHAR}\W*ifndef", line, flags=re.IGNORECASE)
-                if match:
-                    macro = line[match.span()[1]:].strip()
-                    stack.append(macro not in pre_defines)
-                    continue
+# Loads the cached variants of a file, or an empty list if there are none
+def loadcache(path):
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except Exception:   # Missing, stale or corrupt cache files are just a miss
+        return []
+
+
+# Returns the include guard define of a file if everything in it is wrapped in
+# #ifndef NAME / #define NAME ... #endif, otherwise None
+def findguard(tokens):
+    if len(tokens) < 3 or tokens[0].directive != "ifndef" or tokens[1].directive != "define" or tokens[-1].directive != "endif":
+        return None
+    guard = tokens[0].args.strip()
+    macro = tokens[1].args.split(maxsplit=1)
+    if len(macro) == 0 or macro[0] != guard:
+        return None
+
+    # The #ifndef must not be closed before the last line
+    depth = 1
+    for token in tokens[1:-1]:
+        if token.directive in ("ifdef", "ifndef"):
+            depth += 1
+        elif token.directive == "endif":
+            depth -= 1
+            if depth < 1:
+                return None
+    if depth != 1:
+        return None
+    return guard
+
+
+# Lexes a file and every file it could include (whatever is defined) into a Lexer.lexfile() cache,
+# so that assemblies sharing the cache do not lex the same files again
+def lexincludes(filename, base_dir, cache, parentfilename=""):
+    filename = resolvefile(filename, parentfilename)
+    if filename in cache:
+        return
+    try:
+        tokens = Lexer.lexfile(filename, cache)
+    except (OSError, UnicodeDecodeError):
+        return  # preprocess() will report it
+
+    head, tail = os.path.split(filename)
+    if base_dir != "":
+        head = base_dir
+    for token in tokens:
+        if token.kind == Lexer.DIRECTIVE and token.directive == "include":
+            lexincludes(os.path.join(head, token.args.strip("\"<> \t")), "", cache, filename)
+
+
+# Preprocesses an included file in a worker process as if no defines had been made before it.
+# Returns the file's variant, or None if it could not be preprocessed on its own
+def preprocessworker(filename, parentfilename, cache_dir):
+    pre = Preprocessor(Diagnostics(1), cache_dir)   # Stop at the first error, the main process reports it
+    pre.recursion_count = 1 # Same depth as an include of the top level file
+
+    # Record the file's reads the same way a cached file's parent would
+    record = IncludeRecord(pre, filename, parentfilename, "", None)
+    pre.records.append(record)
+    try:
+        lines = list(pre.preprocess(filename, parentfilename=parentfilename))
+    except StopAssembly:  # The main process will run into (and report) the same error
+        return None
+    pre.records.pop()
+
+    variant = pre.makevariant(record, lines)
+    variant["deps"] = variant["deps"][1:]   # First dep is the file itself
+    variant["depth"] -= 1
+    variant["messages"] = pre.diagnostics.messages  # Reported by the main process if it uses the variant
+    return variant
+
+
+# Preprocessor state of one assembly
+class Preprocessor:
+    def __init__(self, diagnostics, cache_dir="", lex_cache=None):
+        self.diagnostics = diagnostics
+        self.pmsg = diagnostics.pmsg
+        self.lex_cache = lex_cache  # Lexer.lexfile() cache shared with other assemblies, None to always lex
+        self.defines = {}  # DEFINE, VALUE
+        self.define_index = {}  # DEFINE, order in which it was defined
+        self.define_count = 0
+        self.define_cache = {}  # DEFINE, fully expanded VALUE
+        self.recursion_count = 0
+        self.guards = {}  # FILENAME, (include guard DEFINE, file digest or None)
+        self.once = set()  # FILENAMEs that used #once and have been included
+        self.files = {}  # (FILENAME, PARENT FILENAME), resolved FILENAME of every file the sources depend on
+
+        # Include cache
+        self.cache_dir = cache_dir  # Cache is disabled when empty
+        self.records = []           # Record of each cached file currently being preprocessed (innermost last)
+
+        # Parallel preprocessing
+        self.executor = None
+        self.prefetched = {}        # (FILENAME, PARENT FILENAME), future of the file's variant
+
+    # Adds a define to the table
+    def adddefine(self, name, val):
+        self.defines[name] = val
+        self.define_index[name] = self.define_count
+        self.define_count += 1
+
+    # Removes a define from the table. Raises KeyError if it is not defined
+    def deldefine(self, name):
+        self.defines.pop(name)
+        self.define_index.pop(name)
+        self.define_cache.clear() # Later defines may have expanded to this one
+
+    # Returns the value of a define with any defines made before it expanded
+    def getdefine(self, name):
+        try:
+            return self.define_cache[name]
+        except KeyError:
+            val = self.expanddefines(self.defines[name], self.define_index[name])
+            self.define_cache[name] = val
+            return val
+
+    # Replaces every identifier in a line that has been defined with the define's value.
+    # Identifiers inside string and character literals are left alone. If limit is given,
+    # only defines made before the define with that index are expanded (last defined wins)
+    def expanddefines(self, line, limit=None):
+        if len(self.defines) == 0 and len(self.records) == 0:
+            return line
+
+        def replace(match):
+            name = match.group(2)
+            if name is not None and len(self.records) > 0:
+                self.records[-1].names.add(name)
+            if name is None or name not in self.defines:
+                return match.group(0)
+            if limit is not None and self.define_index[name] >= limit:
+                return match.group(0)
+            return self.getdefine(name)
+
+        return re_define_token.sub(replace, line)
+
+    # Returns the path of the cache file holding every cached variant of a file
+    def getcachepath(self, filename, base_dir, digest):
+        key = f"{PREPROC_CACHE_VERSION}\0{base_dir}\0{os.path.abspath(filename)}\0{digest}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+    # Returns true if a cached or prefetched variant of a file can be used with the current preprocessor state
+    def checkvariant(self, variant, filename, parentfilename, check_deps=True):
+        if self.recursion_count + variant["depth"] > PREPROC_MAX_RECURSION:
+            return False
+        if getdefinestate(variant["names"], self.defines) != variant["state"]:
+            return False
+        for (name, once) in variant["once_reads"].items():
+            if (name in self.once) != once:
+                return False
+        if check_deps:
+            for (dep, dep_parent, dep_resolved, dep_digest) in variant["deps"]:
+                if resolvefile(dep, dep_parent) != dep_resolved or hashfile(dep_resolved) != dep_digest:
+                    return False
+
+        # Lines from the file itself belong to whichever file included it this time
+        for line in variant["lines"]:
+            if line.filename == filename and line.parentfilename == variant["parentfilename"]:
+                line.parentfilename = parentfilename
+        variant["parentfilename"] = parentfilename
+        return True
+
+    # Looks up a cached result for a file that matches the current define state.
+    # Returns the variant or None on a miss
+    def findcache(self, filename, parentfilename, base_dir, digest):
+        for variant in loadcache(self.getcachepath(filename, base_dir, digest)):
+            if self.checkvariant(variant, filename, parentfilename):
+                return variant
+        return None
+
+    # Replays the changes a cached file made to the define table
+    def applycache(self, variant):
+        for name in variant["undefs"]:
+            self.deldefine(name)
+        for (name, val) in variant["defines"]:
+            self.adddefine(name, val)
+        self.once.update(variant["onces"])
+        self.guards.update(variant["guards"])
+
+    # Builds the cacheable result of preprocessing a file from what it read from the define table
+    def makevariant(self, record, lines):
+        # Include every define that a read define may expand to
+        names = set(record.names)
+        pending = list(names)
+        while len(pending) > 0:
+            name = pending.pop()
+            if name in record.defines:
+                for match in re_define_token.finditer(record.defines[name]):
+                    if match.group(2) is not None and match.group(2) not in names:
+                        names.add(match.group(2))
+                        pending.append(match.group(2))
+
+        # Work out what the file changed in the define table
+        undefs = [name for name in record.defines if self.define_index.get(name) != record.define_index[name]]
+        defines = [(name, val) for (name, val) in self.defines.items() if record.define_index.get(name) != self.define_index[name]]
+
+        return {
+            "parentfilename": record.parentfilename,
+            "names": names,
+            "state": getdefinestate(names, record.defines),
+            "deps": record.deps,
+            "depth": record.depth,
+            "once_reads": record.once_reads,
+            "onces": record.onces,
+            "guards": record.guards,
+            "lines": lines,
+            "undefs": undefs,
+            "defines": defines,
+        }
+
+    # Adds a variant of a file to the cache
+    def savecache(self, filename, base_dir, digest, variant):
+        path = self.getcachepath(filename, base_dir, digest)
+        variants = [variant] + loadcache(path)[:PREPROC_CACHE_VARIANTS-1]
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump(variants, file)
+            os.replace(temp_path, path)
+        except OSError:
+            self.pmsg(WARN, f"Unable to write include cache file '{path}'")
+
+    # Passes what a finished (or cached) file read up to the file that included it.
+    # child is a variant or the attributes of an IncludeRecord
+    def mergerecord(self, filename, parentfilename, resolved, digest, child):
+        if len(self.records) > 0:
+            parent = self.records[-1]
+            parent.names |= child["names"]
+            parent.deps.append((filename, parentfilename, resolved, digest))
+            parent.deps.extend(child["deps"])
+            parent.depth = max(parent.depth, child["depth"] + 1)
+            for (name, once) in child["once_reads"].items():
+                if name not in parent.onces and name not in parent.once_reads:
+                    parent.once_reads[name] = once
+            parent.onces |= child["onces"]
+            parent.guards.update(child["guards"])
+
+    # Returns true if including a file would not produce anything because it used #once or
+    # its include guard is already defined
+    def isskipped(self, filename):
+        once = filename in self.once
+        guard = self.guards.get(filename)
+        if len(self.records) > 0:
+            record = self.records[-1]
+            if filename not in record.onces and filename not in record.once_reads:
+                record.once_reads[filename] = once
+            if guard is not None:
+                record.names.add(guard[0])
+        return once or (guard is not None and guard[0] in self.defines)
+
+    # Starts preprocessing the files included by a top level file in a pool of worker processes
+    def prefetch(self, filename, base_dir, jobs):
+        filename = resolvefile(filename, "")
+        try:
+            tokens = Lexer.lexfile(filename, self.lex_cache)
+        except FileNotFoundError:
+            return  # preprocess() will report it
+
+        head, tail = os.path.split(filename)
+        if base_dir != "":
+            head = base_dir
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        for token in tokens:
+            if token.kind == Lexer.DIRECTIVE and token.directive == "include":
+                inc_filename = os.path.join(head, token.args.strip("\"<> \t"))
+                if (inc_filename, filename) not in self.prefetched:
+                    self.prefetched[(inc_filename, filename)] = self.executor.submit(preprocessworker, inc_filename, filename, self.cache_dir)
+
+    # Stops any prefetch workers that are still running
+    def endprefetch(self):
+        if self.executor is not None:
+            for future in self.prefetched.values():  # Files that have not been started are not needed
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.prefetched.clear()
+
+    # Returns the prefetched variant of an included file if it can be used with the current
+    # preprocessor state. Each prefetched variant is used at most once
+    def getprefetched(self, requested_filename, filename, parentfilename):
+        future = self.prefetched.get((requested_filename, parentfilename))
+        if future is None:
+            return None
+        try:
+            variant = future.result()
+        except Exception:   # Worker died, fall back to preprocessing here
+            variant = None
+        if variant is None or not self.checkvariant(variant, filename, parentfilename, False):
+            return None
+        self.prefetched.pop((requested_filename, parentfilename))
+
+        # Report the worker's messages where preprocessing the file here would have
+        for diag in variant["messages"]:
+            self.pmsg(diag.level, diag.msg)
+        return variant
+
+    # Loads in includes. Yields the FileLines of a file (and everything it includes) in source order.
+    # The source of the top level file can be given in text, filename is then only used in messages
+    def preprocess(self, filename, base_dir="", parentfilename="", parentlinenum=-1, text=None):
+        if self.recursion_count > PREPROC_MAX_RECURSION:
+            self.pmsg(ERROR, f"Max preprocessor recursion limit reached, check for recursive includes. Last file: {filename}, parent file: {parentfilename}", fatal=True)
+        self.recursion_count += 1
+
+        file_contents = [] # Only kept when the file is going into the cache
+
+        line_num = 0
+        stack = [] # False for not included, True for included
+        stack.append(True) # Start off including stuff
+
+
+        requested_filename = filename
+        record = None
+        errors = self.diagnostics.errors   # Files with errors are not cached, the errors would be lost
+
+        try:
+            filename = resolvefile(filename, parentfilename)
+            self.files[(requested_filename, parentfilename)] = filename
+
+            # Skip repeat includes without reading the file
+            if parentfilename != "" and self.isskipped(filename):
+                if len(self.records) > 0 and filename not in self.once:
+                    digest = self.guards[filename][1]
+                    if digest is None:
+                        digest = hashfile(filename)
+                    self.records[-1].deps.append((requested_filename, parentfilename, filename, digest))
+                self.recursion_count -= 1
+                return
+
+            # Included files may come from the cache or a prefetch worker
+            if parentfilename != "":
+                variant = None
+                digest = None
+                if self.cache_dir != "" or len(self.records) > 0:
+                    digest = hashfile(filename)
+                if self.cache_dir != "" and digest is not None:
+                    variant = self.findcache(filename, parentfilename, base_dir, digest)
+                if variant is None and len(self.prefetched) > 0:
+                    variant = self.getprefetched(requested_filename, filename, parentfilename)   # The worker has cached it
+
+                if variant is not None:
+                    self.applycache(variant)
+                    for (dep, dep_parent, dep_resolved, dep_digest) in variant["deps"]:
+                        self.files[(dep, dep_parent)] = dep_resolved
+                    self.mergerecord(requested_filename, parentfilename, filename, digest, variant)
+                    self.recursion_count -= 1
+                    yield from variant["lines"]
+                    return
+
+                if digest is not None:
+                    record = IncludeRecord(self, filename, parentfilename, base_dir, digest)
+                    self.records.append(record)
+
+            if text is not None:
+                tokens = Lexer.lex(text.splitlines(keepends=True))
+            else:
+                tokens = Lexer.lexfile(filename, self.lex_cache)
+            guard = findguard(tokens)
+            if guard is not None:
+                self.guards[filename] = (guard, record.digest if record is not None else None)
+                if record is not None:
+                    record.guards[filename] = self.guards[filename]
+
+            for token in tokens:
+                line_num = token.line_num
+                directive = token.directive
+
+                if token.kind == Lexer.DIRECTIVE:
+                    # ENDIF
+                    if directive == "endif":
+                        if len(stack) < 2:  # The first entry is the file itself
+                            self.pmsg(ERROR, f"Extra '{PREPROC_CHAR}endif' encountered on line {line_num} of file '{filename}'")
+                        else:
+                            stack.pop()
+                        continue
+
+                    # IFDEF
+                    if directive == "ifdef":
+                        macro = token.args.strip()
+                        if record is not None:
+                            record.names.add(macro)
+                        stack.append(macro in self.defines) # True: exists, False: does not exist
+                        continue
+
+                    # IFNDEF
+                    if directive == "ifndef":
+                        macro = token.args.strip()
+                        if record is not None:
+                            record.names.add(macro)
+                        stack.append(macro not in self.defines)
+                        continue
 
                 # Check if we should include this part (if stack says no, skip line)
                 if not stack[-1]:
                     continue
 
-                # UNDEF
-                match = re.search(f"^{PREPROC_CHAR}\W*undef", line, flags=re.IGNORECASE)
-                if match:
-                    macro = line[match.span()[1]:].strip()
-                    try:
-                        pre_defines.pop(macro)
-                    except KeyError:
-                        pmsg(ERROR, f"Encountered '{PREPROC_CHAR}undef' but macro '{macro}' not defined. Line {line_num} of '{filename}'")
-                    continue
-
-                # Check for includes
-                match = re.search(f"^{PREPROC_CHAR}\W*include", line, flags=re.IGNORECASE)
-                if match:
-                    inc_filename = line[match.span()[1]:].strip("\"<> \t")
-                    head, tail = os.path.split(filename)
-                    if base_dir != "":
-                        head = base_dir
-                    for inc_line in preprocess(os.path.join(head, inc_filename), parentfilename=filename, parentlinenum=line_num):
-                        file_contents.append(inc_line)
-                    continue
-
-                # Found a define, add it to table
-                match = re.search(f"^{PREPROC_CHAR}\W*define", line, flags=re.IGNORECASE)
-                if match:
-                    macro = line[match.span()[1]:].split(maxsplit=1)
-                    if len(macro) == 0:
-                        pmsg(ERROR, f"{PREPROC_CHAR}define encountered with no macro specified on line {line_num} of '{filename}")
-
-                    macro_name = macro[0]
-                    macro_val = ""
-                    if len(macro) > 1:
-                        macro_val = macro[1]
-
-                    if macro_name not in pre_defines:
-                        pre_defines[macro_name] = macro_val
-                    else:
-                        pmsg(ERROR, f"Redefinition of macro '{macro_name}' on line {line_num} of '{filename}'")
-                    continue
+                if token.kind == Lexer.DIRECTIVE:
+                    # UNDEF
+                    if directive == "undef":
+                        macro = token.args.strip()
+                        if record is not None:
+                            record.names.add(macro)
+                        try:
+                            self.deldefine(macro)
+                        except KeyError:
+                            self.pmsg(ERROR, f"Encountered '{PREPROC_CHAR}undef' but macro '{macro}' not defined. Line {line_num} of '{filename}'")
+                        continue
+
+                    # ONCE
+                    if directive == "once":
+                        self.once.add(filename)
+                        if record is not None:
+                            record.onces.add(filename)
+                        continue
+
+                    # Check for includes
+                    if directive == "include":
+                        inc_filename = token.args.strip("\"<> \t")
+                        head, tail = os.path.split(filename)
+                        if base_dir != "":
+                            head = base_dir
+                        for inc_line in self.preprocess(os.path.join(head, inc_filename), parentfilename=filename, parentlinenum=line_num):
+                            if record is not None:
+                                file_contents.append(inc_line)
+                            yield inc_line
+                        continue
+
+                    # Found a define, add it to table
+                    if directive == "define":
+                        macro = token.args.split(maxsplit=1)
+                        if len(macro) == 0:
+                            self.pmsg(ERROR, f"{PREPROC_CHAR}define encountered with no macro specified on line {line_num} of '{filename}")
+                            continue
+
+                        macro_name = macro[0]
+                        if record is not None:
+                            record.names.add(macro_name)
+                        macro_val = ""
+                        if len(macro) > 1:
+                            macro_val = macro[1]
+
+                        if macro_name not in self.defines:
+                            self.adddefine(macro_name, macro_val)
+                        else:
+                            self.pmsg(ERROR, f"Redefinition of macro '{macro_name}' on line {line_num} of '{filename}'")
+                        continue
 
                 # Nothing special, check for macros, expand them, and append line
-                # REQUIRES python 3.7+ for dict key ordering (order keys were inserted into dict)
-                define_keys = reversed(list(pre_defines.keys()))
-                for macro_key in define_keys:
-                    line = line.replace(f"{macro_key}", pre_defines[macro_key])
-                file_contents.append(FileLine(parentfilename=parentfilename, filename=filename, line_num=line_num, line=nomod_line.rstrip(), ppline=line))
+                line = FileLine(parentfilename=parentfilename, filename=filename, line_num=line_num, line=token.line, ppline=self.expanddefines(token.text))
+                if record is not None:
+                    file_contents.append(line)
+                yield line
 
 
-    except FileNotFoundError:
-        if parentfilename != "":
-            pmsg(ERROR, f"Included file '{filename}' on line {parentlinenum} of '{parentfilename}' not found.")
-        else:
-            pmsg(ERROR, f"File '{filename}' not found.")
-        exit(-1)
+        except FileNotFoundError:
+            if parentfilename != "":
+                self.pmsg(ERROR, f"Included file '{filename}' on line {parentlinenum} of '{parentfilename}' not found.", fatal=True)
+            else:
+                self.pmsg(ERROR, f"File '{filename}' not found.", fatal=True)
 
-    if len(stack) != 1:
-        pmsg(ERROR, f"Unbalanced preprocessor macros in file '{filename}'.")
+        if len(stack) != 1:
+            self.pmsg(ERROR, f"Unbalanced preprocessor macros in file '{filename}'.")
 
-    pre_recursion_count -= 1
+        if record is not None:
+            self.records.pop()
+            if self.cache_dir != "" and self.diagnostics.errors == errors:
+                self.savecache(filename, base_dir, record.digest, self.makevariant(record, file_contents))
+            self.mergerecord(requested_filename, parentfilename, filename, record.digest, vars(record))
 
-    return file_contents
+        self.recursion_count -= 1
@@ -0,0 +1,86 @@
+# Sparse ROM image covering the 65816's 24-bit address space, used with --sparse
+# Only the pages that are written to are allocated
+
+import bisect
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+ADDR_SPACE = 0x1000000  # 24-bit addresses
+
+
+# A run of data starting at an ORG directive
+class Segment:
+    def __init__(self, start):
+        self.start = start
+        self.end = start    # One past the last byte written
+
+    def __lt__(self, other):
+        return self.start < other.start
+
+
+class SparseRom:
+    def __init__(self):
+        self.pages = {}         # Page number, bytearray of PAGE_SIZE
+        self.segment = None     # Segment being written
+        self.segments = []      # Written segments, sorted by start address
+        self.overlaps = []      # (SEGMENT, SEGMENT), pairs of segments that share addresses
+
+    # Segments are found again on every pass, the pages keep their contents
+    def newpass(self):
+        self.segment = None
+        self.segments = []
+        self.overlaps = []
+
+    # Starts a new segment at addr
+    def org(self, addr):
+        self.close()
+        self.segment = Segment(addr)
+
+    # Adds the segment being written to the index, checking it against every segment it shares
+    # addresses with. Any earlier segment can reach past it, not just the one before it
+    def close(self):
+        seg = self.segment
+        self.segment = None
+        if seg is None or seg.end == seg.start:
+            return
+
+        i = bisect.bisect(self.segments, seg)
+        for other in self.segments[:i]:
+            if other.end > seg.start:
+                self.overlaps.append((other, seg))
+        j = i
+        while j < len(self.segments) and self.segments[j].start < seg.end:
+            self.overlaps.append((seg, self.segments[j]))
+            j += 1
+        self.segments.insert(i, seg)
+
+    def write(self, addr, data):
+        if self.segment is not None:
+            self.segment.end = max(self.segment.end, addr + len(data))
+
+        i = 0
+        while i < len(data):
+            page = (addr + i) >> PAGE_BITS
+            offset = (addr + i) & (PAGE_SIZE - 1)
+            n = min(len(data) - i, PAGE_SIZE - offset)
+            buf = self.pages.get(page)
+            if buf is None:
+                buf = bytearray(PAGE_SIZE)
+                self.pages[page] = buf
+            buf[offset:offset+n] = data[i:i+n]
+            i += n
+
+    # Returns the bytes in [start, end), unwritten pages read as 0
+    def read(self, start, end):
+        data = bytearray()
+        addr = start
+        while addr < end:
+            offset = addr & (PAGE_SIZE - 1)
+            n = min(end - addr, PAGE_SIZE - offset)
+            buf = self.pages.get(addr >> PAGE_BITS)
+            if buf is None:
+                data.extend(bytes(n))
+            else:
+                data.extend(buf[offset:offset+n])
+            addr += n
+        return data
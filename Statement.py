@@ -0,0 +1,39 @@
+# Decoded form of an assembly line, built once and run on every pass
+
+# Statement kinds
+STMT_ERROR = 0          # Prints text as an error
+STMT_LABEL = 1
+STMT_ORG = 2
+STMT_INSTRUCTION = 3
+STMT_BYTE = 4
+STMT_WORD = 5
+STMT_DATE = 6
+STMT_BUILD = 7
+STMT_EQU = 8
+STMT_AL = 9
+STMT_XL = 10
+STMT_AS = 11
+STMT_XS = 12
+
+# Instruction addressing modes
+MODE_INVALID = 0        # Reports an invalid addressing mode when run
+MODE_IMPLIED = 1
+MODE_IMMEDIATE = 2
+MODE_ADDRESS = 3        # Direct, absolute or long, picked from the operand's value
+MODE_REL8 = 4
+MODE_REL16 = 5
+MODE_BLOCK = 6
+
+
+class Statement:
+    def __init__(self, kind, name="", text="", exps=(), args=()):
+        self.kind = kind
+        self.name = name        # Label, equate symbol or mnemonic
+        self.text = text        # Equate expression or error message
+        self.exps = exps        # Compiled operand expressions
+        self.args = args        # .byte/.word arguments, a compiled expression or a list of character values
+        self.instruction = None
+        self.mode = MODE_INVALID
+        self.opcodes = ()       # Direct, absolute and long opcodes (MODE_ADDRESS)
+        self.force = 0          # Addressing mode forced by a '<', '!' or '>' prefix (MODE_ADDRESS)
+        self.warn = False       # Warn about a potentially invalid indirect addressing mode
@@ -1,10 +1,17 @@
+# Value of a symbol that has not been resolved yet
+SYMVALUNK = 0xffffffff
 
 class Symbol:
+    __slots__ = ("sym", "val", "exp", "lpc", "resolved", "pending", "version")
+
     def __init__(self, sym:str, val:int, exp:str, lpc:int):
-        self.sym = sym 
-        self.val = val
-        self.exp = exp
+        self.sym = sym
+        self.val = val          # Value returned by lookups
+        self.exp = exp          # Expression and PC of the latest definition
         self.lpc = lpc
+        self.resolved = False   # True once the symbol has had a resolved value
+        self.pending = False    # True if the latest definition could not be resolved
+        self.version = 0        # Changes every time val changes
 
     def __eq__(self, other):
         if (type(other) == Symbol):
@@ -17,3 +24,106 @@ class Symbol:
             return self.sym < other.sym
         else:
             return self.sym < other
+
+
+# Single store for resolved and unresolved symbols. A symbol whose latest definition is unresolved
+# keeps the value it had when it was last resolved
+class SymbolTable:
+    def __init__(self):
+        self.symbols = {}       # SYM, Symbol
+        self.version = 0        # Last version given to a symbol
+        self.changed = set()    # SYMs whose value changed since clearchanges()
+        self.watchers = {}      # SYM, objects to tell the next time its value changes
+
+    def __contains__(self, sym):
+        return sym in self.symbols
+
+    def get(self, sym):
+        return self.symbols.get(sym)
+
+    # Returns the value of a symbol, default if it is not defined
+    def value(self, sym, default=None):
+        symbol = self.symbols.get(sym)
+        if symbol is None:
+            return default
+        return symbol.val
+
+    # Returns the version of a symbol's value, -1 if it is not defined
+    def getversion(self, sym):
+        symbol = self.symbols.get(sym)
+        if symbol is None:
+            return -1
+        return symbol.version
+
+    # Defines a symbol. Values of SYMVALUNK leave the symbol pending resolution
+    def define(self, sym, val, exp, lpc, notify=True):
+        symbol = self.symbols.get(sym)
+        if symbol is None:
+            symbol = Symbol(sym, SYMVALUNK, exp, lpc)
+            self.symbols[sym] = symbol
+
+        symbol.exp = exp
+        symbol.lpc = lpc
+        if val == SYMVALUNK:
+            symbol.pending = True
+            if symbol.version == 0:     # New symbol
+                self.setval(symbol, SYMVALUNK, notify)
+        else:
+            self.resolve(sym, val, notify)
+
+    # Gives a pending symbol its resolved value
+    def resolve(self, sym, val, notify=True):
+        symbol = self.symbols[sym]
+        symbol.resolved = True
+        symbol.pending = False
+        self.setval(symbol, val, notify)
+
+    # Marks a symbol as resolved with any value, even SYMVALUNK
+    def force(self, sym, val):
+        symbol = self.symbols[sym]
+        symbol.resolved = True
+        self.setval(symbol, val, True)
+
+    def setval(self, symbol, val, notify):
+        if symbol.val == val and symbol.version != 0:
+            return
+        symbol.val = val
+        self.version += 1
+        symbol.version = self.version
+        if notify:
+            self.changed.add(symbol.sym)
+            self.notify(symbol.sym)
+
+    def remove(self, sym):
+        self.symbols.pop(sym, None)
+        self.changed.discard(sym)
+        self.notify(sym)
+
+    # Calls watcher.symchanged(sym) the next time the value of a symbol changes or the symbol is
+    # removed. Symbols that are not defined yet can be watched. Each watch is only told once
+    def watch(self, sym, watcher):
+        watchers = self.watchers.get(sym)
+        if watchers is None:
+            self.watchers[sym] = [watcher]
+        else:
+            watchers.append(watcher)
+
+    def notify(self, sym):
+        watchers = self.watchers.pop(sym, None)
+        if watchers is not None:
+            for watcher in watchers:
+                watcher.symchanged(sym)
+
+    # Returns the SYMs that changed since the last call, and starts recording again
+    def clearchanges(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    # SYMs with a resolved value, in definition order
+    def resolvedsyms(self):
+        return [sym for sym in self.symbols if self.symbols[sym].resolved]
+
+    # SYMs whose latest definition could not be resolved, in definition order
+    def pendingsyms(self):
+        return [sym for sym in self.symbols if self.symbols[sym].pending]
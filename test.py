@@ -1,9 +1,16 @@
 
 from Assembler import *
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
 
-print(parseexp("{ $35 &7 (4 -(9*2)+2) - + } + $6 - ($4 * { 6 2 * } )+ $5"))
-print(parseexp("5"))
-print(parseexp("2+'A'-1"))
+asm = Assembler()
+print(asm.parseexp("{ $35 &7 (4 -(9*2)+2) - + } + $6 - ($4 * { 6 2 * } )+ $5"))
+print(asm.parseexp("5"))
+print(asm.parseexp("2+'A'-1"))
 
 
 def testparseexp(string):
@@ -12,4 +19,217 @@ def testparseexp(string):
 
     if string == "":
         return 0
-    
+
+
+
+# Regression fixtures. test/NAME.asm is assembled by Assembler.py with the options on a
+# "; TEST: <options>" first line ({tmp} is a temporary directory) and every output file is compared
+# with the file of the same name in test/. Fixtures that fail are compared with test/NAME.err, one
+# "FILE:LINE: message" per error. Fixtures with --cache-dir are built twice, the second build reads
+# the cache
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test")
+ASSEMBLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Assembler.py")
+failures = []
+
+
+def check(name, ok):
+    if not ok:
+        failures.append(name)
+    print(f"{'PASS' if ok else 'FAIL'} {name}")
+
+
+# Runs Assembler.py in cwd. Returns (exit code, output without colours)
+def runassembler(argv, cwd=TEST_DIR):
+    proc = subprocess.run([sys.executable, ASSEMBLER] + argv, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    return (proc.returncode, re.sub(r"\x1b\[[0-9;]*m", "", proc.stdout))
+
+
+# Returns the errors in the output of a build, one "FILE:LINE: message" per error
+def geterrors(output):
+    errors = []
+    for text in re.split(r"^(?=\[(?:INFO|WARN|ERROR)\] )", output, flags=re.M):
+        if text.startswith("[ERROR] "):
+            where = re.search(r" on line (\d+) of '([^']*)':\n", text)
+            msg = text[8:where.start() if where else len(text)].split("\n")[0]
+            errors.append(f"{where.group(2)}:{where.group(1)}: {msg}" if where else msg)
+    return "\n".join(errors) + "\n"
+
+
+# Builds a fixture into tmp. Returns (ok, output)
+def buildfixture(name, tmp):
+    with open(os.path.join(TEST_DIR, name + ".asm"), "r") as file:
+        argv = file.readline()[7:].replace("{tmp}", tmp).split()
+    code, output = runassembler(argv + ["-a", name + ".asm", "-o", os.path.join(tmp, name + ".bin"), "-l", os.path.join(tmp, name + ".lst")])
+    return (code == 0, output)
+
+
+def runfixture(name, update):
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = 1
+        with open(os.path.join(TEST_DIR, name + ".asm"), "r") as file:
+            if "--cache-dir" in file.readline():
+                runs = 2
+        for run in range(runs):
+            for output in os.listdir(tmp):
+                if os.path.isfile(os.path.join(tmp, output)):
+                    os.remove(os.path.join(tmp, output))
+            ok, output = buildfixture(name, tmp)
+            outputs = {}
+            if ok:
+                for output in os.listdir(tmp):
+                    if os.path.isfile(os.path.join(tmp, output)):
+                        with open(os.path.join(tmp, output), "rb") as file:
+                            outputs[output] = file.read()
+            else:
+                outputs[name + ".err"] = geterrors(output).encode()
+
+            if update:
+                for output, data in outputs.items():
+                    with open(os.path.join(TEST_DIR, output), "wb") as file:
+                        file.write(data)
+                break
+            same = True
+            for output, data in outputs.items():
+                try:
+                    with open(os.path.join(TEST_DIR, output), "rb") as file:
+                        same = same and file.read() == data
+                except OSError:
+                    same = False
+            check(f"{name}{' (cached)' if run > 0 else ''}", same)
+
+
+def runfixtures(update=False):
+    for filename in sorted(os.listdir(TEST_DIR)):
+        if filename.endswith(".asm"):
+            with open(os.path.join(TEST_DIR, filename), "r") as file:
+                if not file.readline().startswith("; TEST:"):
+                    continue
+            runfixture(filename[:-4], update)
+
+
+# assemble() with a file, with source text and with a missing file
+def testassemble():
+    result = assemble(os.path.join(TEST_DIR, "replay.asm"), Options(rom_size=64))
+    with open(os.path.join(TEST_DIR, "replay.bin"), "rb") as file:
+        check("assemble file", result.ok and result.rom == file.read() and result.symbols["later"] == 0x1010)
+
+    result = assemble(text="    org $8000\nstart:\n    jmp start\n", options=Options(rom_size=3))
+    check("assemble text", result.ok and result.rom == bytes([0x4c, 0x00, 0x80]) and result.symbols["start"] == 0x8000)
+
+    result = assemble(text="    org 0\n    lda #1 / 0\n    ldq #2\n", options=Options(rom_size=4, max_errors=0))
+    check("assemble text errors", not result.ok and result.errors == 2 and result.rom is None)
+
+    result = assemble(os.path.join(TEST_DIR, "missing.asm"))
+    check("assemble missing file", not result.ok and result.errors == 1 and "not found" in result.messages[-1].msg)
+
+    try:
+        assemble()
+        check("assemble nothing", False)
+    except ValueError:
+        check("assemble nothing", True)
+
+
+# A cached include is read again when it, or a file it includes, changes
+def testcacheinvalidation():
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("cache.asm", "cache_mid.inc", "cache_leaf.inc"):
+            shutil.copy(os.path.join(TEST_DIR, name), tmp)
+
+        def runbuild():
+            code, output = runassembler(["-r", "64", "-a", "cache.asm", "-o", "out.bin", "--cache-dir", "cache"], tmp)
+            if code != 0:
+                return None
+            with open(os.path.join(tmp, "out.bin"), "rb") as file:
+                return file.read()
+
+        first = runbuild()
+        with open(os.path.join(TEST_DIR, "cache.bin"), "rb") as file:
+            check("cache cold", first == file.read())
+        check("cache written", len(os.listdir(os.path.join(tmp, "cache"))) > 0)
+
+        with open(os.path.join(tmp, "cache_leaf.inc"), "w") as file:
+            file.write("    inx\n    iny\n")
+        changed = runbuild()
+        check("cache invalidated", changed is not None and changed[:7] == bytes([0x12, 0xe8, 0xc8, 0x34, 0x12, 0xe8, 0xc8]))
+
+        shutil.copy(os.path.join(TEST_DIR, "cache_leaf.inc"), tmp)
+        check("cache restored", runbuild() == first)
+
+
+# -j prints the same warnings as preprocessing every file in the main process. The cache directory
+# is a file, so every included file warns that it could not be cached
+def testprefetchwarnings():
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("cache.asm", "cache_mid.inc", "cache_leaf.inc"):
+            shutil.copy(os.path.join(TEST_DIR, name), tmp)
+        open(os.path.join(tmp, "cache"), "w").close()
+
+        warnings = []
+        for jobs in ("1", "2"):
+            code, output = runassembler(["-r", "64", "-a", "cache.asm", "-o", "out.bin", "--cache-dir", "cache", "-j", jobs], tmp)
+            warnings.append([line for line in output.splitlines() if line.startswith("[WARN] ")] if code == 0 else None)
+        check("prefetch warnings", warnings[0] is not None and len(warnings[0]) == 4 and warnings[1] == warnings[0])
+
+
+# --depfile lists every included file, --if-changed skips a build until an input changes
+def testincremental():
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("cache.asm", "cache_mid.inc", "cache_leaf.inc"):
+            shutil.copy(os.path.join(TEST_DIR, name), tmp)
+
+        # Returns True if the program was assembled
+        def runbuild():
+            code, output = runassembler(["-r", "64", "-a", "cache.asm", "-o", "out.bin", "--depfile", "out.d", "--if-changed"], tmp)
+            return code == 0 and "No inputs changed" not in output
+
+        check("if-changed first build", runbuild())
+        with open(os.path.join(tmp, "out.d"), "r") as file:
+            deps = file.read()
+        check("depfile", deps.startswith("out.bin:") and "cache_mid.inc" in deps and "cache_leaf.inc:" in deps)
+        check("if-changed unchanged", not runbuild())
+
+        with open(os.path.join(tmp, "cache_leaf.inc"), "a") as file:
+            file.write("    nop\n")
+        check("if-changed include changed", runbuild())
+        os.remove(os.path.join(tmp, "out.bin"))
+        check("if-changed output removed", runbuild())
+
+
+# --batch builds every program of a manifest with the options from the command line and from the
+# manifest, paths in the manifest are relative to it. A failed build fails the batch
+def testbatch():
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.path.join(tmp, "cwd")  # The manifest's paths must not be read from here
+        os.mkdir(cwd)
+        with open(os.path.join(tmp, "manifest.txt"), "w") as file:
+            file.write("# Fixtures\n")
+            for name, opts in (("defines", "-r 64"), ("replay", "-r 64 -w"), ("precedence", "--precedence -r 16")):
+                shutil.copy(os.path.join(TEST_DIR, name + ".asm"), tmp)
+                file.write(f"{name}.asm {name}.bin -l {name}.lst {opts}\n")
+
+        code, output = runassembler(["--batch", os.path.join(tmp, "manifest.txt"), "--batch-jobs", "2", "-j", "2", "--max-errors", "3", "-i"], cwd)
+        same = code == 0
+        for name in ("defines", "replay", "precedence"):
+            for ext in (".bin", ".lst"):
+                if same:
+                    with open(os.path.join(tmp, name + ext), "rb") as out, open(os.path.join(TEST_DIR, name + ext), "rb") as expected:
+                        same = out.read() == expected.read()
+        check("batch", same)
+
+        shutil.copy(os.path.join(TEST_DIR, "maxerrors_divzero.asm"), tmp)
+        with open(os.path.join(tmp, "manifest.txt"), "a") as file:
+            file.write("maxerrors_divzero.asm divzero.bin -r 16\n")
+        code, output = runassembler(["--batch", os.path.join(tmp, "manifest.txt"), "--batch-jobs", "2"], cwd)
+        check("batch failed build", code != 0 and "FAILED" in output)
+
+
+if __name__ == "__main__":
+    runfixtures("--update" in sys.argv)
+    testassemble()
+    testcacheinvalidation()
+    testprefetchwarnings()
+    testincremental()
+    testbatch()
+    print(f"{len(failures)} failure(s)")
+    exit(1 if len(failures) > 0 else 0)
@@ -0,0 +1,7 @@
+; TEST: -r 64 --cache-dir {tmp}/cache
+; Included files are cached, the second build reads them from the cache. The same file is
+; included with different defines, so it is cached once for each
+    org $0
+#include "cache_mid.inc"
+#define BIG
+#include "cache_mid.inc"
@@ -0,0 +1,15 @@
+; TEST: -r 64
+; Defines are replaced by whole identifier, including in the value of other defines,
+; but not inside string literals or longer identifiers
+#define PORT $10
+#DEFINE VALUE (PORT + 1) ; comment
+#define MSG "PORT"
+    org $0
+PORTB equ $20
+    lda #VALUE
+    sta PORT
+    sta PORTB
+    .byte MSG, 'P'
+#undef PORT
+PORT equ $30
+    sta PORT
@@ -0,0 +1,13 @@
+; TEST: -r 16
+; Enums with no name, with a name and with a start value
+    org $0
+!enum {
+    UP
+    DOWN
+}
+!enum DIR =4 {
+    LEFT
+    RIGHT
+}
+    lda #DOWN
+    lda #DIR.RIGHT
@@ -0,0 +1,10 @@
+; TEST: -r 64
+; A guarded file is skipped while its guard is defined and read again after an #undef.
+; A file with #once is only read the first time
+    org $0
+#include "guards_guarded.inc"
+#include "guards_guarded.inc"
+#include "guards_once.inc"
+#include "guards_once.inc"
+#undef GUARDS_GUARDED_H
+#include "guards_guarded.inc"
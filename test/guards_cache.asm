@@ -0,0 +1,3 @@
+; TEST: -r 64 --cache-dir {tmp}/cache
+; Include guards and #once with cached files
+#include "guards.asm"
@@ -0,0 +1,45 @@
+; TEST: -r 64
+; Macros with args, local labels, the macro stack, variables and conditional blocks
+    org $2000
+!macro STORE @val @addr {
+    lda #@val
+    sta @addr
+}
+!macro LOOP @count {
+__loop:
+    dex
+    !if @count == 2
+    nop
+    !else
+    inx
+    !endif
+    bne __loop
+}
+!macro PUSHLBL {
+    !mpush frame here:
+}
+!macro POPLBL {
+    !mpop frame
+}
+!macro SETMODE @mode {
+    !setvar mode @mode
+}
+!macro VARS {
+    !ifvar mode == fast
+    lda #1
+    !else
+    lda #2
+    !endif
+}
+    STORE $12 $34
+    STORE $12 $34
+    LOOP 2
+    LOOP 3
+    LOOP 2
+    PUSHLBL
+    jmp here
+    POPLBL
+    SETMODE fast
+    VARS
+    SETMODE slow
+    VARS
@@ -0,0 +1,8 @@
+; TEST: -r 16 --max-errors 0
+; Division by zero and bad expressions are reported without stopping the other lines
+    org $0
+    lda #8 / 0
+    lda #8 % 0
+    lda #{ 2 + + }
+    lda #3
+    ldq #4
@@ -0,0 +1,9 @@
+; TEST: -r 16 --max-errors 0
+; Each extra #endif is reported, the preprocessor carries on after the first one
+    org $0
+#ifdef NOT_DEFINED
+    lda #1
+#endif
+#endif
+    lda #2
+#endif
@@ -0,0 +1,7 @@
+; TEST: -r 16 --max-errors 0
+; An enum needs an opening bracket, its keys are still read up to the closing bracket
+    org $0
+!enum COLORS
+    RED
+}
+!enum
@@ -0,0 +1,8 @@
+; TEST: -r 16 --max-errors 0
+; Errors in two lines of one macro expansion are both reported
+    org $0
+!macro DIV @a {
+    lda #@a / 0
+    ldx #@a / 0
+}
+    DIV 4
@@ -0,0 +1,10 @@
+; TEST: -r 16 --max-errors 0
+; A macro without an opening bracket or a name is reported, errors after it are still found
+    org $0
+!macro FOO
+    nop
+}
+!macro
+!enum COLORS
+    RED
+}
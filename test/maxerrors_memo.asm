@@ -0,0 +1,10 @@
+; TEST: -r 16 --max-errors 0
+; Repeating an invocation that reports an error reports it again
+    org $0
+!macro CHECK @a {
+!if @a <> 1
+    nop
+!endif
+}
+    CHECK 1
+    CHECK 1
@@ -0,0 +1,10 @@
+; TEST: -r 16 --precedence
+; Operators bind by precedence, not left to right
+    org $0
+    lda #2 + 3 * 4
+    lda #(2 + 3) * 4
+    lda #1 << 2 + 1
+    lda #$f0 | $0f & $3c
+    lda #fwd - 2 * 3
+    lda #20 / 3 % 4
+fwd equ 10 + 2 * 5
@@ -0,0 +1,9 @@
+; TEST: -r 16 --precedence --max-errors 5
+; Division by zero in a symbol resolved after the first pass is reported on the symbol's line
+    org $0
+foo equ 8 / zero
+bar equ 1 << neg
+    lda #foo
+    lda #bar
+zero equ 0
+neg equ 0 - 1
@@ -0,0 +1,8 @@
+; TEST: -r 64 -j 2
+; Included files are preprocessed in worker processes. The second one depends on a define
+; made before it is included, so the worker's copy is checked before it is used
+    org $0
+#include "prefetch_a.inc"
+#define WIDE
+#include "prefetch_b.inc"
+    jmp a_start
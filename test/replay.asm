@@ -0,0 +1,13 @@
+; TEST: -r 64
+; Lines that are replayed on later passes keep their bytes and write them to ROM again
+    org $1000
+start:
+    lda #end - start
+    .byte $01, $02, "hi", 3
+    .word start, end
+    jmp later
+    .word $1234
+later:
+    bra start
+    .byte end & $ff
+end:
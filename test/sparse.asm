@@ -0,0 +1,8 @@
+; TEST: --sparse
+; Each ORG starts a segment that is written to its own file, anywhere in the 24-bit address space
+    org $00fffe
+    .word $1234, $5678
+    org $c00000
+    jml $00fffe
+    org $8000
+    .byte "hi"
@@ -0,0 +1,17 @@
+; TEST: --sparse --max-errors 0
+; A segment holding two others overlaps both of them, not just the one that starts before it
+    org 0
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    .byte "0123456789"
+    org 10
+    .byte "0123456789"
+    org 50
+    .byte "0123456789"
@@ -0,0 +1,8 @@
+; TEST: --sparse --max-errors 0
+; Segments that share addresses are reported
+    org $1000
+    .byte 1, 2, 3, 4
+    org $1002
+    .byte 5
+    org $0ffe
+    .word $1234, $5678
@@ -0,0 +1,15 @@
+; TEST: -r 64 --verify
+; Every instruction decodes back to its mnemonic with the register widths at its line
+    org $0
+    rep #$30
+    .al
+    .xl
+    lda #$1234
+    ldx #$5678
+    sep #$20
+    .as
+    lda #$12
+    dea
+    jml $123456
+    mvn $01, $02
+    bra $0
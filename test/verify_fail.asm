@@ -0,0 +1,6 @@
+; TEST: -r 64 --verify
+; A stray comma turns the jump into a block move with no opcode, which does not verify
+    org $0
+    nop
+label:
+    jmp label,